@@ -1,44 +1,105 @@
+import contextvars
+import logging
 import os
-import tempfile
-import zipfile
+import threading
+import time
+import uuid
 import gradio as gr
-import torch
-import numpy as np
-import wave
-import torchaudio
-import torchaudio.functional as F
-from demucs.pretrained import get_model
-from demucs.audio import AudioFile
-from demucs.apply import apply_model
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse, Response
+
+from audio_encoding import CONTAINERS, OUTPUT_CONTAINER, negotiate_container
+from demucs_config import DemucsConfig
+from output_store import OUTPUT_DIR, get_output_store
+from stem_cache import get_stem_cache
+from telemetry import (
+    CACHE_HIT_RATIO,
+    IN_FLIGHT,
+    MODELS_RESIDENT,
+    RequestTrace,
+    metrics_payload,
+    track_gauge,
+)
 
 # Configuration
-MODEL_NAME = os.environ.get("DEMUCS_MODEL", "htdemucs_ft")  # Use fine-tuned model for better quality
-TARGET_SAMPLE_RATE = 44100
-TARGET_NUM_CHANNELS = 2
+# Deployment default (DEMUCS_QUALITY / DEMUCS_MODEL); the UI can pick another preset
+DEFAULT_CONFIG = DemucsConfig.for_request()
+MODEL_NAME = DEFAULT_CONFIG["model_name"]
 MAX_DURATION_SECONDS = int(os.environ.get("MAX_DURATION_SECONDS", "30"))
-USE_FLOAT32 = os.environ.get("USE_FLOAT32", "true").lower() == "true"
+# Load the default model during startup; /ready reports 503 until it is resident
+PRELOAD_MODEL = os.environ.get("PRELOAD_MODEL", "true").lower() == "true"
+# Separations run at once (each gets an equal share of the cores) and requests that may wait
+GRADIO_CONCURRENCY = max(1, int(os.environ.get("GRADIO_CONCURRENCY", str(min(4, max(1, (os.cpu_count() or 1) // 2))))))
+GRADIO_QUEUE_SIZE = max(1, int(os.environ.get("GRADIO_QUEUE_SIZE", "32")))
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+_STARTED_AT = time.time()
+_pipeline_lock = threading.Lock()
+_pipeline_module = None
+_warm_up_error = None
 
-# Global model cache
-_loaded_model = None
-_inference_device = "cuda" if torch.cuda.is_available() else "cpu"
+def _pipeline():
+    """The separation pipeline (torch, torchaudio, demucs), imported on first use"""
+    global _pipeline_module
+    with _pipeline_lock:
+        if _pipeline_module is None:
+            start = time.perf_counter()
+            import space_pipeline
+            threads = space_pipeline.set_concurrency(GRADIO_CONCURRENCY)
+            _pipeline_module = space_pipeline
+            logger.info(
+                "Separation pipeline imported in %.2fs (%d concurrent requests, %d threads)",
+                time.perf_counter() - start, GRADIO_CONCURRENCY, threads,
+            )
+        return _pipeline_module
+
+def _warm_up():
+    """Import the pipeline and preload the default model; runs on a background thread"""
+    global _warm_up_error
+    try:
+        pipeline = _pipeline()
+        if PRELOAD_MODEL:
+            pipeline.load_demucs_model(MODEL_NAME)
+        logger.info("Ready %.2fs after start", time.time() - _STARTED_AT)
+    except Exception as e:
+        # The UI keeps running; the first request retries the load
+        _warm_up_error = str(e)
+        logger.exception("Warm-up failed")
 
-def load_demucs_model():
-    """Load and cache the Demucs model"""
-    global _loaded_model
-    if _loaded_model is None:
-        print(f"Loading model {MODEL_NAME} on device {_inference_device}")
-        model = get_model(MODEL_NAME)
-        model.to(_inference_device)
-        model.eval()
-        _loaded_model = model
-    return _loaded_model
+def is_ready():
+    """True once the pipeline is imported and the default model has been loaded"""
+    pipeline = _pipeline_module
+    if pipeline is None:
+        return False
+    return not PRELOAD_MODEL or MODEL_NAME in pipeline.model_registry.load_seconds
 
-def separate_stems(audio_file):
+track_gauge(MODELS_RESIDENT, lambda: len(_pipeline_module.model_registry.resident()) if _pipeline_module else 0)
+track_gauge(CACHE_HIT_RATIO, lambda: get_stem_cache().stats()["hit_ratio"] if get_stem_cache() is not None else 0.0)
+
+def _progress_reporter(progress):
+    """``progress(fraction, desc)`` updating a ``gr.Progress`` from any thread"""
+    # gr.Progress finds its event through context variables, which inference threads do not inherit
+    context = contextvars.copy_context()
+    lock = threading.Lock()
+    def report(fraction, desc):
+        with lock:
+            context.run(progress, fraction, desc=desc)
+    return report
+
+def separate_stems(audio_file, quality=None, model_choice=None, stems=None, output_format=None, progress=None):
     """
     Separate audio into stems using Demucs
     
     Args:
         audio_file: Gradio audio input (tuple of sample_rate, audio_data)
+        quality: Quality preset name, or None for the deployment default
+        model_choice: Model preset or model name, or None for the deployment default
+        stems: Stem names to return, or None for every stem of the model
+        output_format: Stem container (wav, flac, opus, mp3), or None for OUTPUT_CONTAINER
+        progress: Optional ``gr.Progress`` updated per finished model segment
         
     Returns:
         List of separated stem audio files
@@ -46,115 +107,18 @@ def separate_stems(audio_file):
     if audio_file is None:
         return "Please upload an audio file first."
     
+    trace = RequestTrace(uuid.uuid4().hex, quality=quality, model=model_choice)
     try:
-        # Load model
-        model = load_demucs_model()
-        
-        # Extract audio data and sample rate from Gradio input
-        sample_rate, audio_data = audio_file
-        
-        # Convert to torch tensor and normalize
-        if len(audio_data.shape) == 1:
-            # Mono to stereo
-            audio_data = np.stack([audio_data, audio_data])
-        elif len(audio_data.shape) == 2 and audio_data.shape[0] > audio_data.shape[1]:
-            # Transpose if needed (samples, channels) -> (channels, samples)
-            audio_data = audio_data.T
-        
-        # Resample to target sample rate if needed using high-quality resampling
-        if sample_rate != TARGET_SAMPLE_RATE:
-            audio_tensor = torch.tensor(audio_data, dtype=torch.float32)
-            audio_tensor = F.resample(audio_tensor, sample_rate, TARGET_SAMPLE_RATE)
-            audio_data = audio_tensor.numpy()
-        
-        # Limit duration
-        max_samples = TARGET_SAMPLE_RATE * MAX_DURATION_SECONDS
-        if audio_data.shape[1] > max_samples:
-            audio_data = audio_data[:, :max_samples]
-        
-        # Improved normalization to preserve dynamics
-        # Use RMS normalization instead of z-score normalization
-        rms = np.sqrt(np.mean(audio_data ** 2))
-        if rms > 1e-8:  # Avoid division by zero
-            audio_data = audio_data / (rms * 3.0)  # Scale to prevent clipping while preserving dynamics
-        
-        # Store original statistics for denormalization
-        original_rms = rms
-        
-        # Convert to tensor with appropriate dtype
-        tensor_dtype = torch.float32 if USE_FLOAT32 else torch.float16
-        audio_tensor = torch.tensor(audio_data, dtype=tensor_dtype, device=_inference_device)
-        audio_tensor = audio_tensor.unsqueeze(0)  # Add batch dimension
-        
-        # Separate stems with optimized parameters for quality
-        with torch.no_grad():
-            separated_sources = apply_model(
-                model,
-                audio_tensor,
-                split=True,
-                overlap=0.25,  # Increased overlap for smoother transitions
-                shifts=2,      # Use multiple shifts and average for better quality
-            )[0].to("cpu")
-        
-        # Get source names
-        source_names = getattr(model, "sources", ["drums", "bass", "other", "vocals"])
-        
-        # Create temporary directory for output files
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            output_files = []
-            
-            for source_index, source_name in enumerate(source_names):
-                stem_tensor = separated_sources[source_index]
-                
-                # Improved de-normalization using original RMS
-                if original_rms > 1e-8:
-                    stem_tensor = stem_tensor * (original_rms * 3.0)
-                
-                stem_np = stem_tensor.transpose(0, 1).numpy()  # [samples, channels]
-                
-                # Apply soft clipping to reduce harsh artifacts
-                stem_np = np.tanh(stem_np * 0.9) * 1.1  # Soft saturation
-                stem_np = np.clip(stem_np, -1.0, 1.0)
-                
-                # Save as higher quality audio file
-                output_path = os.path.join(tmp_dir, f"{source_name}.wav")
-                
-                if USE_FLOAT32:
-                    # Save as 32-bit float WAV for maximum quality
-                    import soundfile as sf
-                    try:
-                        sf.write(output_path, stem_np, TARGET_SAMPLE_RATE, subtype='FLOAT')
-                    except ImportError:
-                        # Fallback to 24-bit if soundfile not available
-                        with wave.open(output_path, "wb") as wf:
-                            wf.setnchannels(TARGET_NUM_CHANNELS)
-                            wf.setsampwidth(3)  # 24-bit
-                            wf.setframerate(TARGET_SAMPLE_RATE)
-                            pcm = (stem_np * 8388607.0).astype(np.int32)
-                            # Convert to 24-bit
-                            pcm_bytes = []
-                            for sample in pcm.flatten():
-                                pcm_bytes.extend(sample.to_bytes(4, 'little', signed=True)[:3])
-                            wf.writeframes(bytes(pcm_bytes))
-                else:
-                    # Standard 16-bit output
-                    with wave.open(output_path, "wb") as wf:
-                        wf.setnchannels(TARGET_NUM_CHANNELS)
-                        wf.setsampwidth(2)  # 16-bit
-                        wf.setframerate(TARGET_SAMPLE_RATE)
-                        pcm = (stem_np * 32767.0).astype(np.int16)
-                        wf.writeframes(pcm.tobytes())
-                
-                # Copy to a permanent location for Gradio
-                import shutil
-                permanent_path = f"/tmp/{source_name}.wav"
-                shutil.copy2(output_path, permanent_path)
-                output_files.append(permanent_path)
-            
-            return output_files
-            
+        config = DemucsConfig.for_request(quality, model_choice, stems)
+        container = negotiate_container(output_format)
+        with IN_FLIGHT.track_inprogress():
+            report = _progress_reporter(progress) if progress is not None else None
+            output_files = _pipeline().separate(audio_file, config, trace, container, report)
     except Exception as e:
+        trace.finish("error")
         return f"Error during separation: {str(e)}"
+    trace.finish("ok")
+    return output_files
 
 def create_interface():
     """Create the Gradio interface"""
@@ -193,6 +157,34 @@ def create_interface():
                     format="wav"
                 )
                 
+                with gr.Row():
+                    quality_input = gr.Dropdown(
+                        label="Quality",
+                        choices=list(DemucsConfig.QUALITY_PRESETS),
+                        value=DEFAULT_CONFIG["quality"],
+                        info="maximum is slowest and cleanest, fast skips the shift ensemble"
+                    )
+                    model_input = gr.Dropdown(
+                        label="Model",
+                        choices=list(DemucsConfig.MODEL_OPTIONS),
+                        value=None,
+                        info=f"Leave empty for the default ({MODEL_NAME})"
+                    )
+                
+                stems_input = gr.CheckboxGroup(
+                    label="Stems",
+                    choices=["drums", "bass", "vocals", "other"],
+                    value=["drums", "bass", "vocals", "other"],
+                    info="Fewer stems separate faster with multi-model presets"
+                )
+                
+                format_input = gr.Dropdown(
+                    label="Output Format",
+                    choices=list(CONTAINERS),
+                    value=OUTPUT_CONTAINER,
+                    info="flac is lossless and about a third of wav; opus and mp3 are far smaller"
+                )
+                
                 separate_btn = gr.Button(
                     "🎛️ Separate Stems", 
                     variant="primary",
@@ -206,7 +198,6 @@ def create_interface():
                         <li>Maximum duration: {MAX_DURATION_SECONDS} seconds</li>
                         <li>Supported formats: WAV, MP3, FLAC, etc.</li>
                         <li>Processing time: ~30-60 seconds depending on length</li>
-                        <li>Device: {_inference_device.upper()}</li>
                     </ul>
                 </div>
                 """)
@@ -220,29 +211,30 @@ def create_interface():
                 vocals_output = gr.Audio(label="🎤 Vocals", interactive=False)
                 other_output = gr.Audio(label="🎹 Other", interactive=False)
         
-        def process_and_display(audio_file):
+        def process_and_display(audio_file, quality, model_choice, stems, output_format, progress=gr.Progress()):
             """Process audio and return individual stems"""
             if audio_file is None:
                 return None, None, None, None
                 
-            result = separate_stems(audio_file)
+            if not stems:
+                gr.Warning("Select at least one stem.")
+                return None, None, None, None
+            
+            result = separate_stems(
+                audio_file, quality or None, model_choice or None, stems, output_format or None, progress
+            )
             
             if isinstance(result, str):  # Error message
                 gr.Warning(result)
                 return None, None, None, None
             
-            # Return the four stems in order: drums, bass, other, vocals
-            # (matching the typical Demucs output order)
-            stems = [None, None, None, None]
-            for i, path in enumerate(result):
-                if i < 4:
-                    stems[i] = path
-            
-            return stems[0], stems[1], stems[3], stems[2]  # drums, bass, vocals, other
+            # Match stems by source name, models differ in source order and count
+            stems = {os.path.splitext(os.path.basename(path))[0]: path for path in result}
+            return stems.get("drums"), stems.get("bass"), stems.get("vocals"), stems.get("other")
         
         separate_btn.click(
             fn=process_and_display,
-            inputs=[audio_input],
+            inputs=[audio_input, quality_input, model_input, stems_input, format_input],
             outputs=[drums_output, bass_output, vocals_output, other_output],
             show_progress=True
         )
@@ -255,21 +247,50 @@ def create_interface():
         </div>
         """)
     
+    # Parallel users are separated concurrently; each request has its own output directory
+    demo.queue(default_concurrency_limit=GRADIO_CONCURRENCY, max_size=GRADIO_QUEUE_SIZE)
     return demo
 
-# Preload model when the module is imported
-print("Preloading Demucs model...")
-try:
-    load_demucs_model()
-    print("Model loaded successfully!")
-except Exception as e:
-    print(f"Warning: Could not preload model: {e}")
+def create_server(demo):
+    """FastAPI server with health checks, Prometheus metrics on /metrics and the Gradio UI on /"""
+    server = FastAPI(title="RiffRaff")
+    
+    @server.get("/health")
+    def health():
+        """Liveness: answers as soon as the server runs"""
+        return {
+            "status": "ok",
+            "ready": is_ready(),
+            "uptime_seconds": round(time.time() - _STARTED_AT, 1),
+            "concurrency": GRADIO_CONCURRENCY,
+            "outputs": get_output_store().stats(),
+        }
+    
+    @server.get("/ready")
+    def ready():
+        """Readiness: 200 once the default model is loaded, else 503"""
+        if is_ready():
+            return {"status": "ready", "model": MODEL_NAME}
+        return JSONResponse(
+            {"status": "starting" if _warm_up_error is None else "degraded", "model": MODEL_NAME, "error": _warm_up_error},
+            status_code=503,
+        )
+    
+    @server.on_event("startup")
+    def warm_up_on_startup():
+        # Import and preload in the background so the UI is served meanwhile
+        threading.Thread(target=_warm_up, name="warm-up", daemon=True).start()
+    
+    @server.get("/metrics")
+    def metrics():
+        body, content_type = metrics_payload()
+        return Response(content=body, media_type=content_type)
+    
+    # Mounted last: the UI takes every path not matched above
+    # OUTPUT_DIR may live outside the temp directory Gradio serves by default
+    return gr.mount_gradio_app(server, demo, path="/", allowed_paths=[OUTPUT_DIR])
 
 # Create and launch the interface
 if __name__ == "__main__":
     demo = create_interface()
-    demo.launch(
-        server_name="0.0.0.0",
-        server_port=7860,
-        share=True
-    )
\ No newline at end of file
+    uvicorn.run(create_server(demo), host="0.0.0.0", port=7860)
\ No newline at end of file
@@ -0,0 +1,161 @@
+"""
+Decoding, pre- and post-processing around Demucs inference, shared by the
+apps, the batch CLI and the benchmarks.
+
+Every step works on one contiguous float32 buffer instead of a fresh copy
+per step: an input is converted to [channels, samples] float32 (mono
+duplicated, integer PCM scaled to [-1, 1]) in a single pass, resampled and
+RMS-normalized in torch and handed to the model as is; separated stems are
+de-normalized and soft-clipped inside the model's output tensor and passed
+to the encoders as [samples, channels] views.
+
+WAV, FLAC and AIFF files are decoded in-process by libsndfile; ffmpeg (one
+subprocess per decode) is only started for compressed formats. Resampling
+kernels are built once per rate pair and reused.
+"""
+
+import math
+import os
+from functools import lru_cache
+
+import numpy as np
+import torch
+
+# Normalized audio has an RMS of 1 / NORMALIZE_HEADROOM, leaving room for peaks
+NORMALIZE_HEADROOM = 3.0
+# Soft saturation of the de-normalized stems: tanh(x * DRIVE) * GAIN, clipped to [-1, 1]
+SOFT_CLIP_DRIVE = 0.9
+SOFT_CLIP_GAIN = 1.1
+
+# Containers libsndfile decodes itself; anything else (MP3, AAC, Opus, ...) goes through ffmpeg
+NATIVE_FORMATS = ("WAV", "WAVEX", "RF64", "W64", "FLAC", "AIFF")
+# Rate pairs whose resampling kernels are kept
+RESAMPLER_CACHE_SIZE = 16
+# Block size of a whole-file ffmpeg decode
+_FFMPEG_BLOCK_SECONDS = 10.0
+
+
+def to_channels_first(audio: np.ndarray, channels: int = 2) -> np.ndarray:
+    """
+    Convert decoded audio to C-contiguous [channels, samples] float32 with one copy.
+
+    Args:
+        audio: [samples], [samples, channels] or [channels, samples] audio,
+            float or integer PCM (scaled to [-1, 1] by its full scale)
+        channels: Channel count mono input is duplicated to
+
+    Returns:
+        A new array; ``audio`` is not modified
+    """
+    if audio.ndim == 1:
+        audio = audio[np.newaxis]
+    elif audio.shape[0] > audio.shape[1]:
+        # (samples, channels) -> (channels, samples)
+        audio = audio.T
+    out_channels = channels if audio.shape[0] == 1 else audio.shape[0]
+    out = np.empty((out_channels, audio.shape[1]), dtype=np.float32)
+    # Casts, transposes and duplicates mono in the same pass
+    out[...] = audio
+    if np.issubdtype(audio.dtype, np.integer):
+        out *= np.float32(1.0 / (np.iinfo(audio.dtype).max + 1))
+    return out
+
+
+def prepare_mix(audio: np.ndarray, sample_rate: int, target_rate: int, channels: int = 2) -> torch.Tensor:
+    """
+    Decoded audio as a [channels, samples] float32 CPU tensor at ``target_rate``.
+
+    ``tensor.numpy()`` views the same memory, for numpy consumers such as
+    silence detection and cache keys.
+    """
+    return resample(torch.from_numpy(to_channels_first(audio, channels)), sample_rate, target_rate)
+
+
+@lru_cache(maxsize=RESAMPLER_CACHE_SIZE)
+def get_resampler(orig_rate: int, target_rate: int) -> torch.nn.Module:
+    """
+    Shared ``torchaudio.transforms.Resample`` for a rate pair.
+
+    Same filter as ``torchaudio.functional.resample``, whose windowed-sinc
+    kernel would be rebuilt on every call; the module is stateless apart
+    from the kernel, so concurrent requests can share it.
+    """
+    import torchaudio
+
+    return torchaudio.transforms.Resample(orig_rate, target_rate)
+
+
+def resample(audio: torch.Tensor, orig_rate: int, target_rate: int) -> torch.Tensor:
+    """Resample [..., samples] float32 audio with a cached kernel; returns ``audio`` if the rates match."""
+    if orig_rate == target_rate:
+        return audio
+    return get_resampler(int(orig_rate), int(target_rate))(audio)
+
+
+def native_info(path: str):
+    """``soundfile.info`` of a file libsndfile decodes natively (see ``NATIVE_FORMATS``), else None."""
+    import soundfile as sf
+
+    try:
+        info = sf.info(path)
+    except (RuntimeError, sf.LibsndfileError):
+        return None
+    return info if info.format in NATIVE_FORMATS and info.frames > 0 else None
+
+
+def decode_audio(path: str, target_rate: int, channels: int = 2) -> np.ndarray:
+    """
+    Decode a file to C-contiguous [channels, samples] float32 at ``target_rate``.
+
+    WAV, FLAC and AIFF with up to ``channels`` channels are read in-process
+    and resampled with a cached kernel; anything else, and multichannel
+    files that need a downmix, is decoded by ffmpeg.
+
+    Raises:
+        ValueError: When the file holds no audio
+        RuntimeError: When ffmpeg cannot decode it
+    """
+    info = native_info(path)
+    if info is not None and info.channels <= channels:
+        import soundfile as sf
+
+        audio, sample_rate = sf.read(path, dtype="float32", always_2d=True)
+        return prepare_mix(audio, sample_rate, target_rate, channels).numpy()
+
+    from streaming_separation import iter_ffmpeg_blocks
+
+    block_frames = int(target_rate * _FFMPEG_BLOCK_SECONDS)
+    blocks = list(iter_ffmpeg_blocks(path, target_rate, channels, block_frames))
+    if not blocks:
+        raise ValueError(f"No audio decoded from {os.path.basename(path)}")
+    return np.concatenate(blocks, axis=1)
+
+
+def normalization_gain(rms: float) -> float:
+    """Factor ``normalize_`` divides by and ``denormalize_`` multiplies by."""
+    return rms * NORMALIZE_HEADROOM if rms > 1e-8 else 1.0
+
+
+def normalize_(mix: torch.Tensor) -> float:
+    """
+    RMS-normalize ``mix`` in place.
+
+    Returns:
+        The gain that undoes the normalization (see ``denormalize_``)
+    """
+    rms = float(torch.linalg.vector_norm(mix)) / math.sqrt(mix.numel()) if mix.numel() else 0.0
+    gain = normalization_gain(rms)
+    if gain != 1.0:
+        mix.div_(gain)
+    return gain
+
+
+def denormalize_(stems: torch.Tensor, gain: float) -> torch.Tensor:
+    """Undo ``normalize_`` and soft-clip separated float32 audio in place; returns ``stems``."""
+    stems.mul_(gain * SOFT_CLIP_DRIVE).tanh_().mul_(SOFT_CLIP_GAIN).clamp_(-1.0, 1.0)
+    return stems
+
+
+def stem_samples(stem: torch.Tensor) -> np.ndarray:
+    """[samples, channels] view of a [channels, samples] CPU stem, the layout the encoders take."""
+    return stem.numpy().T
@@ -0,0 +1,190 @@
+"""
+Admission control for separation jobs.
+
+Every upload gets a cost estimate before it is queued:
+
+- work: capped audio seconds x shift passes x sub-models run, the unit the
+  service time is learned in (seconds per unit, a moving average over
+  finished jobs);
+- memory: a fixed working set per job (activations, ``ADMISSION_JOB_BASE_MB``)
+  plus the decoded mix and the separated sources held for its duration.
+  Silence does not count towards the duration cap but is still decoded and
+  separated, so the buffers follow the uncapped duration, up to
+  ``ADMISSION_MAX_HELD_SECONDS`` of wall-clock audio.
+
+``JobQueue`` starts a queued job only while the memory reserved by running
+jobs plus its own fits the budget, so the concurrency limit follows the
+instance size and the requests' cost (one job always runs, however large).
+The budget is ``ADMISSION_MEMORY_MB``, or ``ADMISSION_MEMORY_FRACTION`` of
+the memory left by the idle process under the container's limit.
+Estimates of the wait give clients a ``Retry-After`` when jobs are shed.
+"""
+
+import os
+import threading
+from dataclasses import dataclass
+from typing import Optional
+
+from demucs_config import DemucsConfig
+
+# Memory running jobs may reserve; 0 derives it from the container limit
+ADMISSION_MEMORY_MB = float(os.environ.get("ADMISSION_MEMORY_MB", "0"))
+ADMISSION_MEMORY_FRACTION = float(os.environ.get("ADMISSION_MEMORY_FRACTION", "0.8"))
+ADMISSION_JOB_BASE_MB = float(os.environ.get("ADMISSION_JOB_BASE_MB", "400"))
+# Clips up to this long (after the duration cap) go through the priority lane
+SHORT_CLIP_SECONDS = float(os.environ.get("SHORT_CLIP_SECONDS", "10"))
+# Queue slots long clips cannot take, so short ones still get in during a burst
+SHORT_LANE_RESERVED = max(0, int(os.environ.get("SHORT_LANE_RESERVED", "2")))
+# Short jobs started in a row before a waiting long one goes first
+SHORT_LANE_BURST = max(1, int(os.environ.get("SHORT_LANE_BURST", "3")))
+# Synchronous /separate calls are refused when their wait would exceed this
+ADMISSION_MAX_WAIT_SECONDS = float(os.environ.get("ADMISSION_MAX_WAIT_SECONDS", "120"))
+# Initial service time, seconds per audio second per shift pass per sub-model
+ADMISSION_SECONDS_PER_UNIT = float(os.environ.get("ADMISSION_SECONDS_PER_UNIT", "1.0"))
+# Same default as the pipeline; the cap bounds a job's work
+MAX_DURATION_SECONDS = int(os.environ.get("MAX_DURATION_SECONDS", "15"))
+# Longest wall-clock audio, silence included, a memory estimate counts
+ADMISSION_MAX_HELD_SECONDS = float(os.environ.get("ADMISSION_MAX_HELD_SECONDS", "600"))
+
+# Stereo float32 at 44.1 kHz
+_BYTES_PER_AUDIO_SECOND = 44100 * 2 * 4
+# Compressed uploads libsndfile cannot read are assumed to be 128 kbit/s
+_FALLBACK_BYTES_PER_SECOND = 128000 / 8
+# Weight of the newest job in the service time average
+_SERVICE_TIME_ALPHA = 0.3
+
+
+@dataclass
+class JobCost:
+    audio_seconds: float
+    # Audio seconds x shift passes x sub-models
+    work: float
+    memory_bytes: int
+    short: bool
+
+    def to_dict(self) -> dict:
+        return {
+            "audio_seconds": round(self.audio_seconds, 2),
+            "work": round(self.work, 2),
+            "memory_mb": round(self.memory_bytes / (1024 * 1024), 1),
+            "lane": "short" if self.short else "long",
+        }
+
+
+def probe_duration(path: str) -> float:
+    """Duration of an upload in seconds, from its header, or estimated from its size."""
+    import soundfile as sf
+
+    try:
+        info = sf.info(path)
+        if info.frames > 0 and info.samplerate > 0:
+            return info.frames / info.samplerate
+    except (RuntimeError, sf.LibsndfileError):
+        pass
+    return os.path.getsize(path) / _FALLBACK_BYTES_PER_SECOND
+
+
+def estimate_cost(
+    path: str,
+    options: dict,
+    max_seconds: float = MAX_DURATION_SECONDS,
+    max_held_seconds: float = ADMISSION_MAX_HELD_SECONDS,
+) -> JobCost:
+    """
+    Estimate what separating an upload with ``options`` costs.
+
+    Args:
+        path: The saved upload
+        options: Job options (``model``, ``shifts``, ``stems``)
+        max_seconds: Duration cap of the pipeline
+        max_held_seconds: Bound on the wall-clock duration held in memory
+
+    Returns:
+        The job's cost; its work grows with the capped duration, its memory
+        with the uncapped one (silence is held too)
+    """
+    probed_seconds = probe_duration(path)
+    audio_seconds = min(probed_seconds, max_seconds)
+    held_seconds = min(probed_seconds, max(max_held_seconds, audio_seconds))
+    shift_passes = max(1, options["shifts"])
+    work = audio_seconds * shift_passes * DemucsConfig.get_model_passes(options["model"], options["stems"])
+    num_sources = len(options["stems"] or DemucsConfig.get_model_sources(options["model"]))
+    # The mix, its normalized tensor and one output per source and concurrent shift pass
+    held_bytes = held_seconds * _BYTES_PER_AUDIO_SECOND * (2 + num_sources * (1 + shift_passes))
+    memory_bytes = int(ADMISSION_JOB_BASE_MB * 1024 * 1024 + held_bytes)
+    return JobCost(audio_seconds, work, memory_bytes, short=audio_seconds <= SHORT_CLIP_SECONDS)
+
+
+def memory_limit_bytes() -> Optional[int]:
+    """Memory limit of the container (cgroup v2 or v1), else of the machine; None if unknown."""
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        # "max" or a page-rounded 2^63 mean no limit
+        if value.isdigit() and int(value) < 1 << 60:
+            return int(value)
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def process_rss_bytes() -> int:
+    """Resident memory of this process."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+
+        # Peak instead of current; kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemoryBudget:
+    """Bytes running jobs may reserve together."""
+
+    def __init__(self, budget_mb: float = ADMISSION_MEMORY_MB, fraction: float = ADMISSION_MEMORY_FRACTION):
+        self._fixed = int(budget_mb * 1024 * 1024) if budget_mb > 0 else None
+        self._fraction = fraction
+        self._limit = memory_limit_bytes()
+        self._idle_rss = process_rss_bytes()
+
+    def observe_idle(self) -> None:
+        """Re-measure the process with no job running (the model and runtime it keeps)."""
+        self._idle_rss = process_rss_bytes()
+
+    @property
+    def bytes(self) -> Optional[int]:
+        """The budget; None means no limit."""
+        if self._fixed is not None:
+            return self._fixed
+        if self._limit is None:
+            return None
+        return max(0, int((self._limit - self._idle_rss) * self._fraction))
+
+
+class ServiceTimeEstimator:
+    """Moving average of job seconds per unit of work."""
+
+    def __init__(self, seconds_per_unit: float = ADMISSION_SECONDS_PER_UNIT, alpha: float = _SERVICE_TIME_ALPHA):
+        self.seconds_per_unit = seconds_per_unit
+        self._alpha = alpha
+        self._lock = threading.Lock()
+
+    def observe(self, work: float, seconds: float) -> None:
+        if work <= 0:
+            return
+        with self._lock:
+            self.seconds_per_unit += self._alpha * (seconds / work - self.seconds_per_unit)
+
+    def seconds(self, work: float) -> float:
+        return work * self.seconds_per_unit
+
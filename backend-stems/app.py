@@ -1,165 +1,423 @@
+import json
+import logging
+import math
 import os
-import tempfile
-import zipfile
-from typing import Optional
+import sys
+import threading
+import time
+from typing import AsyncIterator, List, Optional
 
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, Header, HTTPException
 import asyncio
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
 
-import torch
-import numpy as np
-import wave
+# Shared pipeline modules live at the repository root, next to the Gradio app
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _REPO_ROOT not in sys.path:
+    sys.path.append(_REPO_ROOT)
 
-from demucs.pretrained import get_model
-from demucs.audio import AudioFile
-from demucs.apply import apply_model
+# Only light modules are imported here; torch, torchaudio and demucs come in
+# with the pipeline module, which is loaded in the background (see _warm_up)
+from audio_encoding import CONTAINER_MEDIA_TYPES, negotiate_container, read_partial_wav
+from demucs_config import DemucsConfig
+from stem_cache import get_stem_cache
+from upload_ingest import UploadSizeLimitMiddleware, save_upload
+from telemetry import (
+    CACHE_HIT_RATIO,
+    IN_FLIGHT,
+    MODELS_RESIDENT,
+    QUEUE_DEPTH,
+    RequestTrace,
+    metrics_payload,
+    track_gauge,
+)
+from zip_stream import iter_zip, open_entries
+from admission import ADMISSION_MAX_WAIT_SECONDS, estimate_cost
+from jobs import (
+    JOB_DONE,
+    JOB_FAILED,
+    JOB_QUEUED,
+    Job,
+    JobExpired,
+    JobQueue,
+    JobQueueFull,
+    JobWaitTooLong,
+    ProgressCallback,
+)
 
 
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
 app = FastAPI(title="Riffraff Stem Separation", version="1.0.0")
+# Oversized uploads are refused while streaming in (MAX_UPLOAD_MB)
+app.add_middleware(UploadSizeLimitMiddleware)
+
+
+# Deployment default (DEMUCS_QUALITY / DEMUCS_MODEL); requests may pick another preset
+DEFAULT_CONFIG = DemucsConfig.for_request()
+MODEL_NAME = DEFAULT_CONFIG["model_name"]
+
+# Separation runs on a bounded pool of worker threads, never on the event loop;
+# how many of them run at once is decided by the memory budget (admission.py)
+JOB_WORKERS = max(1, int(os.environ.get("JOB_WORKERS", str(min(4, os.cpu_count() or 1)))))
+JOB_QUEUE_SIZE = max(1, int(os.environ.get("JOB_QUEUE_SIZE", "8")))
+JOB_TTL_SECONDS = float(os.environ.get("JOB_TTL_SECONDS", "3600"))
+
+# GET /jobs/{id}/events checks jobs this often, and comments on idle streams after the keep-alive
+JOB_EVENTS_INTERVAL_SECONDS = float(os.environ.get("JOB_EVENTS_INTERVAL_SECONDS", "0.5"))
+JOB_EVENTS_KEEPALIVE_SECONDS = float(os.environ.get("JOB_EVENTS_KEEPALIVE_SECONDS", "15"))
+# Separated audio a partial stem needs before it is served as a preview
+PREVIEW_MIN_SECONDS = float(os.environ.get("PREVIEW_MIN_SECONDS", "5"))
 
+# Load the default model during startup; /ready reports 503 until it is resident
+PRELOAD_MODEL = os.environ.get("PRELOAD_MODEL", "true").lower() == "true"
 
-MODEL_NAME = os.environ.get("DEMUCS_MODEL", "htdemucs_ft")  # Use fine-tuned model for better quality
-TARGET_SAMPLE_RATE = 44100
-TARGET_NUM_CHANNELS = 2
-MAX_DURATION_SECONDS = int(os.environ.get("MAX_DURATION_SECONDS", "15"))
-USE_FLOAT32 = os.environ.get("USE_FLOAT32", "true").lower() == "true"
+_STARTED_AT = time.time()
+_pipeline_lock = threading.Lock()
+_pipeline_module = None
+_warm_up_error: Optional[str] = None
 
-_loaded_model = None
-_inference_device = "cuda" if torch.cuda.is_available() else "cpu"
-try:
-    torch.set_num_threads(max(1, int(os.environ.get("TORCH_NUM_THREADS", "1"))))
-except Exception:
-    pass
 
+def _pipeline():
+    """The separation pipeline module, imported (and started) on first use."""
+    global _pipeline_module
+    with _pipeline_lock:
+        if _pipeline_module is None:
+            start = time.perf_counter()
+            import pipeline
 
-def load_demucs_model():
-    global _loaded_model
-    if _loaded_model is None:
-        model = get_model(MODEL_NAME)
-        model.to(_inference_device)
-        model.eval()
-        _loaded_model = model
-    return _loaded_model
+            pipeline.start()
+            _pipeline_module = pipeline
+            logger.info("Separation pipeline imported in %.2fs", time.perf_counter() - start)
+        return _pipeline_module
+
+
+def _warm_up() -> None:
+    global _warm_up_error
+    try:
+        pipeline = _pipeline()
+        if PRELOAD_MODEL:
+            pipeline.load_demucs_model(MODEL_NAME)
+        logger.info("Ready %.2fs after start", time.time() - _STARTED_AT)
+    except Exception as exc:
+        # The server keeps running; the first job retries the load
+        _warm_up_error = str(exc)
+        logger.exception("Warm-up failed")
+
+
+def is_ready() -> bool:
+    """True once the pipeline is imported and the default model has been loaded."""
+    pipeline = _pipeline_module
+    if pipeline is None:
+        return False
+    return not PRELOAD_MODEL or MODEL_NAME in pipeline.model_registry.load_seconds
 
 
 @app.get("/health")
 def health() -> dict:
-    return {"status": "ok", "device": _inference_device, "model": MODEL_NAME}
+    """Liveness: answers as soon as the server runs, whatever the model's state."""
+    cache = get_stem_cache()
+    pipeline = _pipeline_module
+    return {
+        "status": "ok",
+        "ready": is_ready(),
+        "model": MODEL_NAME,
+        "quality": DEFAULT_CONFIG["quality"],
+        "uptime_seconds": round(time.time() - _STARTED_AT, 1),
+        "queue_depth": job_queue.depth,
+        "workers": job_queue.num_workers,
+        "admission": job_queue.stats(),
+        "cache": cache.stats() if cache is not None else None,
+        **(pipeline.stats() if pipeline is not None else {}),
+    }
+
+
+@app.get("/ready")
+def ready():
+    """Readiness: 200 once jobs can start without a cold model load, else 503."""
+    if is_ready():
+        return {"status": "ready", "model": MODEL_NAME}
+    return JSONResponse(
+        {"status": "starting" if _warm_up_error is None else "degraded", "model": MODEL_NAME, "error": _warm_up_error},
+        status_code=503,
+    )
+
+
+@app.get("/metrics")
+def metrics() -> Response:
+    body, content_type = metrics_payload()
+    return Response(content=body, media_type=content_type)
+
+
+@app.get("/models")
+def list_models() -> dict:
+    pipeline = _pipeline_module
+    return {
+        "default": MODEL_NAME,
+        "presets": DemucsConfig.MODEL_OPTIONS,
+        "models": DemucsConfig.get_model_info(),
+        "resident": pipeline.model_registry.resident() if pipeline is not None else [],
+    }
+
+
+@app.get("/presets")
+def list_presets() -> dict:
+    return {"default": DEFAULT_CONFIG["quality"], "quality": DemucsConfig.QUALITY_PRESETS}
 
 
 @app.on_event("startup")
-async def _preload_model_on_startup() -> None:
-    # Preload in a background thread to avoid blocking readiness
-    loop = asyncio.get_running_loop()
+async def _warm_up_on_startup() -> None:
+    # Import and preload off the event loop, so liveness answers meanwhile
+    threading.Thread(target=_warm_up, name="warm-up", daemon=True).start()
+
+
+def _run_separation(job: Job, report_progress: ProgressCallback) -> List[str]:
+    """Separate ``job.input_path`` into stem files inside the job directory."""
+    trace = RequestTrace(job.id, model=job.options["model"], quality=job.options["quality"])
+    job.timings = trace.spans
     try:
-        await loop.run_in_executor(None, load_demucs_model)
+        with IN_FLIGHT.track_inprogress():
+            saved_paths = _pipeline().separate_job(job, report_progress, trace)
     except Exception:
-        # Allow app to start even if preload fails; first request will attempt to load
-        pass
+        trace.finish("error")
+        raise
+    trace.finish("ok")
+    return saved_paths
 
 
-@app.post("/separate")
-async def separate(file: UploadFile = File(...)):
+job_queue = JobQueue(
+    _run_separation,
+    num_workers=JOB_WORKERS,
+    max_queued=JOB_QUEUE_SIZE,
+    ttl_seconds=JOB_TTL_SECONDS,
+)
+
+track_gauge(QUEUE_DEPTH, lambda: job_queue.depth)
+track_gauge(MODELS_RESIDENT, lambda: len(_pipeline_module.model_registry.resident()) if _pipeline_module else 0)
+track_gauge(CACHE_HIT_RATIO, lambda: get_stem_cache().stats()["hit_ratio"] if get_stem_cache() is not None else 0.0)
+
+
+@app.on_event("startup")
+async def _start_job_workers() -> None:
+    job_queue.start()
+
+
+@app.on_event("shutdown")
+async def _stop_job_workers() -> None:
+    job_queue.stop()
+    if _pipeline_module is not None:
+        _pipeline_module.stop()
+
+
+def _job_options(
+    quality: Optional[str],
+    model: Optional[str],
+    stems: Optional[str] = None,
+    output_format: Optional[str] = None,
+    accept: Optional[str] = None,
+    preview: bool = False,
+) -> dict:
+    """Resolve the request's quality preset, model, stems and stem format into the settings a job runs with."""
+    try:
+        config = DemucsConfig.for_request(quality or None, model or None, stems or None)
+        container = negotiate_container(output_format, accept)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    return {
+        "quality": config["quality"],
+        "model": config["model_name"],
+        "overlap": config["overlap"],
+        "shifts": config["shifts"],
+        "segment_length": config["segment_length"],
+        "use_float32": config["use_float32"],
+        "stems": config["stems"],
+        "container": container,
+        # Previewable jobs run the streaming engine, which writes the stems as it goes
+        "preview": preview,
+    }
+
+
+def _retry_after(seconds: float) -> dict:
+    return {"Retry-After": str(max(1, math.ceil(seconds)))}
+
+
+def _shed(exc: JobQueueFull) -> HTTPException:
+    """429 when the queue is full, 503 when the job would wait longer than its client."""
+    status_code = 503 if isinstance(exc, JobWaitTooLong) else 429
+    return HTTPException(status_code=status_code, detail=str(exc), headers=_retry_after(exc.retry_after))
+
+
+async def _submit_upload(file: UploadFile, options: dict, max_wait: Optional[float] = None) -> Job:
     if file is None or file.filename is None or file.filename.strip() == "":
         raise HTTPException(status_code=400, detail="No file provided")
 
+    # Refuse before reading the body when even a short clip would not fit
+    try:
+        job_queue.ensure_capacity()
+    except JobQueueFull as exc:
+        raise _shed(exc)
+
+    job = job_queue.new_job(file.filename, options)
+    try:
+        await save_upload(file, job.input_path)
+        job.cost = await asyncio.get_running_loop().run_in_executor(None, estimate_cost, job.input_path, options)
+    except BaseException:
+        job_queue.discard(job)
+        raise
+
+    try:
+        return job_queue.submit(job, max_wait)
+    except JobQueueFull as exc:
+        raise _shed(exc)
+
+
+def _stems_response(job: Job, background: Optional[BackgroundTask] = None) -> StreamingResponse:
+    """Stream the job's stems as stems.zip, archived on the fly; ``background`` runs once it is sent."""
+    try:
+        entries = open_entries(job.result_paths)
+    except FileNotFoundError:
+        raise HTTPException(status_code=410, detail="Job result has expired")
+    return StreamingResponse(
+        iter_zip(entries),
+        media_type="application/zip",
+        headers={"Content-Disposition": 'attachment; filename="stems.zip"'},
+        background=background,
+    )
+
+
+def _get_job_or_404(job_id: str) -> Job:
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.post("/jobs", status_code=202)
+async def create_job(
+    file: UploadFile = File(...),
+    quality: Optional[str] = None,
+    model: Optional[str] = None,
+    stems: Optional[str] = None,
+    format: Optional[str] = None,
+    preview: bool = False,
+    accept: Optional[str] = Header(None),
+) -> dict:
+    job = await _submit_upload(file, _job_options(quality, model, stems, format, accept, preview))
+    return job.to_dict()
+
+
+def _job_status(job: Job) -> dict:
+    status = {**job.to_dict(), "queue_depth": job_queue.depth}
+    if job.status == JOB_QUEUED:
+        status["estimated_wait_seconds"] = round(job_queue.estimated_wait(job), 1)
+    return status
+
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str) -> dict:
+    return _job_status(_get_job_or_404(job_id))
+
+
+async def _iter_job_events(job: Job) -> AsyncIterator[str]:
+    """Server-sent events carrying the job's status whenever it changes, until it finishes."""
+    last_status = None
+    last_sent = time.monotonic()
+    while True:
+        # Read before the status, so the last event sent is the final status
+        finished = job.finished
+        status = _job_status(job)
+        if status != last_status:
+            event = job.status if finished else "progress"
+            yield f"event: {event}\ndata: {json.dumps(status)}\n\n"
+            last_status, last_sent = status, time.monotonic()
+        elif time.monotonic() - last_sent >= JOB_EVENTS_KEEPALIVE_SECONDS:
+            # A comment line keeps proxies from closing an idle stream
+            yield ": keep-alive\n\n"
+            last_sent = time.monotonic()
+        if finished:
+            return
+        await asyncio.sleep(JOB_EVENTS_INTERVAL_SECONDS)
+
+
+@app.get("/jobs/{job_id}/events")
+def get_job_events(job_id: str) -> StreamingResponse:
+    """Progress of a job as a text/event-stream: "progress" events, then one "done" or "failed"."""
+    job = _get_job_or_404(job_id)
+    return StreamingResponse(
+        _iter_job_events(job),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/jobs/{job_id}/preview/{stem}")
+def get_job_preview(job_id: str, stem: str):
+    """
+    One stem of a job: the part separated so far while it runs, as WAV, or the finished file.
+
+    Partial stems exist for jobs submitted with ``preview=true`` (or with
+    STREAMING_SEPARATION on), once PREVIEW_MIN_SECONDS have been separated.
+    """
+    job = _get_job_or_404(job_id)
+    sources = job.options["stems"] or DemucsConfig.get_model_sources(job.options["model"])
+    if stem not in sources:
+        raise HTTPException(status_code=404, detail=f"Job has no stem {stem!r}, expected one of {sources}")
+    if job.status == JOB_FAILED:
+        raise HTTPException(status_code=500, detail=f"Separation failed: {job.error}")
+    if job.status == JOB_DONE:
+        path = next((path for path in job.result_paths if os.path.basename(path).startswith(f"{stem}.")), None)
+        if path is None or not os.path.exists(path):
+            raise HTTPException(status_code=410, detail="Job result has expired")
+        media_type = CONTAINER_MEDIA_TYPES[job.options["container"]][0]
+        return FileResponse(path, media_type=media_type, filename=os.path.basename(path))
+
     try:
-        model = load_demucs_model()
-
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            input_path = os.path.join(tmp_dir, file.filename)
-            file_bytes = await file.read()
-            with open(input_path, "wb") as f:
-                f.write(file_bytes)
-
-            # Read and normalize audio
-            audio = AudioFile(input_path).read(
-                streams=0, samplerate=TARGET_SAMPLE_RATE, channels=TARGET_NUM_CHANNELS
-            )
-
-            # Cap duration to reduce CPU/RAM usage on small instances
-            if audio.shape[1] > TARGET_SAMPLE_RATE * MAX_DURATION_SECONDS:
-                audio = audio[:, : TARGET_SAMPLE_RATE * MAX_DURATION_SECONDS]
-
-            # Improved normalization to preserve dynamics
-            # Use RMS normalization instead of z-score normalization
-            rms = np.sqrt(np.mean(audio ** 2))
-            if rms > 1e-8:  # Avoid division by zero
-                audio = audio / (rms * 3.0)  # Scale to prevent clipping while preserving dynamics
-            
-            # Store original statistics for denormalization
-            original_rms = rms
-
-            # Convert to tensor with appropriate dtype
-            tensor_dtype = torch.float32 if USE_FLOAT32 else torch.float16
-            audio_tensor = torch.tensor(audio, dtype=tensor_dtype, device=_inference_device)
-            audio_tensor = audio_tensor.unsqueeze(0)  # [batch=1, channels, samples]
-
-            with torch.no_grad():
-                # Output shape: [sources, channels, samples]
-                separated_sources = apply_model(
-                    model,
-                    audio_tensor,
-                    split=True,  # chunked inference to reduce memory
-                    overlap=0.25,  # Increased overlap for smoother transitions
-                    shifts=2,      # Use multiple shifts and average for better quality
-                )[0].to("cpu")
-
-            source_names = getattr(model, "sources", ["drums", "bass", "other", "vocals"])  # type: ignore[attr-defined]
-
-            saved_paths = []
-            for source_index, source_name in enumerate(source_names):
-                stem_tensor = separated_sources[source_index]
-                
-                # Improved de-normalization using original RMS
-                if original_rms > 1e-8:
-                    stem_tensor = stem_tensor * (original_rms * 3.0)
-                
-                stem_np = stem_tensor.transpose(0, 1).numpy()  # [samples, channels]
-                
-                # Apply soft clipping to reduce harsh artifacts
-                stem_np = np.tanh(stem_np * 0.9) * 1.1  # Soft saturation
-                stem_np = np.clip(stem_np, -1.0, 1.0)
-
-                out_path = os.path.join(tmp_dir, f"{source_name}.wav")
-                
-                if USE_FLOAT32:
-                    # Save as 32-bit float WAV for maximum quality
-                    try:
-                        import soundfile as sf
-                        sf.write(out_path, stem_np, TARGET_SAMPLE_RATE, subtype='FLOAT')
-                    except ImportError:
-                        # Fallback to 24-bit if soundfile not available
-                        with wave.open(out_path, "wb") as wf:
-                            wf.setnchannels(TARGET_NUM_CHANNELS)
-                            wf.setsampwidth(3)  # 24-bit
-                            wf.setframerate(TARGET_SAMPLE_RATE)
-                            pcm = (stem_np * 8388607.0).astype(np.int32)
-                            # Convert to 24-bit
-                            pcm_bytes = []
-                            for sample in pcm.flatten():
-                                pcm_bytes.extend(sample.to_bytes(4, 'little', signed=True)[:3])
-                            wf.writeframes(bytes(pcm_bytes))
-                else:
-                    # Standard 16-bit output with improved quantization
-                    pcm = (stem_np * 32767.0).astype(np.int16)
-                    with wave.open(out_path, "wb") as wf:
-                        wf.setnchannels(TARGET_NUM_CHANNELS)
-                        wf.setsampwidth(2)  # 16-bit
-                        wf.setframerate(TARGET_SAMPLE_RATE)
-                        wf.writeframes(pcm.tobytes())
-                
-                saved_paths.append(out_path)
-
-            zip_path = os.path.join(tmp_dir, "stems.zip")
-            with zipfile.ZipFile(zip_path, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
-                for path in saved_paths:
-                    zf.write(path, arcname=os.path.basename(path))
-
-            # Return the zip file as the response
-            return FileResponse(zip_path, media_type="application/zip", filename="stems.zip")
+        wav, seconds = read_partial_wav(os.path.join(job.stems_dir, f"{stem}.wav"))
+    except (FileNotFoundError, ValueError):
+        # Not started, not a streaming job, or between the last block and the transcode
+        wav, seconds = b"", 0.0
+    if seconds < PREVIEW_MIN_SECONDS:
+        raise HTTPException(status_code=409, detail=f"Job is {job.stage}, no preview of {stem} yet")
+    return Response(wav, media_type="audio/wav", headers={"X-Preview-Seconds": f"{seconds:.2f}"})
+
+
+@app.get("/jobs/{job_id}/result")
+def get_job_result(job_id: str):
+    job = _get_job_or_404(job_id)
+    if job.status == JOB_FAILED:
+        raise HTTPException(status_code=500, detail=f"Separation failed: {job.error}")
+    if job.status != JOB_DONE:
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    return _stems_response(job)
+
 
+@app.post("/separate")
+async def separate(
+    file: UploadFile = File(...),
+    quality: Optional[str] = None,
+    model: Optional[str] = None,
+    stems: Optional[str] = None,
+    format: Optional[str] = None,
+    accept: Optional[str] = Header(None),
+):
+    # A caller waiting on the response is refused up front rather than left to time out
+    job = await _submit_upload(file, _job_options(quality, model, stems, format, accept), ADMISSION_MAX_WAIT_SECONDS)
+
+    try:
+        await asyncio.wrap_future(job.future)
+    except JobExpired as exc:
+        job_queue.remove(job)
+        raise HTTPException(status_code=503, detail=str(exc), headers=_retry_after(job_queue.estimated_wait(job)))
     except Exception as exc:
+        job_queue.remove(job)
         raise HTTPException(status_code=500, detail=f"Separation failed: {exc}")
 
+    # Stream the stems back as a zip; nobody polls a synchronous job, so it
+    # and its files go as soon as the zip is sent
+    try:
+        return _stems_response(job, BackgroundTask(job_queue.remove, job))
+    except HTTPException:
+        job_queue.remove(job)
+        raise
@@ -0,0 +1,183 @@
+"""
+Micro-batching of Demucs segment inference across concurrent requests.
+
+``apply_model(split=True)`` cuts every track into segments and hands each one
+to ``pool.submit(apply_model, model, chunk, ...)``. ``MicroBatcher`` is a
+drop-in for that pool: instead of running segments one at a time with batch
+size 1, it waits a few milliseconds for segments from other requests (or the
+other segments and shifts of the same request), stacks up to
+``max_batch_size`` of them into one tensor and runs a single forward pass.
+Outputs are split again and routed back to each caller's future.
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+import torch
+from demucs.apply import BagOfModels, apply_model, tensor_chunk
+from demucs.utils import center_trim
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _Pending:
+    model: Any
+    chunk: Any
+    device: torch.device
+    future: Future
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+    @property
+    def length(self) -> int:
+        return self.chunk.shape[-1]
+
+
+class MicroBatcher:
+    """Pool-compatible executor that batches single-segment model calls."""
+
+    def __init__(self, max_batch_size: int = 4, max_wait_ms: float = 20.0):
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.batches_run = 0
+        self.segments_run = 0
+        self._pending: List[_Pending] = []
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+
+    def start(self) -> None:
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stopped = False
+            self._thread = threading.Thread(target=self._loop, name="micro-batcher", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=5.0)
+            self._thread = None
+        with self._cond:
+            abandoned, self._pending = self._pending, []
+        for item in abandoned:
+            item.future.set_exception(RuntimeError("Inference batcher stopped"))
+
+    @property
+    def depth(self) -> int:
+        with self._cond:
+            return len(self._pending)
+
+    def submit(self, fn, model, mix, **kwargs) -> Future:
+        """``concurrent.futures``-style submit, as called by ``apply_model``."""
+        batchable = (
+            fn is apply_model
+            and not kwargs.get("split", True)
+            and not kwargs.get("shifts", 0)
+            and not isinstance(model, BagOfModels)
+            and self._thread is not None
+        )
+        if not batchable:
+            # Shifted, split or bag-level calls recurse into apply_model, which
+            # submits its own segments back here; run them inline.
+            future: Future = Future()
+            try:
+                future.set_result(fn(model, mix, **kwargs))
+            except Exception as exc:
+                future.set_exception(exc)
+            return future
+
+        device = kwargs.get("device")
+        item = _Pending(
+            model=model,
+            chunk=tensor_chunk(mix),
+            device=torch.device(device) if device is not None else mix.device,
+            future=Future(),
+        )
+        with self._cond:
+            self._pending.append(item)
+            self._cond.notify_all()
+        return item.future
+
+    def __enter__(self) -> "MicroBatcher":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        return
+
+    def _take_batch(self) -> List[_Pending]:
+        """Block until a batch is ready: full, or the oldest segment waited long enough."""
+        with self._cond:
+            while True:
+                if self._stopped:
+                    return []
+                if self._pending:
+                    head = self._pending[0]
+                    compatible = [
+                        item for item in self._pending
+                        if item.model is head.model and item.device == head.device
+                        and item.chunk.tensor.dtype == head.chunk.tensor.dtype
+                    ][: self.max_batch_size]
+                    remaining = head.enqueued_at + self.max_wait - time.monotonic()
+                    if len(compatible) >= self.max_batch_size or remaining <= 0:
+                        taken = set(map(id, compatible))
+                        self._pending = [item for item in self._pending if id(item) not in taken]
+                        return compatible
+                    self._cond.wait(timeout=remaining)
+                else:
+                    self._cond.wait()
+
+    def _loop(self) -> None:
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                return
+            try:
+                outputs = self._run_batch(batch)
+            except Exception as exc:
+                logger.exception("Batched inference failed for %d segments", len(batch))
+                for item in batch:
+                    item.future.set_exception(exc)
+                continue
+            for item, output in zip(batch, outputs):
+                item.future.set_result(output)
+
+    def _run_batch(self, batch: List[_Pending]) -> List[torch.Tensor]:
+        model = batch[0].model
+        device = batch[0].device
+        longest = max(item.length for item in batch)
+        if hasattr(model, "valid_length"):
+            valid_length = model.valid_length(longest)
+        else:
+            valid_length = longest
+
+        # Same zero padding around each segment as the unbatched path
+        mix = torch.cat([item.chunk.padded(valid_length) for item in batch], dim=0).to(device)
+        model.to(device)
+        model.eval()
+        with torch.no_grad():
+            out = model(mix)
+
+        self.batches_run += 1
+        self.segments_run += len(batch)
+        return [
+            center_trim(out[index:index + 1], item.length)
+            for index, item in enumerate(batch)
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000.0,
+            "pending": self.depth,
+            "batches_run": self.batches_run,
+            "segments_run": self.segments_run,
+            "mean_batch_size": (self.segments_run / self.batches_run) if self.batches_run else 0.0,
+        }
@@ -0,0 +1,425 @@
+"""
+Background job queue for stem separation.
+
+Separation is CPU-bound and can take minutes, so it must never run on the
+uvicorn event loop. Jobs are pushed onto a bounded queue and drained by a
+fixed pool of worker threads; the HTTP layer only submits jobs and polls
+their state.
+
+The queue has two lanes: short clips go first (but a waiting long job gets
+its turn after ``SHORT_LANE_BURST`` short ones), and long clips cannot take
+the last ``SHORT_LANE_RESERVED`` slots. A worker only starts a job while the
+memory reserved by running jobs plus its estimate fits the budget (see
+``admission``), and drops jobs whose client has given up waiting.
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from admission import (
+    SHORT_LANE_BURST,
+    SHORT_LANE_RESERVED,
+    JobCost,
+    MemoryBudget,
+    ServiceTimeEstimator,
+)
+from telemetry import JOBS_SHED
+
+logger = logging.getLogger(__name__)
+
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+# Finished jobs are checked for expiry this often (at most every ttl_seconds)
+JOB_REAP_INTERVAL_SECONDS = 60.0
+
+# report_progress(fraction, stage, segments=None, eta_seconds=None), handed to
+# the runner of every job; segments is (done, total) while the model runs
+ProgressCallback = Callable[..., None]
+
+
+class JobQueueFull(Exception):
+    """Raised when the queue cannot accept another job."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        # Estimated seconds until the job would be accepted
+        self.retry_after = retry_after
+
+
+class JobWaitTooLong(JobQueueFull):
+    """Raised when a job would wait longer than its client is willing to."""
+
+
+class JobExpired(Exception):
+    """Set on a job dropped from the queue after its deadline."""
+
+
+@dataclass
+class Job:
+    id: str
+    work_dir: str
+    input_path: str
+    filename: str
+    # Per-request separation settings (model, ...)
+    options: Dict[str, Any] = field(default_factory=dict)
+    status: str = JOB_QUEUED
+    stage: str = "queued"
+    progress: float = 0.0
+    # Model segments finished and expected, and the separation's estimated seconds left
+    segments_done: int = 0
+    segments_total: int = 0
+    eta_seconds: Optional[float] = None
+    error: Optional[str] = None
+    result_paths: List[str] = field(default_factory=list)
+    # Seconds spent per pipeline stage, filled in by the runner
+    timings: Dict[str, float] = field(default_factory=dict)
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    future: Future = field(default_factory=Future, repr=False)
+    # Admission estimate; None is treated as free and short
+    cost: Optional[JobCost] = None
+    # Wall-clock time after which a still-queued job is dropped
+    deadline: Optional[float] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (JOB_DONE, JOB_FAILED)
+
+    @property
+    def stems_dir(self) -> str:
+        """Where the runner writes the stems, and the streaming engine its partial ones."""
+        return os.path.join(self.work_dir, "stems")
+
+    @property
+    def short(self) -> bool:
+        return self.cost is None or self.cost.short
+
+    @property
+    def memory_bytes(self) -> int:
+        return self.cost.memory_bytes if self.cost is not None else 0
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "stage": self.stage,
+            "progress": round(self.progress, 4),
+            "segments": {"done": self.segments_done, "total": self.segments_total},
+            "eta_seconds": round(self.eta_seconds, 1) if self.eta_seconds is not None else None,
+            "error": self.error,
+            "filename": self.filename,
+            "options": self.options,
+            "timings": {stage: round(seconds, 4) for stage, seconds in self.timings.items()},
+            "cost": self.cost.to_dict() if self.cost is not None else None,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobQueue:
+    """Bounded two-lane queue of separation jobs drained by a pool of worker threads."""
+
+    def __init__(
+        self,
+        runner: Callable[[Job, ProgressCallback], List[str]],
+        num_workers: int = 1,
+        max_queued: int = 8,
+        ttl_seconds: float = 3600.0,
+        memory_budget: Optional[MemoryBudget] = None,
+        short_reserved: int = SHORT_LANE_RESERVED,
+        short_burst: int = SHORT_LANE_BURST,
+    ):
+        self._runner = runner
+        self._num_workers = max(1, num_workers)
+        self._max_queued = max(1, max_queued)
+        # Long clips leave these slots to short ones (at least one slot stays theirs)
+        self._max_long = max(1, self._max_queued - short_reserved)
+        self._short_burst = short_burst
+        self._ttl_seconds = ttl_seconds
+        self.memory_budget = memory_budget or MemoryBudget()
+        self.service_time = ServiceTimeEstimator()
+        self._jobs: Dict[str, Job] = {}
+        # Guards the lanes and the running set; workers wait on it for admissible jobs
+        self._lock = threading.Condition()
+        self._short: Deque[Job] = deque()
+        self._long: Deque[Job] = deque()
+        self._running: Dict[str, Job] = {}
+        self._running_bytes = 0
+        self._short_streak = 0
+        self._stopping = False
+        self._workers: List[threading.Thread] = []
+        self._reap_interval = max(0.1, min(JOB_REAP_INTERVAL_SECONDS, ttl_seconds))
+
+    @property
+    def depth(self) -> int:
+        return len(self._short) + len(self._long)
+
+    @property
+    def num_workers(self) -> int:
+        return self._num_workers
+
+    @property
+    def running(self) -> int:
+        return len(self._running)
+
+    def start(self) -> None:
+        if self._workers:
+            return
+        self._stopping = False
+        for index in range(self._num_workers):
+            worker = threading.Thread(
+                target=self._worker_loop, name=f"separation-worker-{index}", daemon=True
+            )
+            worker.start()
+            self._workers.append(worker)
+        # Expired jobs are also dropped while no uploads come in
+        reaper = threading.Thread(target=self._reaper_loop, name="job-reaper", daemon=True)
+        reaper.start()
+        self._workers.append(reaper)
+
+    def stop(self, timeout: float = 5.0) -> None:
+        with self._lock:
+            self._stopping = True
+            self._lock.notify_all()
+        for worker in self._workers:
+            worker.join(timeout=timeout)
+        self._workers = []
+
+    def new_job(self, filename: str, options: Optional[Dict[str, Any]] = None) -> Job:
+        """Create a job with its own work directory; the caller writes the input there."""
+        job_id = uuid.uuid4().hex
+        work_dir = os.path.join(_jobs_root(), job_id)
+        os.makedirs(work_dir, exist_ok=True)
+        safe_name = os.path.basename(filename) or "input"
+        # Keep the original extension so ffmpeg can sniff the container
+        extension = os.path.splitext(safe_name)[1]
+        return Job(
+            id=job_id,
+            work_dir=work_dir,
+            input_path=os.path.join(work_dir, f"input{extension}"),
+            filename=safe_name,
+            options=dict(options or {}),
+        )
+
+    def ensure_capacity(self) -> None:
+        """
+        Refuse early, before an upload is read, when no lane has room.
+
+        Raises:
+            JobQueueFull: When the queue is full for short clips too
+        """
+        with self._lock:
+            if self.depth >= self._max_queued:
+                JOBS_SHED.labels("queue_full").inc()
+                raise JobQueueFull("Separation queue is full, try again later", self._slot_wait_locked())
+
+    def submit(self, job: Job, max_wait: Optional[float] = None) -> Job:
+        """
+        Queue a job in its lane.
+
+        Args:
+            job: A job from ``new_job`` with its input written and ``cost`` set
+            max_wait: Refuse the job if its estimated wait is longer, and drop
+                it if it is still queued after that long
+
+        Raises:
+            JobQueueFull: When the job's lane is full
+            JobWaitTooLong: When the estimated wait exceeds ``max_wait``
+        """
+        self._reap_expired()
+        try:
+            with self._lock:
+                if self.depth >= self._max_queued or (not job.short and len(self._long) >= self._max_long):
+                    JOBS_SHED.labels("queue_full").inc()
+                    raise JobQueueFull("Separation queue is full, try again later", self._slot_wait_locked())
+                if max_wait is not None:
+                    wait = self._estimated_wait_locked(job)
+                    if wait > max_wait:
+                        JOBS_SHED.labels("wait_too_long").inc()
+                        raise JobWaitTooLong(
+                            f"Estimated wait of {wait:.0f}s exceeds {max_wait:.0f}s, try again later",
+                            wait - max_wait,
+                        )
+                    job.deadline = time.time() + max_wait
+                self._jobs[job.id] = job
+                (self._short if job.short else self._long).append(job)
+                self._lock.notify_all()
+        except JobQueueFull:
+            shutil.rmtree(job.work_dir, ignore_errors=True)
+            raise
+        return job
+
+    def discard(self, job: Job) -> None:
+        """Remove the work directory of a job that was created but never submitted."""
+        shutil.rmtree(job.work_dir, ignore_errors=True)
+
+    def remove(self, job: Job) -> None:
+        """Forget a finished job and delete its work directory, e.g. once its result was delivered."""
+        with self._lock:
+            self._jobs.pop(job.id, None)
+        shutil.rmtree(job.work_dir, ignore_errors=True)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def estimated_wait(self, job: Job) -> float:
+        """Seconds until ``job`` (queued or not) would start, by the current estimates."""
+        with self._lock:
+            return self._estimated_wait_locked(job)
+
+    def _job_seconds(self, job: Job) -> float:
+        return self.service_time.seconds(job.cost.work) if job.cost is not None else 0.0
+
+    def _remaining_seconds_locked(self) -> List[float]:
+        now = time.time()
+        return [max(0.0, self._job_seconds(job) - (now - (job.started_at or now))) for job in self._running.values()]
+
+    def _slot_wait_locked(self) -> float:
+        # A queue slot frees up when the next running job finishes and a queued one starts
+        return min(self._remaining_seconds_locked(), default=0.0)
+
+    def _estimated_wait_locked(self, job: Job) -> float:
+        # Work ahead of the job: the rest of the running jobs and the queued ones it does not overtake
+        ahead = list(self._short) if job.short else [*self._short, *self._long]
+        work = sum(self._remaining_seconds_locked()) + sum(self._job_seconds(other) for other in ahead if other is not job)
+        return work / max(1, len(self._running))
+
+    def _fits_locked(self, job: Job) -> bool:
+        budget = self.memory_budget.bytes
+        # One job always runs, whatever its estimate
+        return not self._running or budget is None or self._running_bytes + job.memory_bytes <= budget
+
+    def _next_job_locked(self) -> Optional[Job]:
+        """Pop the next job that may start now, short lane first, or None."""
+        lanes = [self._short, self._long]
+        if self._long and self._short_streak >= self._short_burst:
+            lanes.reverse()
+        for lane in lanes:
+            if lane and self._fits_locked(lane[0]):
+                job = lane.popleft()
+                self._short_streak = self._short_streak + 1 if lane is self._short else 0
+                return job
+        return None
+
+    def _worker_loop(self) -> None:
+        while True:
+            with self._lock:
+                job = None
+                while not self._stopping:
+                    job = self._next_job_locked()
+                    if job is not None:
+                        break
+                    self._lock.wait()
+                if job is None:
+                    return
+                if not self._running:
+                    # The memory the idle process holds (runtime, resident models) is not for jobs
+                    self.memory_budget.observe_idle()
+                expired = job.deadline is not None and time.time() > job.deadline
+                if not expired:
+                    job.status = JOB_RUNNING
+                    job.started_at = time.time()
+                    self._running[job.id] = job
+                    self._running_bytes += job.memory_bytes
+            if expired:
+                # Its client has timed out; running it would only delay the jobs behind it
+                JOBS_SHED.labels("expired").inc()
+                self._fail(job, JobExpired("Job expired in the queue before it could start"))
+                continue
+            try:
+                self._run(job)
+            finally:
+                with self._lock:
+                    self._running.pop(job.id, None)
+                    self._running_bytes -= job.memory_bytes
+                    self._lock.notify_all()
+
+    def _run(self, job: Job) -> None:
+        def report_progress(
+            fraction: float, stage: str, segments: Optional[Tuple[int, int]] = None, eta_seconds: Optional[float] = None
+        ) -> None:
+            job.progress = min(1.0, max(job.progress, fraction))
+            job.stage = stage
+            if segments is not None:
+                job.segments_done, job.segments_total = segments
+            job.eta_seconds = eta_seconds
+
+        try:
+            job.result_paths = self._runner(job, report_progress)
+        except Exception as exc:
+            logger.exception("Job %s failed", job.id)
+            self._fail(job, exc)
+            return
+        job.progress = 1.0
+        job.eta_seconds = None
+        job.stage = "done"
+        job.status = JOB_DONE
+        job.finished_at = time.time()
+        # Cache hits say nothing about how long a separation takes
+        if job.cost is not None and ("inference" in job.timings or "stream_separate" in job.timings):
+            self.service_time.observe(job.cost.work, job.finished_at - job.started_at)
+        job.future.set_result(job.result_paths)
+
+    def _fail(self, job: Job, exc: Exception) -> None:
+        job.error = str(exc)
+        job.eta_seconds = None
+        job.stage = "failed"
+        job.status = JOB_FAILED
+        job.finished_at = time.time()
+        job.future.set_exception(exc)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            budget = self.memory_budget.bytes
+            return {
+                "queued_short": len(self._short),
+                "queued_long": len(self._long),
+                "running": len(self._running),
+                "reserved_mb": round(self._running_bytes / (1024 * 1024), 1),
+                "memory_budget_mb": round(budget / (1024 * 1024), 1) if budget is not None else None,
+                "seconds_per_unit": round(self.service_time.seconds_per_unit, 3),
+            }
+
+    def _reaper_loop(self) -> None:
+        while True:
+            with self._lock:
+                if not self._stopping:
+                    self._lock.wait(self._reap_interval)
+                if self._stopping:
+                    return
+            self._reap_expired()
+
+    def _reap_expired(self) -> None:
+        now = time.time()
+        with self._lock:
+            expired = [
+                job for job in self._jobs.values()
+                if job.finished and job.finished_at is not None
+                and now - job.finished_at > self._ttl_seconds
+            ]
+            for job in expired:
+                del self._jobs[job.id]
+        for job in expired:
+            shutil.rmtree(job.work_dir, ignore_errors=True)
+
+
+def _jobs_root() -> str:
+    root = os.environ.get("JOB_DIR") or os.path.join(tempfile.gettempdir(), "riffraff-jobs")
+    os.makedirs(root, exist_ok=True)
+    return root
@@ -0,0 +1,296 @@
+"""
+Separation pipeline of the stem backend.
+
+Everything that needs torch, torchaudio or demucs lives here, so importing
+``app`` stays cheap and the server answers liveness checks within a second
+of starting. ``app`` imports this module on a background thread at startup
+(or on the first job, whichever comes first).
+"""
+
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+from audio_encoding import OUTPUT_DITHER, output_format_for, write_stems
+from audio_processing import decode_audio, denormalize_, normalize_, stem_samples
+from demucs_config import DemucsConfig
+from batching import MicroBatcher
+from inference_modes import inference_mode_label
+from jobs import Job, ProgressCallback
+from model_registry import MAX_LOADED_MODELS, ModelRegistry
+from parallel_apply import (
+    INFERENCE_PROCESSES,
+    ProcessSegmentPool,
+    SegmentProgress,
+    count_segments,
+    parallel_apply_model,
+)
+from silence import SilenceDetector, Span, detect_spans, separate_spans, silence_settings
+from stem_cache import CacheKeyBuilder, get_stem_cache
+from streaming_separation import (
+    DEFAULT_BLOCK_SECONDS,
+    STREAMING_SEPARATION,
+    iter_audio_blocks,
+    scan_stream,
+    separate_stream,
+)
+from telemetry import MODEL_LOAD_SECONDS, RequestTrace
+
+TARGET_SAMPLE_RATE = 44100
+TARGET_NUM_CHANNELS = 2
+MAX_DURATION_SECONDS = int(os.environ.get("MAX_DURATION_SECONDS", "15"))
+
+# Segments from concurrent jobs are stacked into one forward pass
+BATCH_INFERENCE = os.environ.get("BATCH_INFERENCE", "true").lower() == "true"
+BATCH_MAX_SIZE = max(1, int(os.environ.get("BATCH_MAX_SIZE", "4")))
+BATCH_MAX_WAIT_MS = float(os.environ.get("BATCH_MAX_WAIT_MS", "20"))
+
+inference_device = "cuda" if torch.cuda.is_available() else "cpu"
+try:
+    torch.set_num_threads(max(1, int(os.environ.get("TORCH_NUM_THREADS", "1"))))
+except Exception:
+    pass
+
+
+# Segments either run in forked worker processes (INFERENCE_PROCESSES > 0, CPU
+# only) or are micro-batched in this process; shift passes run concurrently
+# either way.
+inference_processes = (
+    ProcessSegmentPool(INFERENCE_PROCESSES, max_models=MAX_LOADED_MODELS)
+    if INFERENCE_PROCESSES and inference_device == "cpu" else None
+)
+inference_batcher = (
+    MicroBatcher(BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS) if BATCH_INFERENCE and inference_processes is None else None
+)
+inference_pool = inference_processes or inference_batcher
+
+
+model_registry = ModelRegistry(
+    device=inference_device,
+    on_load=lambda name, seconds: MODEL_LOAD_SECONDS.labels(name).observe(seconds),
+    # Forked workers of an evicted model would otherwise keep running
+    on_evict=inference_processes.release if inference_processes is not None else None,
+)
+
+
+def start() -> None:
+    if inference_batcher is not None:
+        inference_batcher.start()
+
+
+def stop() -> None:
+    if inference_batcher is not None:
+        inference_batcher.stop()
+    if inference_processes is not None:
+        inference_processes.stop()
+
+
+def stats() -> dict:
+    return {
+        "device": inference_device,
+        "batching": inference_batcher.stats() if inference_batcher is not None else None,
+        "processes": inference_processes.stats() if inference_processes is not None else None,
+        "models": model_registry.stats(),
+    }
+
+
+def load_demucs_model(
+    model_name: str, segment_seconds: Optional[float] = None, sources: Optional[List[str]] = None
+):
+    return model_registry.get(model_name, segment_seconds, sources)
+
+
+def _tensor_dtype(use_float32: bool) -> torch.dtype:
+    # Half precision only pays off (and only works) with CUDA kernels
+    return torch.float16 if not use_float32 and inference_device == "cuda" else torch.float32
+
+
+def _decode_upload(input_path: str) -> Tuple[np.ndarray, List[Span]]:
+    """Decode an upload to capped [channels, samples] float32 at the target rate, with its audible spans."""
+    # WAV/FLAC are read in-process, compressed formats through ffmpeg
+    audio = decode_audio(input_path, TARGET_SAMPLE_RATE, TARGET_NUM_CHANNELS)
+
+    # Cap duration to reduce CPU/RAM usage on small instances; silence does not count
+    spans, end = detect_spans(audio, TARGET_SAMPLE_RATE, TARGET_SAMPLE_RATE * MAX_DURATION_SECONDS)
+    return audio[:, :end], spans
+
+
+def _streaming(options: dict) -> bool:
+    """Whether a job runs the streaming engine, which also writes the stems its previews are read from."""
+    return STREAMING_SEPARATION or options.get("preview", False)
+
+
+def _segment_progress(report_progress: ProgressCallback) -> SegmentProgress:
+    """Finished model segments, reported as the 0.1-0.9 stretch of the job's progress."""
+    return SegmentProgress(
+        lambda done, total, eta_seconds: report_progress(
+            0.1 + 0.8 * done / max(1, total), "separating", segments=(done, total), eta_seconds=eta_seconds
+        )
+    )
+
+
+def _cache_keys(key_builder: CacheKeyBuilder, options: dict) -> List[str]:
+    """
+    Cache keys a job's stems may be stored under, most complete first.
+
+    A stem subset is also served from a cached separation of every stem.
+    """
+    settings = _separation_settings(options)
+    keys = [key_builder.finish(TARGET_SAMPLE_RATE, **settings)]
+    if options["stems"]:
+        keys.append(key_builder.finish(TARGET_SAMPLE_RATE, stems=",".join(options["stems"]), **settings))
+    return keys
+
+
+def _separation_settings(options: dict) -> dict:
+    """Every setting that changes the separated output, used for cache keys."""
+    return {
+        "model": options["model"],
+        "overlap": options["overlap"],
+        "shifts": options["shifts"],
+        "segment_length": DemucsConfig.effective_segment_length(options["model"], options["segment_length"]),
+        "use_float32": options["use_float32"],
+        "output_format": output_format_for(options["use_float32"]),
+        "container": options["container"],
+        "dither": OUTPUT_DITHER,
+        "max_duration_seconds": MAX_DURATION_SECONDS,
+        "streaming": _streaming(options),
+        "silence": silence_settings(),
+        "inference_mode": inference_mode_label(inference_device),
+    }
+
+
+def _separate_to_dir(
+    audio: np.ndarray,
+    spans: List[Span],
+    stems_dir: str,
+    options: dict,
+    report_progress: ProgressCallback,
+    trace: RequestTrace,
+) -> Dict[str, str]:
+    """Run Demucs on decoded audio and write one stem file per source into ``stems_dir``."""
+    with trace.span("model_load"):
+        model = load_demucs_model(options["model"], options["segment_length"], options["stems"])
+
+    with trace.span("normalize"):
+        # RMS normalization in place on the decoded buffer; the gain undoes it after inference
+        mix = torch.from_numpy(audio)
+        gain = normalize_(mix)
+        audio_tensor = mix.to(device=inference_device, dtype=_tensor_dtype(options["use_float32"]))
+        audio_tensor = audio_tensor.unsqueeze(0)  # [batch=1, channels, samples]
+
+    source_names = getattr(model, "sources", ["drums", "bass", "other", "vocals"])  # type: ignore[attr-defined]
+
+    progress = _segment_progress(report_progress)
+    progress.add_total(sum(count_segments(model, end - start, options["shifts"], options["overlap"]) for start, end in spans))
+    with trace.span("inference"), torch.no_grad():
+        # Output shape: [sources, channels, samples]; only audible spans go through the model
+        separated_sources = separate_spans(
+            lambda mix: parallel_apply_model(
+                model,
+                mix,
+                split=True,  # chunked inference to reduce memory
+                overlap=options["overlap"],
+                shifts=options["shifts"],
+                device=inference_device,
+                pool=inference_pool,  # None runs segments and shifts one by one
+                progress=progress,
+            ),
+            audio_tensor,
+            spans,
+            len(source_names),
+        )[0]
+
+    report_progress(0.9, "encoding")
+    stems = {}
+    for source_index, source_name in enumerate(source_names):
+        if options["stems"] and source_name not in options["stems"]:
+            continue
+        with trace.span("postprocess"):
+            # De-normalize and soft-clip in the output tensor itself
+            stems[source_name] = stem_samples(denormalize_(separated_sources[source_index], gain))
+
+    with trace.span("encode"):
+        # Stems are encoded in parallel; compressed containers dominate this stage
+        return write_stems(
+            stems,
+            stems_dir,
+            TARGET_SAMPLE_RATE,
+            output_format_for(options["use_float32"]),
+            options["container"],
+            dither=OUTPUT_DITHER,
+        )
+
+
+def separate_job(job: Job, report_progress: ProgressCallback, trace: RequestTrace) -> List[str]:
+    """Separate ``job.input_path`` into stem files inside the job directory."""
+    options = job.options
+    report_progress(0.05, "decoding")
+    stems_dir = job.stems_dir
+    streaming = _streaming(options)
+    max_samples = TARGET_SAMPLE_RATE * MAX_DURATION_SECONDS
+
+    if streaming:
+        # Decode twice in blocks instead of holding the whole track in memory
+        block_frames = int(TARGET_SAMPLE_RATE * DEFAULT_BLOCK_SECONDS)
+
+        def open_blocks():
+            return iter_audio_blocks(job.input_path, TARGET_SAMPLE_RATE, TARGET_NUM_CHANNELS, block_frames)
+
+        with trace.span("scan"):
+            # The cap counts audible samples only
+            stats = scan_stream(open_blocks, max_samples, SilenceDetector(TARGET_SAMPLE_RATE))
+            cache_keys = _cache_keys(stats.key_builder, options)
+    else:
+        with trace.span("decode"):
+            audio, spans = _decode_upload(job.input_path)
+        with trace.span("cache_key"):
+            key_builder = CacheKeyBuilder()
+            key_builder.update(audio)
+            cache_keys = _cache_keys(key_builder, options)
+
+    cache = get_stem_cache()
+    with trace.span("cache_lookup"):
+        stems = cache.get_first(cache_keys, stems_dir) if cache is not None else None
+    if stems is not None and options["stems"]:
+        stems = {name: path for name, path in stems.items() if name in options["stems"]}
+    if stems is None:
+        if streaming:
+            with trace.span("model_load"):
+                model = load_demucs_model(options["model"], options["segment_length"], options["stems"])
+            report_progress(0.1, "separating")
+            # Decode, inference and encoding interleave segment by segment
+            with trace.span("stream_separate"):
+                stems = separate_stream(
+                    model,
+                    open_blocks,
+                    stats,
+                    stems_dir,
+                    overlap=options["overlap"],
+                    shifts=options["shifts"],
+                    device=inference_device,
+                    tensor_dtype=_tensor_dtype(options["use_float32"]),
+                    sample_format=output_format_for(options["use_float32"]),
+                    dither=OUTPUT_DITHER,
+                    pool=inference_pool,
+                    progress=_segment_progress(report_progress),
+                    sources=options["stems"],
+                    container=options["container"],
+                )
+        else:
+            stems = _separate_to_dir(audio, spans, stems_dir, options, report_progress, trace)
+        if cache is not None:
+            with trace.span("cache_store"):
+                # A subset goes under its own key, a full separation under the shared one
+                cache.put(cache_keys[-1], stems)
+    saved_paths = list(stems.values())
+
+    # The upload is no longer needed once the stems exist
+    try:
+        os.unlink(job.input_path)
+    except OSError:
+        pass
+
+    return saved_paths
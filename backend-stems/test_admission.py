@@ -0,0 +1,34 @@
+import numpy as np
+import soundfile as sf
+
+from admission import estimate_cost
+
+OPTIONS = {"model": "htdemucs", "shifts": 1, "stems": None}
+
+
+def _write_clip(path, audible_seconds, silent_seconds, sample_rate=44100):
+    audio = np.zeros((int((audible_seconds + silent_seconds) * sample_rate), 2), dtype="float32")
+    audio[: int(audible_seconds * sample_rate)] = 0.5
+    sf.write(str(path), audio, sample_rate, subtype="PCM_16")
+    return str(path)
+
+
+def test_memory_follows_the_uncapped_duration(tmp_path):
+    short = estimate_cost(_write_clip(tmp_path / "short.wav", 10, 0), OPTIONS, max_seconds=10)
+    padded = estimate_cost(_write_clip(tmp_path / "padded.wav", 10, 50), OPTIONS, max_seconds=10)
+
+    # Silence is free for the duration cap, not for the buffers that hold it
+    assert padded.audio_seconds == short.audio_seconds == 10
+    assert padded.work == short.work
+    assert padded.memory_bytes > short.memory_bytes
+
+
+def test_held_duration_is_bounded(tmp_path):
+    path = _write_clip(tmp_path / "long.wav", 1, 59)
+
+    bounded = estimate_cost(path, OPTIONS, max_seconds=10, max_held_seconds=20)
+    unbounded = estimate_cost(path, OPTIONS, max_seconds=10, max_held_seconds=60)
+    at_bound = estimate_cost(_write_clip(tmp_path / "bound.wav", 1, 19), OPTIONS, max_seconds=10)
+
+    assert bounded.memory_bytes < unbounded.memory_bytes
+    assert bounded.memory_bytes == at_bound.memory_bytes
@@ -0,0 +1,46 @@
+import io
+import os
+import struct
+import zipfile
+import zlib
+
+from zip_stream import iter_zip, open_entries
+
+
+def _write(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+    return str(path)
+
+
+def test_stored_entries_have_no_data_descriptor(tmp_path):
+    stems = {
+        "vocals.wav": os.urandom(300 * 1024),
+        "drums.wav": b"",
+        "bass.flac": os.urandom(1000),
+    }
+    paths = [_write(tmp_path / name, data) for name, data in stems.items()]
+
+    archive = b"".join(iter_zip(open_entries(paths), chunk_bytes=64 * 1024))
+
+    with zipfile.ZipFile(io.BytesIO(archive)) as zf:
+        assert zf.testzip() is None
+        infos = zf.infolist()
+        assert [info.filename for info in infos] == list(stems)
+        for info in infos:
+            assert info.flag_bits & 0x08 == 0
+            assert info.compress_type == zipfile.ZIP_STORED
+            assert zf.read(info) == stems[info.filename]
+
+
+def test_local_headers_carry_crc_and_size(tmp_path):
+    data = os.urandom(5000)
+    path = _write(tmp_path / "other.wav", data)
+
+    archive = b"".join(iter_zip(open_entries([path])))
+
+    # A streaming extractor only sees the local header, so it must be complete
+    assert archive[:4] == b"PK\x03\x04"
+    crc, compressed_size, size = struct.unpack("<3L", archive[14:26])
+    assert crc == zlib.crc32(data)
+    assert compressed_size == size == len(data)
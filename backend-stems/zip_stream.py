@@ -0,0 +1,147 @@
+"""
+ZIP archives written on the fly for streaming responses.
+
+Stems are stored, not deflated: PCM audio shrinks by a few percent at best,
+while DEFLATE costs more CPU than encoding the WAVs did. The stem files are
+on disk already, so each one's CRC and size are computed before its local
+header is written. That keeps every header complete, without the data
+descriptors that ``zipfile`` uses on unseekable output, which several
+extractors (java.util.zip's ZipInputStream, some macOS and browser
+unzippers) refuse on stored entries. Bytes are handed to the client as they
+are read; no archive is ever assembled on disk or in memory.
+"""
+
+import os
+import struct
+import time
+import zipfile
+import zlib
+from typing import BinaryIO, Iterator, List, Tuple
+
+CHUNK_BYTES = 256 * 1024
+
+# Offsets and sizes past this need ZIP64 records, which stems never do
+_ZIP32_LIMIT = 0xFFFFFFFF
+_UTF8_FLAG = 0x800
+
+
+def open_entries(paths: List[str]) -> List[Tuple[str, BinaryIO]]:
+    """
+    Open files for ``iter_zip``, named by their basename.
+
+    Opening everything up front keeps the data readable even if the files are
+    deleted (job expiry, cache eviction) while the response is streaming.
+    """
+    entries = []
+    try:
+        for path in paths:
+            entries.append((os.path.basename(path), open(path, "rb")))
+    except BaseException:
+        for _, source in entries:
+            source.close()
+        raise
+    return entries
+
+
+def _stored_info(arcname: str, source: BinaryIO, chunk_bytes: int) -> zipfile.ZipInfo:
+    """ZipInfo of a stored entry with its CRC and size, read from ``source`` (rewound after)."""
+    info = zipfile.ZipInfo(arcname, time.localtime(time.time())[:6])
+    info.compress_type = zipfile.ZIP_STORED
+    info.external_attr = 0o644 << 16
+    crc = 0
+    size = 0
+    while True:
+        chunk = source.read(chunk_bytes)
+        if not chunk:
+            break
+        crc = zlib.crc32(chunk, crc)
+        size += len(chunk)
+    source.seek(0)
+    if size > _ZIP32_LIMIT:
+        raise ValueError(f"{arcname} is too large for a ZIP32 archive")
+    info.CRC = crc
+    info.file_size = info.compress_size = size
+    return info
+
+
+def _central_directory_entry(info: zipfile.ZipInfo) -> bytes:
+    name = info.filename.encode("utf-8")
+    flag_bits = info.flag_bits | (_UTF8_FLAG if not info.filename.isascii() else 0)
+    year, month, day, hour, minute, second = info.date_time
+    dos_time = hour << 11 | minute << 5 | second // 2
+    dos_date = (year - 1980) << 9 | month << 5 | day
+    header = struct.pack(
+        zipfile.structCentralDir,
+        zipfile.stringCentralDir,
+        info.create_version,
+        info.create_system,
+        info.extract_version,
+        info.reserved,
+        flag_bits,
+        info.compress_type,
+        dos_time,
+        dos_date,
+        info.CRC,
+        info.compress_size,
+        info.file_size,
+        len(name),
+        0,  # extra field
+        0,  # comment
+        0,  # disk number
+        info.internal_attr,
+        info.external_attr,
+        info.header_offset,
+    )
+    return header + name
+
+
+def iter_zip(entries: List[Tuple[str, BinaryIO]], chunk_bytes: int = CHUNK_BYTES) -> Iterator[bytes]:
+    """
+    Yield a ZIP_STORED archive of ``entries`` chunk by chunk.
+
+    Every local header carries the entry's CRC and size (no data descriptors).
+
+    Args:
+        entries: (name in archive, readable and seekable binary file) pairs; closed when done
+        chunk_bytes: Read size per step
+
+    Yields:
+        Consecutive pieces of the archive
+
+    Raises:
+        ValueError: For an archive that would need ZIP64 records
+    """
+    try:
+        infos = []
+        offset = 0
+        for arcname, source in entries:
+            info = _stored_info(arcname, source, chunk_bytes)
+            info.header_offset = offset
+            local_header = info.FileHeader(zip64=False)
+            yield local_header
+            while True:
+                chunk = source.read(chunk_bytes)
+                if not chunk:
+                    break
+                yield chunk
+            offset += len(local_header) + info.file_size
+            infos.append(info)
+
+        central_directory = b"".join(_central_directory_entry(info) for info in infos)
+        if offset + len(central_directory) > _ZIP32_LIMIT:
+            raise ValueError("Archive is too large for ZIP32")
+        end_record = struct.pack(
+            zipfile.structEndArchive,
+            zipfile.stringEndArchive,
+            0,  # this disk
+            0,  # disk with the central directory
+            len(infos),
+            len(infos),
+            len(central_directory),
+            offset,
+            0,  # comment
+        )
+        yield central_directory + end_record
+    finally:
+        for _, source in entries:
+            source.close()
@@ -0,0 +1,374 @@
+"""
+Offline batch separation of whole music libraries.
+
+Separates every audio file under a directory (or listed in a manifest, one
+path per line) with the same model registry, inference modes, silence
+skipping and stem encoding as the apps, without their duration cap:
+
+    python batch_separate.py ~/music --out ~/stems --format flac
+    python batch_separate.py --manifest tracks.txt --out stems --workers 4 --threads 2
+
+Tracks are spread over ``--workers`` processes (default: one per
+``--threads`` cores). Inside each worker decoding, inference and encoding
+run as a pipeline of three stages joined by bounded queues, so the next
+track is decoded and the previous one encoded while the model is busy.
+
+Every finished track is appended to ``<out>/progress.jsonl``; a rerun skips
+the tracks recorded there as done, so an interrupted batch resumes where it
+stopped. Stems are written to ``<out>/<track>/`` through a temporary
+directory, so a crash never leaves a half-written track that looks done.
+A throughput summary is printed at the end.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+import traceback
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+TARGET_SAMPLE_RATE = 44100
+TARGET_NUM_CHANNELS = 2
+AUDIO_EXTENSIONS = (".wav", ".flac", ".mp3", ".ogg", ".opus", ".m4a", ".aac", ".aif", ".aiff", ".wma")
+PROGRESS_FILE = "progress.jsonl"
+
+_STOP = None
+
+
+def find_tracks(root: str) -> List[str]:
+    """Audio files under ``root``, sorted, by extension."""
+    tracks = []
+    for directory, _, files in os.walk(root):
+        for name in files:
+            if name.lower().endswith(AUDIO_EXTENSIONS):
+                tracks.append(os.path.join(directory, name))
+    return sorted(tracks)
+
+
+def read_manifest(path: str) -> List[str]:
+    """Track paths from a manifest: one per line, relative to the manifest, ``#`` starts a comment."""
+    base = os.path.dirname(os.path.abspath(path))
+    tracks = []
+    with open(path) as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                tracks.append(os.path.normpath(os.path.join(base, os.path.expanduser(line))))
+    return tracks
+
+
+def track_name(path: str, root: Optional[str]) -> str:
+    """Output directory name of a track: its path below ``root`` without the extension."""
+    relative = os.path.relpath(path, root) if root else os.path.basename(path)
+    if relative.startswith(".."):
+        relative = os.path.basename(path)
+    return os.path.splitext(relative)[0]
+
+
+def load_progress(path: str) -> Dict[str, Dict[str, Any]]:
+    """Latest progress record per input path; a torn last line (crash mid-write) is ignored."""
+    records: Dict[str, Dict[str, Any]] = {}
+    if not os.path.exists(path):
+        return records
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            records[record["input"]] = record
+    return records
+
+
+def decode_track(path: str) -> np.ndarray:
+    """Decode a file to [channels, samples] float32 at the target rate."""
+    from audio_processing import decode_audio
+
+    return decode_audio(path, TARGET_SAMPLE_RATE, TARGET_NUM_CHANNELS)
+
+
+def _worker(worker_index: int, options: Dict[str, Any], tasks, results) -> None:
+    """Worker process: decode -> infer -> encode pipeline over tasks until a stop marker."""
+    import torch
+
+    from audio_encoding import OUTPUT_DITHER, output_format_for, write_stems
+    from audio_processing import denormalize_, normalize_, stem_samples
+    from model_registry import ModelRegistry
+    from parallel_apply import parallel_apply_model
+    from silence import detect_spans, separate_spans
+
+    torch.set_num_threads(options["threads"])
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    registry = ModelRegistry(device=device)
+    model = registry.get(options["model_name"], options["segment_length"], options["stems"])
+    source_names = list(model.sources)
+    sample_format = output_format_for(options["use_float32"])
+    decoded: "queue.Queue" = queue.Queue(maxsize=options["prefetch"])
+    separated: "queue.Queue" = queue.Queue(maxsize=options["prefetch"])
+
+    def fail(task: Dict[str, Any], stage: str) -> None:
+        results.put({**task, "status": "failed", "worker": worker_index, "error": f"{stage}: {traceback.format_exc(limit=3)}"})
+
+    def decode_stage() -> None:
+        while True:
+            task = tasks.get()
+            if task is _STOP:
+                decoded.put(_STOP)
+                return
+            start = time.perf_counter()
+            try:
+                audio = decode_track(task["input"])
+                spans, _ = detect_spans(audio, TARGET_SAMPLE_RATE)
+            except Exception:
+                fail(task, "decode")
+                continue
+            decoded.put((task, audio, spans, {"decode": time.perf_counter() - start}))
+
+    def encode_stage() -> None:
+        while True:
+            item = separated.get()
+            if item is _STOP:
+                return
+            task, stems, timings = item
+            start = time.perf_counter()
+            final_dir = os.path.join(options["out"], task["name"])
+            partial_dir = f"{final_dir}.partial-{os.getpid()}"
+            try:
+                shutil.rmtree(partial_dir, ignore_errors=True)
+                paths = write_stems(
+                    stems, partial_dir, TARGET_SAMPLE_RATE, sample_format, options["container"], dither=OUTPUT_DITHER
+                )
+                shutil.rmtree(final_dir, ignore_errors=True)
+                os.replace(partial_dir, final_dir)
+            except Exception:
+                shutil.rmtree(partial_dir, ignore_errors=True)
+                fail(task, "encode")
+                continue
+            timings["encode"] = time.perf_counter() - start
+            results.put({
+                **task,
+                "status": "done",
+                "worker": worker_index,
+                "stems": [os.path.join(final_dir, os.path.basename(path)) for path in paths.values()],
+                "audio_seconds": task["audio_seconds"],
+                "timings": {stage: round(seconds, 3) for stage, seconds in timings.items()},
+            })
+
+    decoder = threading.Thread(target=decode_stage, name="decode", daemon=True)
+    encoder = threading.Thread(target=encode_stage, name="encode", daemon=True)
+    decoder.start()
+    encoder.start()
+
+    # Inference runs on this thread; it is the stage the other two keep fed
+    while True:
+        item = decoded.get()
+        if item is _STOP:
+            break
+        task, audio, spans, timings = item
+        task = {**task, "audio_seconds": round(audio.shape[1] / TARGET_SAMPLE_RATE, 3)}
+        start = time.perf_counter()
+        try:
+            # Same in-place RMS normalization and soft clipping as the apps
+            mix = torch.from_numpy(audio)
+            gain = normalize_(mix)
+            mix = mix.to(device=device).unsqueeze(0)
+            with torch.no_grad():
+                sources = separate_spans(
+                    lambda segment: parallel_apply_model(
+                        model, segment, split=True, overlap=options["overlap"], shifts=options["shifts"], device=device
+                    ),
+                    mix,
+                    spans,
+                    len(source_names),
+                )[0]
+            stems = {
+                source_name: stem_samples(denormalize_(sources[source_index], gain))
+                for source_index, source_name in enumerate(source_names)
+                if not options["stems"] or source_name in options["stems"]
+            }
+        except Exception:
+            fail(task, "separate")
+            continue
+        timings["separate"] = time.perf_counter() - start
+        separated.put((task, stems, timings))
+
+    separated.put(_STOP)
+    encoder.join()
+
+
+def _default_workers(threads: int) -> int:
+    return max(1, (os.cpu_count() or 1) // max(1, threads))
+
+
+def _format_duration(seconds: float) -> str:
+    hours, rest = divmod(int(seconds), 3600)
+    minutes, secs = divmod(rest, 60)
+    return f"{hours}:{minutes:02d}:{secs:02d}"
+
+
+def run_batch(
+    tracks: List[str],
+    out_dir: str,
+    root: Optional[str],
+    options: Dict[str, Any],
+    workers: int,
+    progress_path: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Separate ``tracks`` into ``out_dir`` with ``workers`` processes.
+
+    Args:
+        tracks: Input files
+        out_dir: Output root; each track gets a directory below it
+        root: Directory track names are taken relative to (None: file names)
+        options: Separation settings (see ``main``)
+        workers: Worker processes
+        progress_path: Progress manifest, default ``<out_dir>/progress.jsonl``
+
+    Returns:
+        Throughput summary
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    progress_path = progress_path or os.path.join(out_dir, PROGRESS_FILE)
+    done = {path for path, record in load_progress(progress_path).items() if record.get("status") == "done"}
+    pending = [path for path in tracks if os.path.abspath(path) not in done]
+    skipped = len(tracks) - len(pending)
+    summary: Dict[str, Any] = {
+        "tracks": len(tracks),
+        "skipped": skipped,
+        "done": 0,
+        "failed": 0,
+        "audio_seconds": 0.0,
+        "stage_seconds": {"decode": 0.0, "separate": 0.0, "encode": 0.0},
+    }
+    print(f"{len(tracks)} tracks, {skipped} already done, {len(pending)} to separate with {workers} workers")
+    if not pending:
+        summary["wall_seconds"] = 0.0
+        return summary
+
+    context = multiprocessing.get_context("spawn")
+    tasks = context.Queue()
+    results = context.Queue()
+    for path in pending:
+        tasks.put({"input": os.path.abspath(path), "name": track_name(path, root)})
+    workers = max(1, min(workers, len(pending)))
+    for _ in range(workers):
+        tasks.put(_STOP)
+    processes = [
+        context.Process(target=_worker, args=(index, {**options, "out": out_dir}, tasks, results), daemon=True)
+        for index in range(workers)
+    ]
+
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+    received = 0
+    with open(progress_path, "a") as progress:
+        while received < len(pending):
+            try:
+                record = results.get(timeout=1.0)
+            except queue.Empty:
+                if not any(process.is_alive() for process in processes):
+                    # Tracks in flight in a crashed worker stay pending for the next run
+                    print(f"All workers exited with {len(pending) - received} tracks unfinished", file=sys.stderr)
+                    break
+                continue
+            received += 1
+            record["finished_at"] = time.time()
+            progress.write(json.dumps(record) + "\n")
+            progress.flush()
+            os.fsync(progress.fileno())
+
+            elapsed = time.perf_counter() - start
+            if record["status"] == "done":
+                summary["done"] += 1
+                summary["audio_seconds"] += record["audio_seconds"]
+                for stage, seconds in record["timings"].items():
+                    summary["stage_seconds"][stage] += seconds
+                print(
+                    f"[{received}/{len(pending)} {_format_duration(elapsed)}] {record['name']} "
+                    f"({record['audio_seconds']:.0f}s audio, separate {record['timings']['separate']:.1f}s)"
+                )
+            else:
+                summary["failed"] += 1
+                print(f"[{received}/{len(pending)} {_format_duration(elapsed)}] FAILED {record['name']}: "
+                      f"{record['error'].strip().splitlines()[-1]}", file=sys.stderr)
+
+    for process in processes:
+        process.join(timeout=5.0)
+        if process.is_alive():
+            process.terminate()
+    summary["wall_seconds"] = time.perf_counter() - start
+    return summary
+
+
+def print_summary(summary: Dict[str, Any]) -> None:
+    wall = summary["wall_seconds"]
+    audio = summary["audio_seconds"]
+    print()
+    print(f"Separated {summary['done']} tracks ({summary['failed']} failed, {summary['skipped']} skipped as done) "
+          f"in {_format_duration(wall)}")
+    if summary["done"] and wall > 0:
+        print(f"  audio:      {_format_duration(audio)} ({audio / wall:.2f}x realtime)")
+        print(f"  throughput: {summary['done'] / wall * 60:.2f} tracks/min")
+        stages = ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in summary["stage_seconds"].items())
+        print(f"  stage time: {stages} (summed over workers)")
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    from audio_encoding import CONTAINERS, OUTPUT_CONTAINER
+    from demucs_config import DemucsConfig
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", nargs="?", help="Directory searched recursively for audio files")
+    parser.add_argument("--manifest", help="File listing one track path per line (instead of a directory)")
+    parser.add_argument("--out", required=True, help="Output directory")
+    parser.add_argument("--quality", default=None, help=f"Quality preset, one of {list(DemucsConfig.QUALITY_PRESETS)}")
+    parser.add_argument("--model", default=None, help="Model preset or Demucs model name")
+    parser.add_argument("--stems", default=None, help="Comma-separated stems to write (default: all)")
+    parser.add_argument("--format", default=OUTPUT_CONTAINER, choices=CONTAINERS, help="Stem container")
+    parser.add_argument("--threads", type=int, default=1, help="Torch threads per worker")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: cores / threads)")
+    parser.add_argument("--prefetch", type=int, default=2, help="Tracks queued between pipeline stages")
+    parser.add_argument("--progress", default=None, help=f"Progress manifest (default: <out>/{PROGRESS_FILE})")
+    args = parser.parse_args(argv)
+
+    if bool(args.input) == bool(args.manifest):
+        parser.error("give either an input directory or --manifest")
+    if args.manifest:
+        tracks, root = read_manifest(args.manifest), os.path.dirname(os.path.abspath(args.manifest))
+    else:
+        tracks, root = find_tracks(args.input), os.path.abspath(args.input)
+
+    try:
+        config = DemucsConfig.for_request(args.quality, args.model, args.stems)
+    except ValueError as exc:
+        parser.error(str(exc))
+    threads = max(1, args.threads)
+    options = {
+        "model_name": config["model_name"],
+        "segment_length": config["segment_length"],
+        "overlap": config["overlap"],
+        "shifts": config["shifts"],
+        "use_float32": config["use_float32"],
+        "stems": config["stems"],
+        "container": args.format,
+        "threads": threads,
+        "prefetch": max(1, args.prefetch),
+    }
+    workers = args.workers or _default_workers(threads)
+    summary = run_batch(tracks, os.path.abspath(args.out), root, options, workers, args.progress)
+    print_summary(summary)
+    if summary["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Micro-benchmark for stem encoding.
+
+Encodes a synthetic stereo stem in every supported format and reports the
+time per stem. ``--legacy`` also times the old per-sample 24-bit loop for
+comparison (slow: seconds per stem).
+
+    python benchmarks/bench_encoding.py --seconds 30 --repeat 5
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from audio_encoding import encode_audio  # noqa: E402
+
+SAMPLE_RATE = 44100
+
+
+def _synthetic_stem(seconds: float) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    num_samples = int(seconds * SAMPLE_RATE)
+    t = np.arange(num_samples, dtype=np.float32) / SAMPLE_RATE
+    tone = 0.5 * np.sin(2 * np.pi * 220.0 * t)
+    noise = 0.05 * rng.standard_normal((num_samples, 2), dtype=np.float32)
+    return np.clip(tone[:, None] + noise, -1.0, 1.0).astype(np.float32)
+
+
+def _legacy_int24(stem: np.ndarray) -> bytes:
+    pcm = (stem * 8388607.0).astype(np.int32)
+    pcm_bytes = []
+    for sample in pcm.flatten():
+        pcm_bytes.extend(int(sample).to_bytes(4, "little", signed=True)[:3])
+    return bytes(pcm_bytes)
+
+
+def _time(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=30.0, help="Stem length in seconds")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per case, the best one is reported")
+    parser.add_argument("--legacy", action="store_true", help="Also time the old per-sample 24-bit loop")
+    args = parser.parse_args()
+
+    stem = _synthetic_stem(args.seconds)
+    cases = [
+        ("wav", "float32", False),
+        ("wav", "int24", False),
+        ("wav", "int24", True),
+        ("wav", "int16", False),
+        ("wav", "int16", True),
+        ("flac", "int24", False),
+        ("flac", "int16", False),
+    ]
+
+    results = []
+    for container, sample_format, dither in cases:
+        try:
+            size = len(encode_audio(stem, SAMPLE_RATE, sample_format, container, dither))
+        except ImportError:
+            continue  # FLAC needs soundfile
+        seconds = _time(lambda: encode_audio(stem, SAMPLE_RATE, sample_format, container, dither), args.repeat)
+        results.append({
+            "case": f"{container}/{sample_format}" + ("+dither" if dither else ""),
+            "ms_per_stem": round(seconds * 1000, 2),
+            "bytes": size,
+        })
+
+    if args.legacy:
+        seconds = _time(lambda: _legacy_int24(stem), 1)
+        results.append({"case": "legacy-loop/int24", "ms_per_stem": round(seconds * 1000, 2), "bytes": stem.size * 3})
+
+    print(json.dumps({"stem_seconds": args.seconds, "channels": 2, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
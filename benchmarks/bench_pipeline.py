@@ -0,0 +1,277 @@
+"""
+Stage-by-stage benchmark of the separation pipeline.
+
+Runs the stages of a separation request over synthetic audio of several
+lengths and prints per-stage latency, throughput (audio seconds per wall
+second) and peak RSS as JSON:
+
+    decode     decode of a WAV upload (in-process soundfile as the apps do, or an ffmpeg subprocess)
+    resample   input rate -> 44.1 kHz (torchaudio, cached kernel)
+    normalize  RMS normalization
+    separate   segment/shift inference for the chosen quality preset
+    softclip   denormalization and soft clipping
+    encode     one file per stem (audio_encoding)
+    zip        streamed stems.zip (backend zip_stream)
+
+By default a seeded stand-in model is used, so the benchmark runs offline
+and results stay comparable across commits; ``--model htdemucs`` (or any
+pretrained name) benchmarks real weights. Every length runs in a fresh
+process so peak RSS is per length.
+
+``--modes`` runs each length once per CPU inference mode (inference_modes)
+and reports every mode's speedup and SDR against fp32; an SDR of null
+means the output matched fp32 exactly. The stand-in model is all
+convolutions, so add ``--standin-linear`` to give int8 something to
+quantize. With ``--compile`` the first run includes compilation, use
+``--repeat 3`` or more so the median does not.
+
+    python benchmarks/bench_pipeline.py --lengths 10,30,60 --quality high
+    python benchmarks/bench_pipeline.py --modes fp32,int8,bf16 --standin-linear
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+import numpy as np
+
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _REPO_ROOT)
+sys.path.insert(0, os.path.join(_REPO_ROOT, "backend-stems"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+TARGET_SAMPLE_RATE = 44100
+# Seeds random and torch before every separate stage
+SHIFT_SEED = 0
+STAGES = ("decode", "resample", "normalize", "separate", "softclip", "encode", "zip")
+
+
+def _synthetic_mix(seconds: float, sample_rate: int) -> np.ndarray:
+    """Deterministic [samples, channels] test signal: tones, a pulse train and noise."""
+    rng = np.random.default_rng(0)
+    num_samples = int(seconds * sample_rate)
+    t = np.arange(num_samples, dtype=np.float32) / sample_rate
+    bass = 0.3 * np.sin(2 * np.pi * 55.0 * t)
+    lead = 0.2 * np.sin(2 * np.pi * 440.0 * t + np.sin(2 * np.pi * 0.5 * t))
+    kick = 0.4 * np.exp(-30.0 * (t % 0.5)) * np.sin(2 * np.pi * 60.0 * t)
+    noise = 0.02 * rng.standard_normal((num_samples, 2), dtype=np.float32)
+    mix = np.stack([bass + lead + kick, bass + 0.8 * lead + kick], axis=1) + noise
+    return np.clip(mix, -1.0, 1.0).astype(np.float32)
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _load_model(args):
+    if args.model == "standin":
+        from inference_modes import prepare_model
+        from standin_model import StandInDemucs
+
+        return prepare_model(StandInDemucs(hidden=args.hidden, linear=args.standin_linear))
+    from model_registry import load_pretrained
+
+    # Applies CPU_INFERENCE_MODE / TORCH_COMPILE like the apps do
+    return load_pretrained(args.model, "cpu")
+
+
+def _sdr_db(reference: np.ndarray, estimate: np.ndarray) -> Optional[float]:
+    """SDR of ``estimate`` against ``reference`` in dB, averaged over sources; None if identical."""
+    values = []
+    for ref, est in zip(reference, estimate):
+        error = np.sum((ref.astype(np.float64) - est) ** 2)
+        if error == 0:
+            continue
+        values.append(10 * np.log10(np.sum(ref.astype(np.float64) ** 2) / error))
+    return round(float(np.mean(values)), 2) if values else None
+
+
+def _run_length(seconds: float, args, mode: str, separated_path: str) -> Dict:
+    """Benchmark one clip length in one inference mode; runs in its own process."""
+    # Read by inference_modes on import
+    os.environ["CPU_INFERENCE_MODE"] = mode
+    os.environ["TORCH_COMPILE"] = args.compile
+
+    import soundfile as sf
+    import torch
+
+    from audio_encoding import output_format_for, write_stem
+    from audio_processing import denormalize_, normalize_, prepare_mix, stem_samples
+    from demucs_config import DemucsConfig
+    from inference_modes import inference_mode_label
+    from model_registry import with_segment
+    from streaming_separation import iter_ffmpeg_blocks
+    from parallel_apply import ProcessSegmentPool, parallel_apply_model
+    from zip_stream import iter_zip, open_entries
+
+    torch.set_num_threads(args.threads)
+    config = DemucsConfig.for_request(args.quality)
+    sample_format = args.sample_format or output_format_for(config["use_float32"])
+    model = with_segment(_load_model(args), config["segment_length"])
+    pool = ProcessSegmentPool(args.workers) if args.workers else None
+
+    timings: Dict[str, List[float]] = {stage: [] for stage in STAGES}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_path = os.path.join(tmp_dir, "input.wav")
+        sf.write(input_path, _synthetic_mix(seconds, args.input_rate), args.input_rate, subtype="PCM_16")
+
+        for run in range(args.repeat):
+            stems_dir = tempfile.mkdtemp(dir=tmp_dir)
+
+            start = time.perf_counter()
+            if args.decoder == "ffmpeg":
+                audio = np.concatenate(list(iter_ffmpeg_blocks(input_path, args.input_rate, 2, args.input_rate)), axis=1)
+            else:
+                audio = sf.read(input_path, dtype="float32", always_2d=True)[0]
+            timings["decode"].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            mix = prepare_mix(audio, args.input_rate, TARGET_SAMPLE_RATE)
+            timings["resample"].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            gain = normalize_(mix)
+            mix = mix.unsqueeze(0)
+            timings["normalize"].append(time.perf_counter() - start)
+
+            # Same shift offsets in every run and mode, so the SDR against fp32
+            # measures the inference mode and not shift noise
+            random.seed(SHIFT_SEED)
+            torch.manual_seed(SHIFT_SEED)
+            start = time.perf_counter()
+            with torch.no_grad():
+                separated = parallel_apply_model(
+                    model, mix, shifts=config["shifts"], split=True, overlap=config["overlap"], pool=pool
+                )[0]
+            timings["separate"].append(time.perf_counter() - start)
+            if run == args.repeat - 1:
+                # Kept for the SDR comparison against fp32 in the parent process, before
+                # the soft clipping below overwrites it
+                np.save(separated_path, separated.numpy())
+
+            start = time.perf_counter()
+            stems = {
+                source: stem_samples(denormalize_(separated[index], gain)) for index, source in enumerate(model.sources)
+            }
+            timings["softclip"].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            paths = [
+                write_stem(os.path.join(stems_dir, f"{source}.wav"), stem, TARGET_SAMPLE_RATE, sample_format)
+                for source, stem in stems.items()
+            ]
+            timings["encode"].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            zip_bytes = sum(len(chunk) for chunk in iter_zip(open_entries(paths)))
+            timings["zip"].append(time.perf_counter() - start)
+
+    if pool is not None:
+        pool.stop()
+
+    stage_ms = {stage: round(statistics.median(values) * 1000, 2) for stage, values in timings.items()}
+    total_s = sum(stage_ms.values()) / 1000
+    return {
+        "audio_seconds": seconds,
+        "mode": inference_mode_label("cpu"),
+        "stage_ms": stage_ms,
+        "total_ms": round(total_s * 1000, 2),
+        "throughput_x_realtime": round(seconds / total_s, 3) if total_s else None,
+        "zip_bytes": zip_bytes,
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+    }
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=_REPO_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lengths", default="10,30,60", help="Comma-separated clip lengths in seconds")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per length, stage medians are reported")
+    parser.add_argument("--quality", default="high", help="DemucsConfig quality preset")
+    parser.add_argument("--model", default="standin", help="'standin' or a pretrained Demucs model name")
+    parser.add_argument("--hidden", type=int, default=32, help="Stand-in model width")
+    parser.add_argument("--decoder", choices=("soundfile", "ffmpeg"), default="soundfile", help="Upload decoder")
+    parser.add_argument("--input-rate", type=int, default=48000, help="Sample rate of the synthetic upload")
+    parser.add_argument("--sample-format", default=None, help="Stem sample format (default: from the preset)")
+    parser.add_argument("--threads", type=int, default=1, help="Torch threads")
+    parser.add_argument("--workers", type=int, default=0, help="Inference worker processes (0 = in-process)")
+    parser.add_argument("--modes", default="fp32", help="Comma-separated CPU inference modes (fp32, int8, bf16)")
+    parser.add_argument("--compile", default="false", help="TORCH_COMPILE value for every mode")
+    parser.add_argument("--standin-linear", action="store_true", help="Give the stand-in model a Linear layer")
+    parser.add_argument("--output", default=None, help="Also write the JSON report to this file")
+    args = parser.parse_args()
+
+    lengths = [float(value) for value in args.lengths.split(",") if value]
+    modes = [value for value in args.modes.split(",") if value]
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for seconds in lengths:
+            by_mode = {}
+            for mode in modes:
+                separated_path = os.path.join(tmp_dir, f"{seconds}-{mode}.npy")
+                # Fresh process per run so peak RSS (and the inference mode) belongs to that run only
+                with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                    result = executor.submit(_run_length, seconds, args, mode, separated_path).result()
+                by_mode[mode] = (result, separated_path)
+                results.append(result)
+
+            if "fp32" in by_mode:
+                reference_result, reference_path = by_mode["fp32"]
+                reference = np.load(reference_path)
+                reference_ms = reference_result["stage_ms"]["separate"]
+                for mode, (result, path) in by_mode.items():
+                    result["speedup_vs_fp32"] = round(reference_ms / result["stage_ms"]["separate"], 3)
+                    result["sdr_vs_fp32_db"] = _sdr_db(reference, np.load(path)) if mode != "fp32" else None
+
+    import torch
+
+    report = {
+        "benchmark": "pipeline",
+        "revision": _git_revision(),
+        "model": args.model if args.model != "standin" else f"standin(hidden={args.hidden}{', linear' if args.standin_linear else ''})",
+        "quality": args.quality,
+        "repeat": args.repeat,
+        "threads": args.threads,
+        "workers": args.workers,
+        "input_rate": args.input_rate,
+        "decoder": args.decoder,
+        "modes": modes,
+        "compile": args.compile,
+        "environment": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Deterministic stand-in for a Demucs model, for offline benchmarks.
+
+``StandInDemucs`` has the interface ``apply_model`` relies on (``sources``,
+``samplerate``, ``audio_channels``, ``segment``, ``valid_length`` and a
+``[batch, channels, samples] -> [batch, sources, channels, samples]``
+forward), so segment splitting, shifts and overlap-add run exactly as in
+production. The weights come from a fixed seed and nothing is downloaded.
+Its cost scales with ``hidden`` but is not meant to match HTDemucs; compare
+timings of the same stand-in settings across commits, not against real models.
+"""
+
+import torch
+from torch import nn
+
+DEFAULT_SOURCES = ("drums", "bass", "other", "vocals")
+
+
+class StandInDemucs(nn.Module):
+    def __init__(
+        self,
+        sources=DEFAULT_SOURCES,
+        samplerate: int = 44100,
+        segment: float = 7.8,
+        audio_channels: int = 2,
+        hidden: int = 32,
+        seed: int = 0,
+        linear: bool = False,
+    ):
+        super().__init__()
+        self.sources = list(sources)
+        self.samplerate = samplerate
+        self.segment = segment
+        self.audio_channels = audio_channels
+        self.encoder = nn.Conv1d(audio_channels, hidden, kernel_size=9, padding=4)
+        # Optional per-sample Linear, like a transformer feed-forward, so int8 quantization has work to do
+        self.mixer = nn.Linear(hidden, hidden) if linear else None
+        self.decoder = nn.Conv1d(hidden, audio_channels * len(self.sources), kernel_size=9, padding=4)
+
+        generator = torch.Generator().manual_seed(seed)
+        with torch.no_grad():
+            for parameter in self.parameters():
+                parameter.copy_(torch.randn(parameter.shape, generator=generator) * 0.1)
+        self.eval()
+
+    def valid_length(self, length: int) -> int:
+        return length
+
+    def forward(self, mix: torch.Tensor) -> torch.Tensor:
+        batch, channels, length = mix.shape
+        hidden = torch.tanh(self.encoder(mix))
+        if self.mixer is not None:
+            hidden = hidden + torch.tanh(self.mixer(hidden.transpose(1, 2))).transpose(1, 2)
+        out = self.decoder(hidden)
+        return out.view(batch, len(self.sources), channels, length)
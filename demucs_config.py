@@ -6,7 +6,7 @@ You can adjust these parameters based on your specific needs and available compu
 """
 
 import os
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional, Union
 
 class DemucsConfig:
     """Configuration class for Demucs audio separation parameters"""
@@ -14,18 +14,41 @@ class DemucsConfig:
     # Model Selection
     # Available models (in order of quality vs speed):
     # - htdemucs_ft: Fine-tuned version, best quality but slower
-    # - htdemucs: Standard hybrid transformer model
-    # - htdemucs_quantized: Faster but lower quality (original default)
+    # - htdemucs: Standard hybrid transformer model, a single model and the fastest
+    #   (CPU_INFERENCE_MODE=int8 quantizes it further)
     # - htdemucs_6s: 6-source separation (drums, bass, other, vocals, guitar, piano)
     # - mdx_extra_q: Alternative model architecture
     MODEL_OPTIONS = {
         "best_quality": "htdemucs_ft",
         "balanced": "htdemucs", 
-        "fast": "htdemucs_quantized",
+        "fast": "htdemucs",
         "six_source": "htdemucs_6s",
         "alternative": "mdx_extra_q"
     }
     
+    # Sources each model separates, in output order; models not listed
+    # separate the four standard sources
+    STANDARD_SOURCES = ["drums", "bass", "other", "vocals"]
+    MODEL_SOURCES = {
+        "htdemucs_6s": ["drums", "bass", "other", "vocals", "guitar", "piano"],
+    }
+    
+    # Sub-models of bagged models; htdemucs_ft has one specialist per source,
+    # so a stem subset runs only the specialists it needs
+    MODEL_BAG_SIZES = {
+        "htdemucs_ft": 4,
+        "mdx_extra_q": 4,
+    }
+    SPECIALIST_BAGS = {"htdemucs_ft"}
+    
+    # Segment length (seconds) the transformer models were trained on; they
+    # cannot run longer segments, so a longer segment_length changes nothing
+    MODEL_SEGMENT_SECONDS = {
+        "htdemucs": 7.8,
+        "htdemucs_ft": 7.8,
+        "htdemucs_6s": 7.8,
+    }
+    
     # Processing Parameters for Quality Optimization
     QUALITY_PRESETS = {
         "maximum": {
@@ -68,13 +91,20 @@ class DemucsConfig:
     }
     
     @classmethod
-    def get_config(cls, quality_preset: str = "high", model_preset: str = "best_quality") -> Dict[str, Any]:
+    def get_config(
+        cls,
+        quality_preset: str = "high",
+        model_preset: str = "best_quality",
+        apply_env_overrides: bool = True,
+    ) -> Dict[str, Any]:
         """
         Get a complete configuration dictionary
         
         Args:
             quality_preset: One of "maximum", "high", "balanced", "fast"
             model_preset: One of "best_quality", "balanced", "fast", "six_source", "alternative"
+            apply_env_overrides: Let DEMUCS_MODEL, USE_FLOAT32, DEMUCS_OVERLAP and
+                DEMUCS_SHIFTS override the presets
             
         Returns:
             Dictionary with all configuration parameters
@@ -86,11 +116,110 @@ class DemucsConfig:
         }
         
         # Override with environment variables if set
-        config["model_name"] = os.environ.get("DEMUCS_MODEL", config["model_name"])
-        config["use_float32"] = os.environ.get("USE_FLOAT32", str(config["use_float32"])).lower() == "true"
-        config["overlap"] = float(os.environ.get("DEMUCS_OVERLAP", config["overlap"]))
-        config["shifts"] = int(os.environ.get("DEMUCS_SHIFTS", config["shifts"]))
+        if apply_env_overrides:
+            config["model_name"] = os.environ.get("DEMUCS_MODEL", config["model_name"])
+            config["use_float32"] = os.environ.get("USE_FLOAT32", str(config["use_float32"])).lower() == "true"
+            config["overlap"] = float(os.environ.get("DEMUCS_OVERLAP", config["overlap"]))
+            config["shifts"] = int(os.environ.get("DEMUCS_SHIFTS", config["shifts"]))
+        
+        return config
+    
+    @classmethod
+    def resolve_model_name(cls, choice: str) -> str:
+        """Map a model preset ("fast", "best_quality", ...) or a model name to a model name"""
+        if choice in cls.MODEL_OPTIONS:
+            return cls.MODEL_OPTIONS[choice]
+        if choice in cls.get_model_info():
+            return choice
+        raise ValueError(
+            f"Unknown model {choice!r}, expected one of "
+            f"{sorted(cls.MODEL_OPTIONS) + sorted(cls.get_model_info())}"
+        )
+    
+    @classmethod
+    def get_model_sources(cls, model_name: str) -> List[str]:
+        """Sources separated by a model name"""
+        return list(cls.MODEL_SOURCES.get(model_name, cls.STANDARD_SOURCES))
+    
+    @classmethod
+    def get_model_passes(cls, model_name: str, stems: Optional[List[str]] = None) -> int:
+        """Sub-models a separation with ``model_name`` runs per shift"""
+        size = cls.MODEL_BAG_SIZES.get(model_name, 1)
+        if stems and model_name in cls.SPECIALIST_BAGS:
+            return min(size, len(stems))
+        return size
+    
+    @classmethod
+    def effective_segment_length(cls, model_name: str, segment_length: Optional[float]) -> Optional[float]:
+        """
+        The segment length a model actually runs with, for cache keys
+        
+        Returns:
+            ``segment_length``, or None when the model runs its trained
+            segment anyway (``model_registry.with_segment`` returns it unchanged)
+        """
+        trained = cls.MODEL_SEGMENT_SECONDS.get(model_name)
+        if not segment_length or (trained is not None and float(segment_length) >= trained):
+            return None
+        return float(segment_length)
+    
+    @classmethod
+    def resolve_stems(cls, stems: Union[str, List[str], None], model_name: str) -> Optional[List[str]]:
+        """
+        Validate a stem subset ("vocals", "vocals,drums" or a list) for a model
+        
+        Returns:
+            The requested sources in the model's order, or None for all of them
+        
+        Raises:
+            ValueError: For a source the model does not separate
+        """
+        if isinstance(stems, str):
+            stems = [stem.strip() for stem in stems.split(",")]
+        requested = {stem for stem in stems or [] if stem}
+        sources = cls.get_model_sources(model_name)
+        unknown = sorted(requested - set(sources))
+        if unknown:
+            raise ValueError(f"Model {model_name} has no stems {unknown}, expected some of {sources}")
+        if not requested or requested == set(sources):
+            return None
+        return [source for source in sources if source in requested]
+    
+    @classmethod
+    def for_request(
+        cls, quality: Optional[str] = None, model: Optional[str] = None, stems: Union[str, List[str], None] = None
+    ) -> Dict[str, Any]:
+        """
+        Resolve the configuration for one separation request
+        
+        Without arguments this is the deployment default: the DEMUCS_QUALITY
+        preset (default "high") with the environment overrides applied. An
+        explicitly requested quality preset is used as defined, so a "fast"
+        request really runs with shifts=0 even if DEMUCS_SHIFTS is set.
+        
+        Args:
+            quality: Quality preset name, or None for the deployment default
+            model: Model preset or model name, or None for DEMUCS_MODEL
+            stems: Sources to produce (see ``resolve_stems``), or None for all
+            
+        Returns:
+            Configuration dictionary, with the chosen preset under "quality"
+            and the stem subset (None for all) under "stems"
+        
+        Raises:
+            ValueError: For an unknown quality preset, model or stem
+        """
+        if quality is not None and quality not in cls.QUALITY_PRESETS:
+            raise ValueError(f"Unknown quality {quality!r}, expected one of {sorted(cls.QUALITY_PRESETS)}")
         
+        quality_preset = quality or os.environ.get("DEMUCS_QUALITY", "high")
+        config = cls.get_config(quality_preset, apply_env_overrides=quality is None)
+        if model is not None:
+            config["model_name"] = cls.resolve_model_name(model)
+        else:
+            config["model_name"] = os.environ.get("DEMUCS_MODEL", config["model_name"])
+        config["quality"] = quality_preset
+        config["stems"] = cls.resolve_stems(stems, config["model_name"])
         return config
     
     @classmethod
@@ -99,7 +228,6 @@ class DemucsConfig:
         return {
             "htdemucs_ft": "Fine-tuned Hybrid Transformer - Best quality, slower processing",
             "htdemucs": "Standard Hybrid Transformer - Good balance of quality and speed", 
-            "htdemucs_quantized": "Quantized model - Faster but lower quality",
             "htdemucs_6s": "6-source separation - Includes guitar and piano stems",
             "mdx_extra_q": "Alternative architecture - Different sound characteristics"
         }
@@ -4,6 +4,7 @@ Provides endpoints to interact with HuggingFace Spaces using gradio_client
 """
 
 import os
+import sys
 import tempfile
 import asyncio
 from typing import Optional, Dict, Any
@@ -11,9 +12,22 @@ import logging
 
 from fastapi import FastAPI, UploadFile, File, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import FileResponse, JSONResponse
 import uvicorn
 
+# Shared modules live at the repository root
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _REPO_ROOT not in sys.path:
+    sys.path.append(_REPO_ROOT)
+
+from starlette.concurrency import run_in_threadpool
+
+from upload_ingest import UploadSizeLimitMiddleware, save_upload
+from proxy_jobs import ProxyJobs, TooManyJobs
+from response_cache import PROXY_CACHE_ENABLED, ResponseCache, cache_key
+from stem_files import StemFiles
+from upstream import Upstream, file_sha256
+
 # Import gradio_client for HuggingFace Spaces API calls
 try:
     from gradio_client import Client
@@ -23,6 +37,10 @@ except ImportError:
 
 app = FastAPI(title="HuggingFace API Proxy", version="1.0.0")
 
+# Oversized uploads are refused while streaming in (MAX_UPLOAD_MB); added
+# before CORS so that the 413 responses still carry CORS headers
+app.add_middleware(UploadSizeLimitMiddleware)
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -36,161 +54,199 @@ app.add_middleware(
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# HuggingFace Space URLs
-STEM_SEPARATION_SPACE = "ahk-d/Spleeter-HT-Demucs-Stem-Separation-2025"
-GUITAR_TABS_SPACE = "JonathanJH/guitar-tabs-ai"
-
-# Cache clients to avoid repeated initialization
-_stem_client = None
-_tabs_client = None
-
-def get_stem_client():
-    global _stem_client
-    if _stem_client is None and Client is not None:
-        try:
-            _stem_client = Client(STEM_SEPARATION_SPACE)
-            logger.info(f"Initialized stem separation client for {STEM_SEPARATION_SPACE}")
-        except Exception as e:
-            logger.error(f"Failed to initialize stem separation client: {e}")
-    return _stem_client
-
-def get_tabs_client():
-    global _tabs_client
-    if _tabs_client is None and Client is not None:
-        try:
-            _tabs_client = Client(GUITAR_TABS_SPACE)
-            logger.info(f"Initialized guitar tabs client for {GUITAR_TABS_SPACE}")
-        except Exception as e:
-            logger.error(f"Failed to initialize guitar tabs client: {e}")
-    return _tabs_client
+# HuggingFace Spaces (a URL works too, e.g. a local fake_space.py)
+STEM_SEPARATION_SPACE = os.environ.get("STEM_SEPARATION_SPACE", "ahk-d/Spleeter-HT-Demucs-Stem-Separation-2025")
+GUITAR_TABS_SPACE = os.environ.get("GUITAR_TABS_SPACE", "JonathanJH/guitar-tabs-ai")
 
-@app.get("/health")
-async def health():
-    return {"status": "ok", "gradio_client_available": Client is not None}
+def _client_factory(space):
+    def connect():
+        client = Client(space)
+        logger.info(f"Initialized client for {space}")
+        return client
+    return connect
 
-@app.post("/separate-stems")
-async def separate_stems(file: UploadFile = File(...)):
-    """Separate audio stems using HuggingFace Spleeter-HT-Demucs Space"""
-    if not Client:
-        raise HTTPException(status_code=500, detail="gradio_client not available")
-    
-    client = get_stem_client()
-    if not client:
-        raise HTTPException(status_code=500, detail="Failed to initialize stem separation client")
-    
+# Pooled clients, concurrency limits, retries and coalescing per Space
+stem_upstream = Upstream("stem-separation", _client_factory(STEM_SEPARATION_SPACE))
+tabs_upstream = Upstream("guitar-tabs", _client_factory(GUITAR_TABS_SPACE))
+
+# Responses shared between users, keyed by the audio's hash, background jobs
+# and the stem files that stem responses point at
+response_cache = ResponseCache() if PROXY_CACHE_ENABLED else None
+proxy_jobs = ProxyJobs()
+stem_files = StemFiles()
+
+async def _save_upload_with_hash(file: UploadFile):
+    """Save an upload to a temporary file; returns its path, size and SHA-256"""
+    if file is None or not file.filename:
+        raise HTTPException(status_code=400, detail="No file provided")
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as temp_file:
+        temp_file_path = temp_file.name
     try:
-        # Save uploaded file to temporary location
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as temp_file:
-            content = await file.read()
-            temp_file.write(content)
-            temp_file_path = temp_file.name
-        
-        logger.info(f"Processing file: {file.filename} ({len(content)} bytes)")
-        
-        # Call the HuggingFace Space
-        result = client.predict(
-            temp_file_path,  # Input audio file
-            api_name="/predict"  # This might need adjustment based on the actual API
-        )
-        
-        # Clean up temporary file
+        size = await save_upload(file, temp_file_path)
+        content_hash = await run_in_threadpool(file_sha256, temp_file_path)
+    except BaseException:
         os.unlink(temp_file_path)
-        
-        # Process the result - format may vary
-        if isinstance(result, (list, tuple)) and len(result) > 0:
-            # Assuming the result contains file paths or URLs to the separated stems
-            stems_data = result[0] if isinstance(result[0], dict) else {}
-            
-            return {
-                "success": True,
-                "stems": stems_data,
-                "message": "Stem separation completed successfully"
-            }
-        else:
+        raise
+    logger.info(f"Received file: {file.filename} ({size} bytes, sha256 {content_hash[:12]})")
+    return temp_file_path, content_hash
+
+async def _run_stem_separation(temp_file_path: str, content_hash: str) -> Dict[str, Any]:
+    """Call the stem separation Space and shape its response; successful responses are cached"""
+    # The upstream removes the temporary file once no call needs it; identical
+    # in-flight uploads share one call (the api_name might need adjustment based on the actual API)
+    result = await stem_upstream.predict_file(f"/predict:{content_hash}", temp_file_path, api_name="/predict")
+    
+    # Process the result - format may vary
+    if isinstance(result, (list, tuple)) and len(result) > 0:
+        # gradio_client downloads the stems to local paths; browsers get the proxy's copies
+        stems_data = await run_in_threadpool(stem_files.store, content_hash, result)
+        if not stems_data:
             return {
                 "success": False,
-                "error": "Unexpected response format from stem separation API",
+                "error": "Stem separation API returned no stem files",
                 "raw_result": str(result)
             }
-            
-    except Exception as e:
-        logger.error(f"Stem separation error: {e}")
-        # Clean up temp file if it exists
-        if 'temp_file_path' in locals():
-            try:
-                os.unlink(temp_file_path)
-            except:
-                pass
         
-        raise HTTPException(status_code=500, detail=f"Stem separation failed: {str(e)}")
+        response = {
+            "success": True,
+            "stems": stems_data,
+            "message": "Stem separation completed successfully"
+        }
+        if response_cache is not None:
+            response_cache.put(cache_key("separate-stems", content_hash), response)
+        return response
+    else:
+        return {
+            "success": False,
+            "error": "Unexpected response format from stem separation API",
+            "raw_result": str(result)
+        }
+
+async def _run_tablature(temp_file_path: str, content_hash: str) -> Dict[str, Any]:
+    """Call the guitar tabs Space and shape its response; successful responses are cached"""
+    result = await tabs_upstream.predict_file(f"/predict:{content_hash}", temp_file_path, api_name="/predict")
+    
+    # Process the result - format may vary
+    if isinstance(result, (list, tuple)) and len(result) > 0:
+        # Parse the tablature result
+        tab_data = result[0]
+        
+        if isinstance(tab_data, str):
+            # If it's a string, split into lines
+            tablature = tab_data.split('\n')
+        elif isinstance(tab_data, list):
+            tablature = tab_data
+        elif isinstance(tab_data, dict):
+            tablature = tab_data.get('tablature', tab_data.get('tab', []))
+        else:
+            tablature = [str(tab_data)]
+        
+        response = {
+            "success": True,
+            "tablature": tablature,
+            "bpm": None,  # Extract if available in response
+            "key": None,  # Extract if available in response
+            "message": "Tablature generation completed successfully"
+        }
+        if response_cache is not None:
+            response_cache.put(cache_key("generate-tablature", content_hash), response)
+        return response
+    else:
+        return {
+            "success": False,
+            "error": "Unexpected response format from tablature generation API",
+            "raw_result": str(result)
+        }
+
+# endpoint -> (runner, name used in error messages)
+_RUNNERS = {
+    "separate-stems": (_run_stem_separation, "Stem separation"),
+    "generate-tablature": (_run_tablature, "Tablature generation"),
+}
+
+def _cached_response(endpoint: str, content_hash: str) -> Optional[Dict[str, Any]]:
+    """The cached response for an upload, unless it points at stem files that are gone"""
+    if response_cache is None:
+        return None
+    cached = response_cache.get(cache_key(endpoint, content_hash))
+    if cached is not None and endpoint == "separate-stems" and not stem_files.available(cached.get("stems", {})):
+        return None
+    return cached
+
+async def _respond(endpoint: str, file: UploadFile) -> Dict[str, Any]:
+    """Answer ``endpoint`` synchronously, from the response cache when possible"""
+    if not Client:
+        raise HTTPException(status_code=500, detail="gradio_client not available")
+    run, label = _RUNNERS[endpoint]
+    temp_file_path, content_hash = await _save_upload_with_hash(file)
+    
+    cached = _cached_response(endpoint, content_hash)
+    if cached is not None:
+        os.unlink(temp_file_path)
+        return cached
+    
+    try:
+        return await run(temp_file_path, content_hash)
+    except Exception as e:
+        logger.error(f"{label} error: {e}")
+        raise HTTPException(status_code=500, detail=f"{label} failed: {str(e)}")
+
+@app.get("/health")
+async def health():
+    return {
+        "status": "ok",
+        "gradio_client_available": Client is not None,
+        "upstreams": {upstream.name: upstream.stats() for upstream in (stem_upstream, tabs_upstream)},
+        "cache": response_cache.stats() if response_cache is not None else None,
+        "jobs": proxy_jobs.stats(),
+    }
+
+@app.post("/separate-stems")
+async def separate_stems(file: UploadFile = File(...)):
+    """Separate audio stems using HuggingFace Spleeter-HT-Demucs Space"""
+    return await _respond("separate-stems", file)
+
+@app.get("/stems/{content_hash}/{filename}")
+async def get_stem(content_hash: str, filename: str):
+    """A stem file that a ``/separate-stems`` response points at"""
+    path = stem_files.path(content_hash, filename)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Stem not found")
+    return FileResponse(path, filename=filename)
 
 @app.post("/generate-tablature")
 async def generate_tablature(file: UploadFile = File(...)):
     """Generate guitar tablature using HuggingFace Guitar Tabs AI Space"""
+    return await _respond("generate-tablature", file)
+
+@app.post("/jobs/{endpoint}", status_code=202)
+async def submit_job(endpoint: str, file: UploadFile = File(...)):
+    """Start ``separate-stems`` or ``generate-tablature`` in the background; poll ``GET /jobs/{id}``"""
+    if endpoint not in _RUNNERS:
+        raise HTTPException(status_code=404, detail=f"Unknown endpoint {endpoint!r}, expected one of {list(_RUNNERS)}")
     if not Client:
         raise HTTPException(status_code=500, detail="gradio_client not available")
+    run, _ = _RUNNERS[endpoint]
+    temp_file_path, content_hash = await _save_upload_with_hash(file)
     
-    client = get_tabs_client()
-    if not client:
-        raise HTTPException(status_code=500, detail="Failed to initialize guitar tabs client")
+    cached = _cached_response(endpoint, content_hash)
+    if cached is not None:
+        os.unlink(temp_file_path)
+        return proxy_jobs.completed(endpoint, cached).to_dict()
     
     try:
-        # Save uploaded file to temporary location
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as temp_file:
-            content = await file.read()
-            temp_file.write(content)
-            temp_file_path = temp_file.name
-        
-        logger.info(f"Processing file for tablature: {file.filename} ({len(content)} bytes)")
-        
-        # Call the HuggingFace Space
-        result = client.predict(
-            temp_file_path,  # Input audio file
-            api_name="/predict"  # This might need adjustment based on the actual API
-        )
-        
-        # Clean up temporary file
+        job = proxy_jobs.submit(endpoint, run(temp_file_path, content_hash))
+    except TooManyJobs as e:
         os.unlink(temp_file_path)
-        
-        # Process the result - format may vary
-        if isinstance(result, (list, tuple)) and len(result) > 0:
-            # Parse the tablature result
-            tab_data = result[0]
-            
-            if isinstance(tab_data, str):
-                # If it's a string, split into lines
-                tablature = tab_data.split('\n')
-            elif isinstance(tab_data, list):
-                tablature = tab_data
-            elif isinstance(tab_data, dict):
-                tablature = tab_data.get('tablature', tab_data.get('tab', []))
-            else:
-                tablature = [str(tab_data)]
-            
-            return {
-                "success": True,
-                "tablature": tablature,
-                "bpm": None,  # Extract if available in response
-                "key": None,  # Extract if available in response
-                "message": "Tablature generation completed successfully"
-            }
-        else:
-            return {
-                "success": False,
-                "error": "Unexpected response format from tablature generation API",
-                "raw_result": str(result)
-            }
-            
-    except Exception as e:
-        logger.error(f"Tablature generation error: {e}")
-        # Clean up temp file if it exists
-        if 'temp_file_path' in locals():
-            try:
-                os.unlink(temp_file_path)
-            except:
-                pass
-        
-        raise HTTPException(status_code=500, detail=f"Tablature generation failed: {str(e)}")
+        raise HTTPException(status_code=503, detail=str(e))
+    return job.to_dict()
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = proxy_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8001))
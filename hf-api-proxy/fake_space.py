@@ -0,0 +1,66 @@
+"""
+Local stand-in for the upstream Spaces, for exercising the proxy offline
+(needs ``gradio`` besides the proxy's requirements).
+
+Serves one ``/predict`` endpoint shaped like both Spaces the proxy calls:
+it takes an audio file and, after ``FAKE_DELAY_SECONDS``, returns a JSON
+description (with a ``tablature`` list) and the tablature as text. Point
+the proxy at it with
+
+    python fake_space.py --port 7861
+    STEM_SEPARATION_SPACE=http://127.0.0.1:7861 GUITAR_TABS_SPACE=http://127.0.0.1:7861 \\
+        uvicorn app:app --port 8001
+
+and watch ``/health`` for calls, coalescing and retries. ``--error-rate``
+makes that share of calls fail inside the Space (errors the proxy does not
+retry).
+"""
+
+import argparse
+import hashlib
+import os
+import random
+import threading
+import time
+
+import gradio as gr
+import uvicorn
+from fastapi import FastAPI
+
+FAKE_DELAY_SECONDS = float(os.environ.get("FAKE_DELAY_SECONDS", "2.0"))
+
+_calls = 0
+_calls_lock = threading.Lock()
+
+
+def create_fake_space(delay_seconds: float = FAKE_DELAY_SECONDS, error_rate: float = 0.0) -> gr.Interface:
+    def predict(audio_path):
+        global _calls
+        with _calls_lock:
+            _calls += 1
+            call = _calls
+        time.sleep(delay_seconds)
+        if random.random() < error_rate:
+            raise gr.Error("Fake Space failure")
+        with open(audio_path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        tablature = ["e|-----0-----|", "B|---1---1---|"]
+        info = {"call": call, "sha256": digest, "bytes": os.path.getsize(audio_path), "tablature": tablature}
+        return info, "\n".join(tablature)
+
+    return gr.Interface(predict, gr.File(type="filepath"), [gr.JSON(), gr.Textbox()], api_name="predict")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run a fake upstream Space for the proxy.")
+    parser.add_argument("--port", type=int, default=7861)
+    parser.add_argument("--delay", type=float, default=FAKE_DELAY_SECONDS, help="Seconds per call")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of calls that fail")
+    args = parser.parse_args()
+    demo = create_fake_space(args.delay, args.error_rate)
+    demo.queue(default_concurrency_limit=None)
+    uvicorn.run(gr.mount_gradio_app(FastAPI(), demo, path="/"), host="127.0.0.1", port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Submit/poll jobs for the proxy's long-running endpoints.
+
+A remote Space can take minutes, longer than many clients (and serverless
+functions) keep a request open. ``POST /jobs/<endpoint>`` starts the
+upstream call as a background task and answers at once with a job id;
+``GET /jobs/{id}`` reports its status and, once done, the same response the
+synchronous endpoint would have returned. Finished jobs are forgotten after
+``PROXY_JOB_TTL_SECONDS``, or sooner, oldest first, beyond
+``PROXY_MAX_FINISHED_JOBS`` (cache hits finish at once, so a client
+resubmitting a cached upload would otherwise grow the store without bound).
+"""
+
+import asyncio
+import logging
+import os
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+PROXY_JOB_TTL_SECONDS = float(os.environ.get("PROXY_JOB_TTL_SECONDS", "3600"))
+# Unfinished jobs accepted at once; beyond this submissions are refused
+PROXY_MAX_JOBS = max(1, int(os.environ.get("PROXY_MAX_JOBS", "64")))
+# Finished jobs kept for polling; the oldest are forgotten beyond this
+PROXY_MAX_FINISHED_JOBS = max(1, int(os.environ.get("PROXY_MAX_FINISHED_JOBS", "1024")))
+
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+
+class TooManyJobs(Exception):
+    """Raised when ``PROXY_MAX_JOBS`` jobs are already unfinished."""
+
+
+@dataclass
+class ProxyJob:
+    id: str
+    endpoint: str
+    status: str = JOB_RUNNING
+    result: Any = None
+    error: Optional[str] = None
+    # Served from the response cache without an upstream call
+    cached: bool = False
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (JOB_DONE, JOB_FAILED)
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "endpoint": self.endpoint,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "cached": self.cached,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class ProxyJobs:
+    """Jobs run as tasks on the event loop; all methods must be called from it."""
+
+    def __init__(
+        self,
+        ttl_seconds: float = PROXY_JOB_TTL_SECONDS,
+        max_jobs: int = PROXY_MAX_JOBS,
+        max_finished: int = PROXY_MAX_FINISHED_JOBS,
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.max_jobs = max_jobs
+        self.max_finished = max_finished
+        # In submission order, so the oldest finished jobs are found first
+        self._jobs: Dict[str, ProxyJob] = {}
+        # Strong references, so running tasks are not garbage collected
+        self._tasks: Dict[str, "asyncio.Task[None]"] = {}
+
+    @property
+    def unfinished(self) -> int:
+        return len(self._tasks)
+
+    def completed(self, endpoint: str, result: Any) -> ProxyJob:
+        """Record a job whose response was already known (a cache hit)."""
+        job = ProxyJob(uuid.uuid4().hex, endpoint, JOB_DONE, result, cached=True, finished_at=time.time())
+        self._jobs[job.id] = job
+        self._reap_expired()
+        return job
+
+    def submit(self, endpoint: str, call: Awaitable[Any]) -> ProxyJob:
+        """
+        Run ``call`` in the background as a new job.
+
+        Raises:
+            TooManyJobs: When the job limit is reached; ``call`` is closed unrun
+        """
+        self._reap_expired()
+        if self.unfinished >= self.max_jobs:
+            if asyncio.iscoroutine(call):
+                call.close()
+            raise TooManyJobs(f"{self.unfinished} jobs are already running, try again later")
+        job = ProxyJob(uuid.uuid4().hex, endpoint)
+        self._jobs[job.id] = job
+        self._tasks[job.id] = asyncio.ensure_future(self._run(job, call))
+        return job
+
+    async def _run(self, job: ProxyJob, call: Awaitable[Any]) -> None:
+        try:
+            job.result = await call
+            job.status = JOB_DONE
+        except Exception as exc:
+            logger.error(f"Job {job.id} ({job.endpoint}) failed: {exc}")
+            job.error = str(exc)
+            job.status = JOB_FAILED
+        finally:
+            job.finished_at = time.time()
+            self._tasks.pop(job.id, None)
+
+    def get(self, job_id: str) -> Optional[ProxyJob]:
+        return self._jobs.get(job_id)
+
+    def _reap_expired(self) -> None:
+        now = time.time()
+        finished = [job for job in self._jobs.values() if job.finished]
+        excess = len(finished) - self.max_finished
+        for index, job in enumerate(finished):
+            if index < excess or (job.finished_at is not None and now - job.finished_at > self.ttl_seconds):
+                del self._jobs[job.id]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "jobs": len(self._jobs),
+            "unfinished": self.unfinished,
+            "max_jobs": self.max_jobs,
+            "max_finished": self.max_finished,
+        }
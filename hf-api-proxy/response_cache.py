@@ -0,0 +1,67 @@
+"""
+In-memory cache of proxy responses, shared by every user of the proxy.
+
+Responses are keyed by endpoint and the SHA-256 of the uploaded audio, so a
+repeat upload of the same file skips the upstream Space. Entries expire
+after ``PROXY_CACHE_TTL_SECONDS`` and the least recently used ones are
+evicted beyond ``PROXY_CACHE_MAX_ENTRIES``. Only successful responses are
+stored.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+PROXY_CACHE_ENABLED = os.environ.get("PROXY_CACHE_ENABLED", "true").lower() == "true"
+PROXY_CACHE_TTL_SECONDS = float(os.environ.get("PROXY_CACHE_TTL_SECONDS", "3600"))
+PROXY_CACHE_MAX_ENTRIES = max(1, int(os.environ.get("PROXY_CACHE_MAX_ENTRIES", "256")))
+
+
+def cache_key(endpoint: str, content_hash: str) -> str:
+    return f"{endpoint}:{content_hash}"
+
+
+class ResponseCache:
+    """TTL- and LRU-bounded mapping of cache keys to JSON-serializable responses."""
+
+    def __init__(self, max_entries: int = PROXY_CACHE_MAX_ENTRIES, ttl_seconds: float = PROXY_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # key -> (expires_at, response), least recently used first
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[Any]:
+        """The cached response for ``key``, or None when missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, response: Any) -> None:
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl_seconds, response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+        }
@@ -0,0 +1,125 @@
+"""
+Stem files returned by the stem separation Space, served by the proxy.
+
+``gradio_client`` downloads a Space's file outputs into a local temporary
+directory, which a browser cannot reach. The proxy copies the four stems
+into ``PROXY_STEMS_DIR/<sha256 of the upload>/`` and answers with
+``/stems/<sha256>/<stem><ext>`` paths that ``GET /stems/...`` serves, so a
+cached response points at files that exist as long as it does. Directories
+older than ``PROXY_STEMS_TTL_SECONDS`` are removed.
+"""
+
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+import uuid
+from typing import Any, Dict, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+PROXY_STEMS_DIR = os.environ.get("PROXY_STEMS_DIR", os.path.join(tempfile.gettempdir(), "proxy-stems"))
+# Outlives the cached responses and finished jobs that point at the files
+PROXY_STEMS_TTL_SECONDS = float(os.environ.get("PROXY_STEMS_TTL_SECONDS", "7200"))
+
+# Stem -> indexes of the Space output holding it, in order of preference
+# (the same outputs the Next.js status route reads from the Space directly)
+STEM_OUTPUTS = {
+    "drums": (0, 5),
+    "bass": (1, 6),
+    "other": (2, 7),
+    "vocals": (3, 4),
+}
+
+_HASH_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+def _output_path(output: Any) -> Optional[str]:
+    """Local path of one Space output: a path string, or a file dict from older clients."""
+    if isinstance(output, dict):
+        output = output.get("path") or output.get("name")
+    if isinstance(output, str) and os.path.isfile(output):
+        return output
+    return None
+
+
+def _stem_source(outputs: Sequence[Any], indexes: Sequence[int]) -> Optional[str]:
+    for index in indexes:
+        path = _output_path(outputs[index]) if index < len(outputs) else None
+        if path is not None:
+            return path
+    return None
+
+
+class StemFiles:
+    """Copies of separated stems on local disk, addressed by upload hash and stem name."""
+
+    def __init__(self, root: str = PROXY_STEMS_DIR, ttl_seconds: float = PROXY_STEMS_TTL_SECONDS):
+        self.root = root
+        self.ttl_seconds = ttl_seconds
+
+    def store(self, content_hash: str, outputs: Sequence[Any]) -> Dict[str, str]:
+        """
+        Copy the stems among a Space's ``outputs`` under ``content_hash``.
+
+        Args:
+            content_hash: SHA-256 of the uploaded audio
+            outputs: The Space's outputs, as returned by ``gradio_client``
+
+        Returns:
+            Stem name -> ``/stems/...`` URL path; empty unless all four stems were found
+        """
+        self._reap_expired()
+        sources = {}
+        for stem, indexes in STEM_OUTPUTS.items():
+            path = _stem_source(outputs, indexes)
+            if path is None:
+                logger.warning(f"Stem separation output has no {stem} file")
+                return {}
+            sources[stem] = path
+
+        stem_dir = os.path.join(self.root, content_hash)
+        os.makedirs(stem_dir, exist_ok=True)
+        urls = {}
+        for stem, source in sources.items():
+            filename = stem + os.path.splitext(source)[1].lower()
+            # Copied under a temporary name, so a concurrent reader never sees half a file
+            partial = os.path.join(stem_dir, f".{filename}.{uuid.uuid4().hex}")
+            shutil.copyfile(source, partial)
+            os.replace(partial, os.path.join(stem_dir, filename))
+            urls[stem] = f"/stems/{content_hash}/{filename}"
+        return urls
+
+    def path(self, content_hash: str, filename: str) -> Optional[str]:
+        """Local path of a stored stem, or None when unknown or expired."""
+        if not _HASH_PATTERN.match(content_hash) or os.path.splitext(filename)[0] not in STEM_OUTPUTS:
+            return None
+        if os.path.basename(filename) != filename or filename.startswith("."):
+            return None
+        path = os.path.join(self.root, content_hash, filename)
+        return path if os.path.isfile(path) else None
+
+    def available(self, urls: Dict[str, str]) -> bool:
+        """Whether every ``/stems/...`` URL path in ``urls`` can still be served."""
+        for url in urls.values():
+            parts = url.split("/")
+            if len(parts) != 4 or self.path(parts[2], parts[3]) is None:
+                return False
+        return bool(urls)
+
+    def _reap_expired(self) -> None:
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return
+        cutoff = time.time() - self.ttl_seconds
+        for name in names:
+            stem_dir = os.path.join(self.root, name)
+            try:
+                expired = os.path.getmtime(stem_dir) < cutoff
+            except OSError:
+                continue
+            if expired:
+                shutil.rmtree(stem_dir, ignore_errors=True)
@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app as proxy_app
+from proxy_jobs import ProxyJobs
+from response_cache import ResponseCache, cache_key
+from stem_files import StemFiles
+
+CONTENT_HASH = "ab" * 32
+
+
+@pytest.fixture
+def proxy(tmp_path, monkeypatch):
+    monkeypatch.setattr(proxy_app, "stem_files", StemFiles(str(tmp_path / "stems")))
+    monkeypatch.setattr(proxy_app, "response_cache", ResponseCache())
+    monkeypatch.setattr(proxy_app, "proxy_jobs", ProxyJobs())
+    return proxy_app
+
+
+def _fake_predict(monkeypatch, result):
+    async def predict_file(key, path, *args, **kwargs):
+        return result
+
+    monkeypatch.setattr(proxy_app.stem_upstream, "predict_file", predict_file)
+
+
+def _downloaded_stems(tmp_path):
+    # gradio_client returns the Space's file outputs as local paths
+    paths = []
+    for stem in ("drums", "bass", "other", "vocals"):
+        path = tmp_path / "gradio" / stem / f"{stem}.WAV"
+        path.parent.mkdir(parents=True)
+        path.write_bytes(stem.encode() * 100)
+        paths.append(str(path))
+    return tuple(paths) + (None, None, None, None, None, "Separated 4 stems")
+
+
+def test_stem_paths_are_served_by_the_proxy(proxy, tmp_path, monkeypatch):
+    _fake_predict(monkeypatch, _downloaded_stems(tmp_path))
+
+    response = asyncio.run(proxy._run_stem_separation(str(tmp_path / "upload.wav"), CONTENT_HASH))
+
+    assert response["success"] is True
+    assert response["stems"] == {
+        stem: f"/stems/{CONTENT_HASH}/{stem}.wav" for stem in ("drums", "bass", "other", "vocals")
+    }
+    assert proxy.response_cache.get(cache_key("separate-stems", CONTENT_HASH)) == response
+    client = TestClient(proxy.app)
+    for stem, url in response["stems"].items():
+        download = client.get(url)
+        assert download.status_code == 200
+        assert download.content == stem.encode() * 100
+    assert client.get(f"/stems/{CONTENT_HASH}/../drums.wav").status_code == 404
+
+
+@pytest.mark.parametrize("result", [({},), ("not a file", None, None, None)])
+def test_results_without_stems_are_failures_and_not_cached(proxy, tmp_path, monkeypatch, result):
+    _fake_predict(monkeypatch, result)
+
+    response = asyncio.run(proxy._run_stem_separation(str(tmp_path / "upload.wav"), CONTENT_HASH))
+
+    assert response["success"] is False
+    assert proxy.response_cache.get(cache_key("separate-stems", CONTENT_HASH)) is None
+
+
+def test_cached_stems_are_dropped_once_their_files_are_gone(proxy, tmp_path, monkeypatch):
+    _fake_predict(monkeypatch, _downloaded_stems(tmp_path))
+    asyncio.run(proxy._run_stem_separation(str(tmp_path / "upload.wav"), CONTENT_HASH))
+    assert proxy._cached_response("separate-stems", CONTENT_HASH) is not None
+
+    proxy.stem_files.ttl_seconds = -1
+    proxy.stem_files._reap_expired()
+
+    assert proxy._cached_response("separate-stems", CONTENT_HASH) is None
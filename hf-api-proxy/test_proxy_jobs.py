@@ -0,0 +1,11 @@
+from proxy_jobs import ProxyJobs
+
+
+def test_cache_hits_do_not_grow_the_store_without_bound():
+    jobs = ProxyJobs(max_finished=3)
+
+    submitted = [jobs.completed("separate-stems", {"success": True}) for _ in range(10)]
+
+    assert jobs.stats()["jobs"] == 3
+    assert [jobs.get(job.id) for job in submitted[-3:]] == submitted[-3:]
+    assert jobs.get(submitted[0].id) is None
@@ -0,0 +1,239 @@
+"""
+Calls to the upstream Hugging Face Spaces.
+
+``gradio_client.Client.predict`` blocks for the whole remote job, so it never
+runs on the event loop. Each upstream Space has:
+
+- a pool of ``Client`` objects, created lazily and reused, one per concurrent
+  call (connecting a client fetches the Space's config, which is slow);
+- a concurrency limit (``UPSTREAM_CONCURRENCY``); calls beyond it wait;
+- retries with exponential backoff and full jitter for transient failures
+  (errors the Space itself reports are not retried);
+- coalescing: identical in-flight calls, keyed by the upload's content hash,
+  share one upstream call and its result.
+
+Blocking work runs on one bounded executor shared by all upstreams
+(``UPSTREAM_THREADS``). Space ids can be replaced by URLs, so the proxy can
+be pointed at a local fake Space (``fake_space.py``).
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+UPSTREAM_THREADS = max(1, int(os.environ.get("UPSTREAM_THREADS", "8")))
+UPSTREAM_CONCURRENCY = max(1, int(os.environ.get("UPSTREAM_CONCURRENCY", "2")))
+UPSTREAM_RETRIES = max(0, int(os.environ.get("UPSTREAM_RETRIES", "3")))
+UPSTREAM_BACKOFF_SECONDS = float(os.environ.get("UPSTREAM_BACKOFF_SECONDS", "1.0"))
+UPSTREAM_BACKOFF_MAX_SECONDS = float(os.environ.get("UPSTREAM_BACKOFF_MAX_SECONDS", "30"))
+
+HASH_CHUNK_BYTES = 1024 * 1024
+
+try:
+    from gradio_client.exceptions import AppError, AuthenticationError
+
+    # The Space ran and rejected the input, or the token is wrong: retrying cannot help
+    NON_RETRYABLE_ERRORS: tuple = (AppError, AuthenticationError, ValueError)
+except ImportError:
+    NON_RETRYABLE_ERRORS = (ValueError,)
+
+try:
+    from gradio_client import handle_file
+except ImportError:
+    # gradio_client < 1.0 uploads plain file paths
+    def handle_file(path: str) -> str:
+        return path
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """The executor every blocking upstream call runs on."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(UPSTREAM_THREADS, thread_name_prefix="upstream")
+        return _executor
+
+
+def file_sha256(path: str) -> str:
+    """Hex SHA-256 of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def backoff_delay(
+    attempt: int, base: float = UPSTREAM_BACKOFF_SECONDS, cap: float = UPSTREAM_BACKOFF_MAX_SECONDS
+) -> float:
+    """Seconds to wait before retry ``attempt`` (0-based): full jitter over an exponential ceiling."""
+    return random.uniform(0.0, min(cap, base * (2 ** attempt)))
+
+
+class ClientPool:
+    """Blocking pool of reusable clients for one Space; at most ``size`` exist at once."""
+
+    def __init__(self, factory: Callable[[], Any], size: int):
+        self._factory = factory
+        self._idle: "queue.LifoQueue[Any]" = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self.created = 0
+
+    def acquire(self) -> Any:
+        """Take an idle client, or connect a new one."""
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            client = self._factory()
+        except BaseException:
+            self._slots.release()
+            raise
+        self.created += 1
+        return client
+
+    def release(self, client: Any, broken: bool = False) -> None:
+        """Return a client; a broken one is dropped and replaced on the next ``acquire``."""
+        if not broken:
+            self._idle.put(client)
+        self._slots.release()
+
+
+class Upstream:
+    """One upstream Space: pooled clients, a concurrency limit, retries and coalescing."""
+
+    def __init__(
+        self,
+        name: str,
+        client_factory: Callable[[], Any],
+        max_concurrency: int = UPSTREAM_CONCURRENCY,
+        retries: int = UPSTREAM_RETRIES,
+        backoff_seconds: float = UPSTREAM_BACKOFF_SECONDS,
+        executor: Optional[ThreadPoolExecutor] = None,
+    ):
+        self.name = name
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+        self._clients = ClientPool(client_factory, max_concurrency)
+        self._max_concurrency = max_concurrency
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._executor = executor
+        self._in_flight: Dict[str, "asyncio.Future[Any]"] = {}
+        self.calls = 0
+        self.coalesced = 0
+        self.retried = 0
+        self.failures = 0
+
+    def _predict(self, args: tuple, kwargs: dict) -> Any:
+        client = self._clients.acquire()
+        broken = False
+        try:
+            return client.predict(*args, **kwargs)
+        except NON_RETRYABLE_ERRORS:
+            raise
+        except Exception:
+            # The connection may be what failed; reconnect for the next call
+            broken = True
+            raise
+        finally:
+            self._clients.release(client, broken)
+
+    async def _call_with_retries(self, args: tuple, kwargs: dict) -> Any:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        loop = asyncio.get_running_loop()
+        executor = self._executor or get_executor()
+        async with self._semaphore:
+            for attempt in range(self.retries + 1):
+                self.calls += 1
+                start = time.perf_counter()
+                try:
+                    return await loop.run_in_executor(executor, self._predict, args, kwargs)
+                except NON_RETRYABLE_ERRORS:
+                    self.failures += 1
+                    raise
+                except Exception as exc:
+                    if attempt == self.retries:
+                        self.failures += 1
+                        raise
+                    delay = backoff_delay(attempt, self.backoff_seconds)
+                    self.retried += 1
+                    logger.warning(
+                        "%s call failed after %.1fs (%s), retry %d/%d in %.1fs",
+                        self.name, time.perf_counter() - start, exc, attempt + 1, self.retries, delay,
+                    )
+                    await asyncio.sleep(delay)
+
+    async def predict(self, key: Optional[str], *args: Any, **kwargs: Any) -> Any:
+        """
+        ``client.predict(*args, **kwargs)`` off the event loop.
+
+        Args:
+            key: Calls with the same key while one is in flight share its
+                result (e.g. content hash plus endpoint); None never coalesces
+
+        Returns:
+            The upstream result
+        """
+        if key is None:
+            return await self._call_with_retries(args, kwargs)
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            # A cancelled waiter must not cancel the call the others share
+            return await asyncio.shield(future)
+
+        future = asyncio.ensure_future(self._call_with_retries(args, kwargs))
+        self._in_flight[key] = future
+        future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def predict_file(self, key: Optional[str], path: str, *args: Any, cleanup: bool = True, **kwargs: Any) -> Any:
+        """
+        ``predict`` with a local file as the first argument.
+
+        With ``cleanup``, the file is removed once nothing needs it: right away
+        when the call is coalesced onto another one, else when the upstream call
+        finishes, even if the awaiting request was cancelled meanwhile.
+        """
+        if key is not None and key in self._in_flight:
+            if cleanup:
+                _unlink(path)
+            return await self.predict(key, handle_file(path), *args, **kwargs)
+
+        call = asyncio.ensure_future(self.predict(key, handle_file(path), *args, **kwargs))
+        if cleanup:
+            call.add_done_callback(lambda _: _unlink(path))
+        return await asyncio.shield(call)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._in_flight),
+            "clients": self._clients.created,
+            "max_concurrency": self._max_concurrency,
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "retried": self.retried,
+            "failures": self.failures,
+        }
+
+
+def _unlink(path: str) -> None:
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
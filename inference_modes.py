@@ -0,0 +1,135 @@
+"""
+CPU inference modes for loaded models.
+
+``USE_FLOAT32=false`` only halves precision on CUDA; on the CPU the weights
+stay float32 and half precision is slower than full. These modes speed up
+CPU inference instead and are chosen per deployment:
+
+    CPU_INFERENCE_MODE=fp32   float32 weights and activations (default)
+    CPU_INFERENCE_MODE=int8   dynamic int8 quantization of the Linear layers
+                              (transformer feed-forward and cross-attention
+                              projections, ~45% of HTDemucs' weights)
+    CPU_INFERENCE_MODE=bf16   bfloat16 autocast; only where the CPU has
+                              native bf16 (AVX512-BF16 / AMX), else fp32
+    TORCH_COMPILE=true        torch.compile each model's forward; any other
+                              value than true/false is used as the compile mode
+
+Modes change the separated audio slightly, so they are part of stem cache
+keys (``inference_mode_label``). ``benchmarks/bench_pipeline.py --modes``
+reports their speed and SDR against fp32.
+"""
+
+import logging
+import os
+import warnings
+from typing import Dict, Optional, Tuple
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+INFERENCE_MODES = ("fp32", "int8", "bf16")
+CPU_INFERENCE_MODE = os.environ.get("CPU_INFERENCE_MODE", "fp32").lower()
+TORCH_COMPILE = os.environ.get("TORCH_COMPILE", "false")
+
+# (model class, bf16, compile mode) -> subclass running the accelerated forward
+_ACCELERATED_CLASSES: Dict[Tuple[type, bool, Optional[str]], type] = {}
+
+
+def bf16_supported() -> bool:
+    """Whether the CPU runs bfloat16 matmuls and convolutions natively."""
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def _compile_mode(value: Optional[str]) -> Optional[str]:
+    if value is None or value.lower() in ("", "0", "false", "none"):
+        return None
+    return "default" if value.lower() in ("1", "true") else value
+
+
+def resolve_mode(mode: str = CPU_INFERENCE_MODE, device: str = "cpu") -> str:
+    """The mode that actually runs: modes apply to the CPU only, bf16 needs hardware support."""
+    if mode not in INFERENCE_MODES:
+        raise ValueError(f"Unknown CPU_INFERENCE_MODE {mode!r}, expected one of {list(INFERENCE_MODES)}")
+    if device != "cpu":
+        return "fp32"
+    if mode == "bf16" and not bf16_supported():
+        return "fp32"
+    return mode
+
+
+def inference_mode_label(
+    device: str = "cpu", mode: str = CPU_INFERENCE_MODE, compile_mode: Optional[str] = TORCH_COMPILE
+) -> str:
+    """Short description of how models run, e.g. "int8" or "bf16+compile"; used in cache keys."""
+    label = resolve_mode(mode, device)
+    if device == "cpu" and _compile_mode(compile_mode):
+        label += "+compile"
+    return label
+
+
+def _accelerated_class(base: type, bf16: bool, compile_mode: Optional[str]) -> type:
+    key = (base, bf16, compile_mode)
+    cls = _ACCELERATED_CLASSES.get(key)
+    if cls is not None:
+        return cls
+
+    run = torch.compile(base.forward, mode=compile_mode) if compile_mode else base.forward
+
+    def forward(self, mix, *args, **kwargs):
+        if not bf16:
+            return run(self, mix, *args, **kwargs)
+        with torch.autocast("cpu", dtype=torch.bfloat16):
+            out = run(self, mix, *args, **kwargs)
+        return out.to(mix.dtype)
+
+    # A subclass rather than a wrapper module keeps every attribute apply_model
+    # and with_segment rely on (segment, sources, valid_length, copy.copy)
+    cls = type(base.__name__, (base,), {"forward": forward, "__module__": base.__module__})
+    _ACCELERATED_CLASSES[key] = cls
+    return cls
+
+
+def prepare_model(
+    model: torch.nn.Module,
+    device: str = "cpu",
+    mode: str = CPU_INFERENCE_MODE,
+    compile_mode: Optional[str] = TORCH_COMPILE,
+) -> torch.nn.Module:
+    """
+    Apply the deployment's inference mode to a loaded model, in place.
+
+    Bags are prepared model by model, since ``apply_model`` calls each
+    sub-model's forward itself. Call after the model has been snapshotted:
+    prepared models are not meant to be pickled.
+
+    Args:
+        model: Model in eval mode on ``device``
+        device: Inference device; CUDA models are returned unchanged
+        mode: One of ``INFERENCE_MODES``
+        compile_mode: TORCH_COMPILE value
+
+    Returns:
+        ``model``
+    """
+    effective = resolve_mode(mode, device)
+    if effective != mode:
+        logger.warning("Inference mode %s is not available on this %s, using %s", mode, device, effective)
+    compile_mode = _compile_mode(compile_mode) if device == "cpu" else None
+    if effective == "fp32" and compile_mode is None:
+        return model
+
+    sub_models = getattr(model, "models", None)
+    for sub_model in sub_models if sub_models is not None else [model]:
+        if effective == "int8":
+            with warnings.catch_warnings():
+                # Eager dynamic quantization is deprecated in favour of torchao, but still shipped
+                warnings.simplefilter("ignore")
+                torch.ao.quantization.quantize_dynamic(sub_model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        if effective == "bf16" or compile_mode is not None:
+            sub_model.__class__ = _accelerated_class(type(sub_model), effective == "bf16", compile_mode)
+    logger.info("Prepared %s for %s inference", type(model).__name__, inference_mode_label(device, mode, compile_mode))
+    return model
@@ -0,0 +1,304 @@
+"""
+Registry of loaded Demucs models.
+
+Models are loaded lazily on first use, kept resident up to a count and a
+memory budget, and evicted least-recently-used. Concurrent requests for a
+model that is still loading wait on the same load instead of starting their
+own (single-flight).
+
+A model can be requested by preset (``DemucsConfig.MODEL_OPTIONS`` keys such
+as "fast" or "best_quality") or by its Demucs name, optionally with a shorter
+segment length (``DemucsConfig`` quality presets set ``segment_length``) or
+restricted to the sub-models a subset of stems needs.
+"""
+
+import copy
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import torch
+
+from demucs_config import DemucsConfig
+from inference_modes import prepare_model
+from model_snapshot import MODEL_SNAPSHOT_WRITE, load_snapshot, save_snapshot
+
+logger = logging.getLogger(__name__)
+
+MAX_LOADED_MODELS = max(1, int(os.environ.get("MAX_LOADED_MODELS", "2")))
+# 0 disables the budget and only MAX_LOADED_MODELS applies
+MODEL_MEMORY_BUDGET_MB = float(os.environ.get("MODEL_MEMORY_BUDGET_MB", "0"))
+
+
+class UnknownModelError(ValueError):
+    """Raised for a model or preset name the registry does not know."""
+
+
+def available_models() -> Dict[str, str]:
+    """Model names that may be requested, with their descriptions."""
+    return DemucsConfig.get_model_info()
+
+
+def resolve_model_name(choice: str) -> str:
+    """Map a preset ("fast", "best_quality", ...) or a model name to a model name."""
+    try:
+        return DemucsConfig.resolve_model_name(choice)
+    except ValueError as exc:
+        raise UnknownModelError(str(exc))
+
+
+def model_size_bytes(model: torch.nn.Module) -> int:
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+def model_segment_seconds(model) -> float:
+    """Longest segment the model (or every model of a bag) can process in one call."""
+    sub_models = getattr(model, "models", None)
+    if sub_models is not None:
+        return min(float(sub_model.segment) for sub_model in sub_models)
+    return float(model.segment)
+
+
+def with_segment(model: torch.nn.Module, segment_seconds: Optional[float]) -> torch.nn.Module:
+    """
+    Return a view of ``model`` that ``apply_model`` splits into shorter segments.
+
+    The view is a shallow copy sharing every parameter with ``model``; only
+    ``segment`` differs. Lengths at or above the trained segment (which the
+    transformer models cannot exceed) return ``model`` unchanged.
+    """
+    if not segment_seconds or float(segment_seconds) >= model_segment_seconds(model):
+        return model
+
+    sub_models = getattr(model, "models", None)
+    clone = copy.copy(model)
+    if sub_models is None:
+        clone.segment = float(segment_seconds)
+        return clone
+    # A bag keeps its models in _modules; give the copy its own dict so the
+    # original bag is left untouched.
+    clone.__dict__["_modules"] = dict(model._modules)
+    clone.models = torch.nn.ModuleList(with_segment(sub_model, segment_seconds) for sub_model in sub_models)
+    return clone
+
+
+def with_sources(model: torch.nn.Module, sources: Optional[List[str]]) -> torch.nn.Module:
+    """
+    Return a view of a bag that only runs the sub-models ``sources`` need.
+
+    Bags such as htdemucs_ft hold one specialised model per source (its bag
+    weights are zero for every other source), so a single-stem request runs
+    one sub-model instead of four. The view still returns every source, but
+    only the requested ones are meaningful. Models that are not bags, and
+    bags whose models all contribute to the requested sources, are
+    returned unchanged.
+    """
+    sub_models = getattr(model, "models", None)
+    if not sources or sub_models is None:
+        return model
+    indices = [model.sources.index(source) for source in sources]
+    keep = [i for i, weight in enumerate(model.weights) if any(weight[k] for k in indices)]
+    if len(keep) == len(sub_models):
+        return model
+
+    weights = [list(model.weights[i]) for i in keep]
+    for k in range(len(model.sources)):
+        if not any(weight[k] for weight in weights):
+            # Unrequested source nobody kept contributes to; avoids a 0/0 in the bag average
+            weights[0][k] = 1.0
+    clone = copy.copy(model)
+    clone.__dict__["_modules"] = dict(model._modules)
+    clone.models = torch.nn.ModuleList(sub_models[i] for i in keep)
+    clone.weights = weights
+    return clone
+
+
+def load_pretrained(name: str, device: str) -> torch.nn.Module:
+    """
+    Default loader: prefer the model's snapshot, else fetch the pretrained
+    checkpoint (and snapshot it for the next start).
+    """
+    print(f"Loading model {name} on device {device}")
+    model = load_snapshot(name)
+    if model is None:
+        # demucs.pretrained pulls in the whole training stack; only import it when needed
+        from demucs.pretrained import get_model
+
+        model = get_model(name)
+        if MODEL_SNAPSHOT_WRITE:
+            try:
+                save_snapshot(model, name)
+            except OSError as exc:
+                logger.warning("Could not write a snapshot of %s: %s", name, exc)
+    model.to(device)
+    model.eval()
+    # int8 / bf16 / torch.compile, per CPU_INFERENCE_MODE and TORCH_COMPILE
+    return prepare_model(model, device)
+
+
+def tag_model(model: torch.nn.Module, name: str) -> None:
+    """
+    Set ``registry_key`` = (name, index in the bag, or None) on a model and its sub-models.
+
+    The ``with_segment`` and ``with_sources`` views keep the tag, so the
+    inference process pool recognizes every variant of a model as that model.
+    """
+    sub_models = getattr(model, "models", None)
+    model.registry_key = (name, None)
+    for index, sub_model in enumerate(sub_models or []):
+        sub_model.registry_key = (name, index)
+
+
+class ModelRegistry:
+    """LRU cache of loaded models with single-flight loading."""
+
+    def __init__(
+        self,
+        device: str = "cpu",
+        max_models: int = MAX_LOADED_MODELS,
+        memory_budget_bytes: Optional[int] = None,
+        loader: Callable[[str, str], torch.nn.Module] = load_pretrained,
+        on_load: Optional[Callable[[str, float], None]] = None,
+        on_evict: Optional[Callable[[str], None]] = None,
+    ):
+        if memory_budget_bytes is None and MODEL_MEMORY_BUDGET_MB > 0:
+            memory_budget_bytes = int(MODEL_MEMORY_BUDGET_MB * 1024 * 1024)
+        self.device = device
+        self.max_models = max(1, max_models)
+        self.memory_budget_bytes = memory_budget_bytes
+        self._loader = loader
+        # Called with (name, seconds) after every load, e.g. to feed metrics
+        self._on_load = on_load
+        # Called with the name of every evicted model, e.g. to stop its inference workers
+        self._on_evict = on_evict
+        self._lock = threading.Lock()
+        # name -> (model, size in bytes), least recently used first
+        self._models: "OrderedDict[str, tuple]" = OrderedDict()
+        self._loading: Dict[str, Future] = {}
+        # (name, segment seconds, sources) -> with_segment / with_sources view of a resident model
+        self._variants: Dict[Tuple[str, Optional[float], Optional[Tuple[str, ...]]], torch.nn.Module] = {}
+        self.load_seconds: Dict[str, float] = {}
+        self.evictions = 0
+
+    def get(
+        self, name: str, segment_seconds: Optional[float] = None, sources: Optional[List[str]] = None
+    ) -> torch.nn.Module:
+        """
+        Return a loaded model, loading it (once) if needed.
+
+        With ``segment_seconds`` the model is returned as a ``with_segment``
+        view, with ``sources`` as a ``with_sources`` view. Views are kept
+        until their model is evicted, so concurrent requests with the same
+        settings share one object (and one batch in the inference batcher).
+        """
+        model = self._get_base(name)
+        if not segment_seconds or float(segment_seconds) >= model_segment_seconds(model):
+            segment_seconds = None
+        if segment_seconds is None and not sources:
+            return model
+        key = (name, float(segment_seconds) if segment_seconds else None, tuple(sources) if sources else None)
+        with self._lock:
+            variant = self._variants.get(key)
+            if variant is None:
+                variant = with_sources(with_segment(model, segment_seconds), sources)
+                if name in self._models:
+                    self._variants[key] = variant
+        return variant
+
+    def _get_base(self, name: str) -> torch.nn.Module:
+        with self._lock:
+            if name in self._models:
+                self._models.move_to_end(name)
+                return self._models[name][0]
+            future = self._loading.get(name)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._loading[name] = future
+
+        if not owner:
+            return future.result()
+
+        try:
+            start = time.perf_counter()
+            model = self._loader(name, self.device)
+            tag_model(model, name)
+            self.load_seconds[name] = time.perf_counter() - start
+            if self._on_load is not None:
+                self._on_load(name, self.load_seconds[name])
+        except BaseException as exc:
+            with self._lock:
+                del self._loading[name]
+            future.set_exception(exc)
+            raise
+
+        with self._lock:
+            self._models[name] = (model, model_size_bytes(model))
+            del self._loading[name]
+            evicted = self._evict(keep=name)
+        if self._on_evict is not None:
+            for evicted_name in evicted:
+                self._on_evict(evicted_name)
+        future.set_result(model)
+        return model
+
+    def is_loaded(self, name: str) -> bool:
+        with self._lock:
+            return name in self._models
+
+    def resident(self) -> List[str]:
+        with self._lock:
+            return list(self._models)
+
+    def evict(self, name: str) -> bool:
+        with self._lock:
+            self._drop_variants(name)
+            evicted = self._models.pop(name, None) is not None
+        if evicted and self._on_evict is not None:
+            self._on_evict(name)
+        return evicted
+
+    def _drop_variants(self, name: str) -> None:
+        for key in [key for key in self._variants if key[0] == name]:
+            del self._variants[key]
+
+    def _resident_bytes(self) -> int:
+        return sum(size for _, size in self._models.values())
+
+    def _over_budget(self) -> bool:
+        if len(self._models) > self.max_models:
+            return True
+        return self.memory_budget_bytes is not None and self._resident_bytes() > self.memory_budget_bytes
+
+    def _evict(self, keep: str) -> List[str]:
+        """Evict least recently used models past the limits; returns their names."""
+        # Models still used by a running request stay alive through that
+        # request's reference and are freed when it finishes.
+        evicted = []
+        while self._over_budget() and len(self._models) > 1:
+            oldest = next(name for name in self._models if name != keep)
+            del self._models[oldest]
+            self._drop_variants(oldest)
+            self.evictions += 1
+            evicted.append(oldest)
+            logger.info("Evicted model %s from the registry", oldest)
+        if evicted and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        return evicted
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "resident": list(self._models),
+                "resident_bytes": self._resident_bytes(),
+                "max_models": self.max_models,
+                "memory_budget_bytes": self.memory_budget_bytes,
+                "loading": list(self._loading),
+                "evictions": self.evictions,
+                "load_seconds": dict(self.load_seconds),
+            }
@@ -0,0 +1,125 @@
+"""
+Pre-serialized model snapshots for fast cold starts.
+
+``demucs.pretrained.get_model`` resolves the model's remote files, downloads
+any that are missing from the torch hub cache, and rebuilds every sub-model
+from its checkpoint (four of them for htdemucs_ft). A snapshot is the loaded,
+ready-to-run model pickled with ``torch.save``. Loading one is a single
+``torch.load`` with ``mmap=True``, so weights are paged in from the file on
+first use instead of being read and copied up front.
+
+Snapshots are written next to the app (``MODEL_SNAPSHOT_DIR``), which on
+Render and Hugging Face Spaces survives from the build to the running
+instance, unlike the hub cache in the home directory. Create them at build
+time:
+
+    python model_snapshot.py htdemucs_ft htdemucs
+
+Snapshot files name the demucs and torch versions they were written with, so
+an upgrade falls back to ``get_model`` instead of unpickling stale classes.
+"""
+
+import argparse
+import logging
+import os
+import tempfile
+import time
+from typing import List, Optional
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+_REPO_ROOT = os.path.dirname(os.path.abspath(__file__))
+# Empty disables snapshots
+MODEL_SNAPSHOT_DIR = os.environ.get("MODEL_SNAPSHOT_DIR", os.path.join(_REPO_ROOT, "model_snapshots"))
+# Write a snapshot after a model had to be built from its checkpoint
+MODEL_SNAPSHOT_WRITE = os.environ.get("MODEL_SNAPSHOT_WRITE", "true").lower() == "true"
+
+
+def snapshot_path(name: str, directory: Optional[str] = None) -> Optional[str]:
+    """Snapshot file for model ``name``, or None when snapshots are disabled."""
+    directory = MODEL_SNAPSHOT_DIR if directory is None else directory
+    if not directory:
+        return None
+    import demucs
+
+    torch_version = torch.__version__.split("+")[0]
+    return os.path.join(directory, f"{name}-demucs{demucs.__version__}-torch{torch_version}.pt")
+
+
+def load_snapshot(name: str, directory: Optional[str] = None) -> Optional[torch.nn.Module]:
+    """
+    Load a model snapshot onto the CPU, memory-mapped where torch supports it.
+
+    Returns:
+        The model in eval mode, or None if there is no usable snapshot
+    """
+    path = snapshot_path(name, directory)
+    if path is None or not os.path.exists(path):
+        return None
+    try:
+        try:
+            model = torch.load(path, map_location="cpu", mmap=True, weights_only=False)
+        except TypeError:
+            # torch < 2.1 has no mmap loading
+            model = torch.load(path, map_location="cpu")
+    except Exception as exc:
+        logger.warning("Ignoring unreadable model snapshot %s: %s", path, exc)
+        return None
+    model.eval()
+    return model
+
+
+def save_snapshot(model: torch.nn.Module, name: str, directory: Optional[str] = None) -> Optional[str]:
+    """
+    Write ``model`` (on the CPU) as the snapshot for ``name``.
+
+    The file is written under a temporary name and renamed into place, so a
+    concurrent or interrupted writer never leaves a truncated snapshot.
+
+    Returns:
+        The snapshot path, or None when snapshots are disabled
+    """
+    path = snapshot_path(name, directory)
+    if path is None:
+        return None
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            torch.save(model, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    return path
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Download Demucs models and write their snapshots.")
+    parser.add_argument("models", nargs="+", help="Model names or presets (e.g. htdemucs_ft, best_quality)")
+    parser.add_argument("--dir", default=None, help=f"Snapshot directory (default: {MODEL_SNAPSHOT_DIR})")
+    args = parser.parse_args(argv)
+
+    from demucs.pretrained import get_model
+
+    from demucs_config import DemucsConfig
+
+    for choice in args.models:
+        name = DemucsConfig.resolve_model_name(choice)
+        start = time.perf_counter()
+        model = get_model(name)
+        model.eval()
+        path = save_snapshot(model, name, args.dir)
+        if path is None:
+            raise SystemExit("Snapshots are disabled (MODEL_SNAPSHOT_DIR is empty)")
+        size_mb = os.path.getsize(path) / (1024 * 1024)
+        print(f"{name}: {path} ({size_mb:.1f} MB, {time.perf_counter() - start:.1f}s)")
+
+
+if __name__ == "__main__":
+    main()
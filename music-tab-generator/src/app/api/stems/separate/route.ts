@@ -3,6 +3,9 @@ import { NextRequest, NextResponse } from 'next/server'
 export const runtime = 'nodejs'
 export const maxDuration = 60 // Increased timeout for file upload and job start
 
+// Stands in for the Gradio session hash of jobs that run on the proxy (see ../status)
+const PROXY_SESSION = 'proxy'
+
 export async function POST(request: NextRequest) {
   try {
     console.log('Stem separation request received')
@@ -27,6 +30,38 @@ export async function POST(request: NextRequest) {
       }, { status: 413 });
     }
 
+    // With a proxy configured, it runs the Space call (queueing, retries, shared
+    // cache) as a job; the status route polls the proxy instead of the Space
+    const proxyUrl = process.env.HF_PROXY_URL;
+    if (proxyUrl) {
+      try {
+        const proxyFormData = new FormData();
+        proxyFormData.append('file', file, (file as any).name || 'audio.wav');
+        
+        const proxyResponse = await fetch(`${proxyUrl}/jobs/separate-stems`, {
+          method: 'POST',
+          body: proxyFormData,
+        });
+        
+        if (proxyResponse.ok) {
+          const job = await proxyResponse.json();
+          console.log(`Proxy job started: ${job.id}${job.cached ? ' (cached)' : ''}`);
+          
+          return NextResponse.json({
+            success: true,
+            jobId: job.id,
+            sessionHash: PROXY_SESSION,
+            status: 'started',
+            message: 'Stem separation started successfully',
+            source: 'proxy'
+          });
+        }
+        console.warn(`Proxy job submission failed: ${proxyResponse.status}`);
+      } catch (proxyError) {
+        console.warn('Proxy job submission failed, calling the Space directly:', proxyError);
+      }
+    }
+
     const baseUrl = 'https://ahk-d-spleeter-ht-demucs-stem-separation-2025.hf.space';
     
     try {
@@ -3,6 +3,77 @@ import { NextRequest, NextResponse } from 'next/server'
 export const runtime = 'nodejs'
 export const maxDuration = 30
 
+// Session hash the separate route hands out for jobs running on the proxy
+const PROXY_SESSION = 'proxy'
+
+// The proxy serves stems at /stems/... paths; the browser downloads them from
+// HF_PROXY_PUBLIC_URL when the proxy is reached differently from here
+function proxyStemUrls(stems: Record<string, string>, proxyUrl: string) {
+  const publicUrl = process.env.HF_PROXY_PUBLIC_URL || proxyUrl;
+  const urls: Record<string, string> = {};
+  for (const [stem, path] of Object.entries(stems)) {
+    urls[stem] = new URL(path, publicUrl).toString();
+  }
+  return urls;
+}
+
+// Maps a proxy job (GET /jobs/{id}) onto the status responses below
+async function proxyJobStatus(jobId: string) {
+  const proxyUrl = process.env.HF_PROXY_URL || 'http://localhost:8001';
+  
+  try {
+    const jobResponse = await fetch(`${proxyUrl}/jobs/${encodeURIComponent(jobId)}`);
+    
+    if (!jobResponse.ok) {
+      return NextResponse.json({
+        success: false,
+        status: jobResponse.status === 404 ? 'session_expired' : 'error',
+        error: jobResponse.status === 404 ? 'Job not found on the proxy' : 'Failed to check job status',
+        source: 'proxy'
+      }, { status: jobResponse.status === 404 ? 200 : jobResponse.status });
+    }
+    
+    const job = await jobResponse.json();
+    
+    if (job.status === 'running') {
+      return NextResponse.json({
+        success: null,
+        status: 'processing',
+        message: 'Stem separation is currently processing...',
+        source: 'proxy'
+      });
+    }
+    
+    if (job.status === 'done' && job.result?.success) {
+      return NextResponse.json({
+        success: true,
+        status: 'completed',
+        stems: proxyStemUrls(job.result.stems, proxyUrl),
+        source: 'proxy',
+        message: job.result.message || 'Stem separation completed successfully'
+      });
+    }
+    
+    return NextResponse.json({
+      success: false,
+      status: 'failed',
+      error: job.error || job.result?.error || 'Processing error occurred',
+      source: 'proxy'
+    });
+    
+  } catch (error) {
+    console.error('Proxy status check error:', error);
+    
+    return NextResponse.json({
+      success: false,
+      status: 'error',
+      error: 'Failed to check job status',
+      details: String(error),
+      source: 'proxy'
+    }, { status: 500 });
+  }
+}
+
 export async function GET(request: NextRequest) {
   try {
     const { searchParams } = new URL(request.url)
@@ -17,6 +88,10 @@ export async function GET(request: NextRequest) {
 
     console.log(`Checking status for job: ${jobId}, session: ${sessionHash}`)
 
+    if (sessionHash === PROXY_SESSION) {
+      return proxyJobStatus(jobId)
+    }
+
     const baseUrl = 'https://ahk-d-spleeter-ht-demucs-stem-separation-2025.hf.space';
     
     try {
@@ -0,0 +1,135 @@
+"""
+Per-request output directories for the Gradio app.
+
+Every separation writes its stems into a directory of its own, so parallel
+users never overwrite each other's files. Directories are removed once
+they are older than ``OUTPUT_TTL_SECONDS`` (Gradio has copied the files
+into its own cache by then), and the oldest ones go first whenever the
+store grows past ``OUTPUT_MAX_BYTES``. Collection runs when a directory is
+created, at most once every ``GC_INTERVAL_SECONDS``. Directories of
+requests still running are never collected, and finished ones are kept for
+at least ``GC_INTERVAL_SECONDS`` so Gradio can copy them.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+OUTPUT_DIR = os.environ.get("OUTPUT_DIR", os.path.join(tempfile.gettempdir(), "riffraff-outputs"))
+OUTPUT_TTL_SECONDS = float(os.environ.get("OUTPUT_TTL_SECONDS", "3600"))
+OUTPUT_MAX_BYTES = int(os.environ.get("OUTPUT_MAX_BYTES", str(2 * 1024 ** 3)))
+GC_INTERVAL_SECONDS = 60.0
+
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for entry in os.scandir(path):
+        if entry.is_file():
+            total += entry.stat().st_size
+    return total
+
+
+class OutputStore:
+    """Directory of per-request output directories with TTL and size-based cleanup."""
+
+    def __init__(
+        self, root: str = OUTPUT_DIR, ttl_seconds: float = OUTPUT_TTL_SECONDS, max_bytes: int = OUTPUT_MAX_BYTES
+    ):
+        self.root = root
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.removed = 0
+        self._lock = threading.Lock()
+        self._last_gc = 0.0
+        self._active = set()
+        os.makedirs(self.root, exist_ok=True)
+
+    def new_dir(self) -> str:
+        """Create an empty, uniquely named directory for one request's outputs; call ``done`` after."""
+        self._maybe_gc()
+        path = os.path.join(self.root, f"{int(time.time())}-{uuid.uuid4().hex}")
+        os.makedirs(path)
+        with self._lock:
+            self._active.add(path)
+        return path
+
+    def done(self, path: str) -> None:
+        """Mark a directory from ``new_dir`` as complete; its TTL starts now."""
+        with self._lock:
+            self._active.discard(path)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _maybe_gc(self) -> None:
+        now = time.time()
+        with self._lock:
+            if now - self._last_gc < GC_INTERVAL_SECONDS:
+                return
+            self._last_gc = now
+        self.gc()
+
+    def _list(self) -> List[Tuple[float, str, int]]:
+        found = []
+        for entry in os.scandir(self.root):
+            if not entry.is_dir():
+                continue
+            try:
+                found.append((entry.stat().st_mtime, entry.path, _dir_size(entry.path)))
+            except OSError:
+                # Removed by a concurrent collection
+                continue
+        return sorted(found)
+
+    def gc(self) -> int:
+        """
+        Remove expired directories, then the oldest ones until under the size cap.
+
+        Returns:
+            Number of directories removed
+        """
+        with self._lock:
+            entries = self._list()
+            total = sum(size for _, _, size in entries)
+            now = time.time()
+            removed = 0
+            for mtime, path, size in entries:
+                age = now - mtime
+                if path in self._active or age < GC_INTERVAL_SECONDS:
+                    continue
+                if age <= self.ttl_seconds and total <= self.max_bytes:
+                    break
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+                removed += 1
+            self.removed += removed
+            return removed
+
+    def stats(self) -> Dict[str, Any]:
+        entries = self._list()
+        return {
+            "directories": len(entries),
+            "active": len(self._active),
+            "bytes": sum(size for _, _, size in entries),
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl_seconds,
+            "removed": self.removed,
+        }
+
+
+_default_store: Optional[OutputStore] = None
+_default_store_lock = threading.Lock()
+
+
+def get_output_store() -> OutputStore:
+    """Return the process-wide output store."""
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = OutputStore()
+    return _default_store
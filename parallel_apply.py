@@ -0,0 +1,437 @@
+"""
+Parallel Demucs inference across shifts, bag models and segments.
+
+``apply_model`` runs the random shifts of a model, and the models of a bag,
+one after another; only the segments of a single pass are handed to its
+``pool`` together. ``parallel_apply_model`` keeps the same arithmetic (same
+shift offsets, same weighting, same overlap-add) but starts every
+(model, shift) pass at once, each from its own thread, so the segments of
+all passes reach the pool together.
+
+``ProcessSegmentPool`` is such a pool: single-segment forward passes run in
+worker processes forked from the serving process. Forked workers see the
+loaded model through copy-on-write memory, so the weights exist once in RAM
+no matter how many workers run; inference never writes to them. Only the
+padded segment, its segment length and its separated output cross the
+process boundary, so every segment-length and stem-subset variant of a
+model runs on the workers forked once for that model.
+
+With enough workers, a request with ``shifts=N`` finishes in about the time
+of one pass instead of N. CPU only: CUDA contexts do not survive fork.
+
+``SegmentProgress`` counts the segments of a separation as they finish, for
+progress bars and ETAs; ``parallel_apply_model`` reports to it through a thin
+wrapper around the pool.
+"""
+
+import copy
+import logging
+import math
+import multiprocessing
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+from demucs.apply import BagOfModels, DummyPoolExecutor, TensorChunk, apply_model, tensor_chunk
+from demucs.utils import center_trim
+
+logger = logging.getLogger(__name__)
+
+# Worker processes for segment inference (0 keeps inference in-process)
+INFERENCE_PROCESSES = max(0, int(os.environ.get("INFERENCE_PROCESSES", "0")))
+# Torch threads inside each worker process
+INFERENCE_PROCESS_THREADS = max(1, int(os.environ.get("INFERENCE_PROCESS_THREADS", "1")))
+
+# Models handed to forked workers, by ``_model_key``. Filled in the parent
+# right before a pool for the model forks, so the children inherit it.
+_FORKED_MODELS: Dict[Tuple, torch.nn.Module] = {}
+# Segment-length views of forked models, built inside each worker
+_SEGMENT_VIEWS: Dict[Tuple, torch.nn.Module] = {}
+
+
+def _model_key(model) -> Tuple:
+    """
+    Stable key of a (sub-)model: (registry name, index in its bag).
+
+    ``ModelRegistry`` tags the models it loads with ``registry_key``; its
+    segment and stem-subset views keep the tag, so they share workers. Other
+    models are keyed by identity, and ``_FORKED_MODELS`` keeps them alive so
+    the id is not reused while their workers exist.
+    """
+    return getattr(model, "registry_key", None) or ("id", id(model))
+
+
+def _init_worker(num_threads: int) -> None:
+    torch.set_num_threads(num_threads)
+
+
+def _run_segment(model_key: Tuple, segment: float, padded_mix: np.ndarray) -> np.ndarray:
+    model = _FORKED_MODELS[model_key]
+    if float(model.segment) != segment:
+        # HTDemucs pads its input to ``segment``, so a shorter-segment view must run as such
+        view = _SEGMENT_VIEWS.get((model_key, segment))
+        if view is None:
+            view = _SEGMENT_VIEWS[(model_key, segment)] = copy.copy(model)
+            view.segment = segment
+        model = view
+    with torch.no_grad():
+        return model(torch.from_numpy(padded_mix)).numpy()
+
+
+def _chain(future: Future, transform) -> Future:
+    """Future resolving to ``transform(future.result())``."""
+    chained: Future = Future()
+
+    def _done(source: Future) -> None:
+        try:
+            chained.set_result(transform(source.result()))
+        except Exception as exc:
+            chained.set_exception(exc)
+
+    future.add_done_callback(_done)
+    return chained
+
+
+def _bag_average(model: BagOfModels, outputs: List[torch.Tensor]) -> torch.Tensor:
+    """Per-source weighted average of the bag's outputs, as ``apply_model`` computes it."""
+    estimates = 0
+    totals = [0] * len(model.sources)
+    for out, weight in zip(outputs, model.weights):
+        for k, inst_weight in enumerate(weight):
+            out[:, k, :, :] *= inst_weight
+            totals[k] += inst_weight
+        estimates += out
+    for k in range(estimates.shape[1]):
+        estimates[:, k, :, :] /= totals[k]
+    return estimates
+
+
+def _combine_bag(model: BagOfModels, futures: List[Future]) -> Future:
+    """Future resolving to the weighted bag average, as ``apply_model`` computes it."""
+    combined: Future = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def _done(_: Future) -> None:
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        try:
+            combined.set_result(_bag_average(model, [future.result() for future in futures]))
+        except Exception as exc:
+            combined.set_exception(exc)
+
+    for future in futures:
+        future.add_done_callback(_done)
+    return combined
+
+
+class ProcessSegmentPool:
+    """
+    Pool-compatible executor running single-segment model calls in forked processes.
+
+    Each model gets its own set of workers (one per sub-model of a bag),
+    forked the first time a segment of it is submitted. Variants of a
+    registry model share them; at most ``max_models`` models keep workers,
+    and ``release`` drops those of a model the registry evicted.
+    """
+
+    def __init__(
+        self,
+        num_workers: int = INFERENCE_PROCESSES,
+        threads_per_worker: int = INFERENCE_PROCESS_THREADS,
+        max_models: int = 2,
+    ):
+        self.num_workers = max(1, num_workers)
+        self.threads_per_worker = max(1, threads_per_worker)
+        self.max_models = max(1, max_models)
+        self.segments_run = 0
+        self._lock = threading.Lock()
+        # registry name (or identity key) -> {model key -> executor}, least recently used first
+        self._executors: "OrderedDict[Any, Dict[Tuple, ProcessPoolExecutor]]" = OrderedDict()
+        self._stopped = False
+
+    def submit(self, fn, model, mix, **kwargs) -> Future:
+        """``concurrent.futures``-style submit, as called by ``apply_model``."""
+        device = torch.device(kwargs.get("device") or mix.device)
+        single_pass = fn is apply_model and not kwargs.get("split", True) and not kwargs.get("shifts", 0)
+        if single_pass and device.type == "cpu" and not self._stopped:
+            if isinstance(model, BagOfModels):
+                # Fan the bag out so its models run side by side
+                return _combine_bag(model, [self.submit(fn, sub_model, mix, **kwargs) for sub_model in model.models])
+            return self._submit_segment(model, mix)
+
+        future: Future = Future()
+        try:
+            future.set_result(fn(model, mix, **kwargs))
+        except Exception as exc:
+            future.set_exception(exc)
+        return future
+
+    def _submit_segment(self, model, mix) -> Future:
+        length = mix.shape[-1]
+        valid_length = model.valid_length(length) if hasattr(model, "valid_length") else length
+        padded_mix = tensor_chunk(mix).padded(valid_length)
+        dtype = padded_mix.dtype
+        padded_mix = padded_mix.detach().to("cpu", torch.float32).numpy()
+
+        key = _model_key(model)
+        future = self._executor_for(key, model).submit(_run_segment, key, float(model.segment), padded_mix)
+        with self._lock:
+            self.segments_run += 1
+        return _chain(future, lambda out: center_trim(torch.from_numpy(out).to(dtype), length))
+
+    def _executor_for(self, key: Tuple, model) -> ProcessPoolExecutor:
+        # Sub-models of a bag are grouped under the bag's name
+        group = key[0] if key[0] != "id" else key
+        with self._lock:
+            executors = self._executors.setdefault(group, {})
+            self._executors.move_to_end(group)
+            executor = executors.get(key)
+            if executor is not None:
+                return executor
+
+            model.eval()
+            _FORKED_MODELS[key] = model
+            executor = ProcessPoolExecutor(
+                self.num_workers,
+                mp_context=multiprocessing.get_context("fork"),
+                initializer=_init_worker,
+                initargs=(self.threads_per_worker,),
+            )
+            executors[key] = executor
+            while len(self._executors) > self.max_models:
+                self._release_locked(next(iter(self._executors)))
+            return executor
+
+    def release(self, name: str) -> None:
+        """Shut down the workers of a model, e.g. when the registry evicts it."""
+        with self._lock:
+            self._release_locked(name)
+
+    def _release_locked(self, group) -> None:
+        executors = self._executors.pop(group, None)
+        if not executors:
+            return
+        for key, executor in executors.items():
+            # Segments already submitted still finish
+            executor.shutdown(wait=False)
+            _FORKED_MODELS.pop(key, None)
+        logger.info("Shut down inference workers for model %s", group)
+
+    def stop(self) -> None:
+        with self._lock:
+            self._stopped = True
+            executors = [executor for group in self._executors.values() for executor in group.values()]
+            self._executors = OrderedDict()
+            _FORKED_MODELS.clear()
+        for executor in executors:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self) -> "ProcessSegmentPool":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        return
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers_per_model": self.num_workers,
+            "threads_per_worker": self.threads_per_worker,
+            "models": len(self._executors),
+            "segments_run": self.segments_run,
+        }
+
+
+def count_segments(model, length: int, shifts: int = 1, overlap: float = 0.25) -> int:
+    """
+    Segments ``parallel_apply_model`` (and ``apply_model``) run for ``length`` samples with ``split=True``.
+
+    A shifted pass covers up to half a second more audio, depending on its
+    random offset; the count assumes the average offset, so it can be off by
+    one segment per pass.
+    """
+    total = 0
+    for sub_model in model.models if isinstance(model, BagOfModels) else [model]:
+        stride = max(1, int((1 - overlap) * int(sub_model.samplerate * sub_model.segment)))
+        if shifts:
+            pass_length = length + int(0.5 * sub_model.samplerate) // 2
+            total += shifts * math.ceil(pass_length / stride)
+        else:
+            total += math.ceil(length / stride)
+    return total
+
+
+class _CountedResult:
+    """``DummyPoolExecutor`` result that reports when it has been computed."""
+
+    def __init__(self, result, on_done: Callable[[], None]):
+        self._result = result
+        self._on_done = on_done
+
+    def result(self):
+        out = self._result.result()
+        self._on_done()
+        return out
+
+
+class _ProgressPool:
+    """Pool wrapper counting finished segment calls into a ``SegmentProgress``."""
+
+    def __init__(self, pool, progress: "SegmentProgress"):
+        self._pool = pool
+        self._progress = progress
+
+    def submit(self, fn, *args, **kwargs):
+        future = self._pool.submit(fn, *args, **kwargs)
+        if hasattr(future, "add_done_callback"):
+            future.add_done_callback(lambda _: self._progress.advance())
+            return future
+        # Inline pools compute the segment when its result is asked for
+        return _CountedResult(future, self._progress.advance)
+
+    def __enter__(self) -> "_ProgressPool":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        return
+
+
+class SegmentProgress:
+    """
+    Finished segments of one separation, reported as ``callback(done, total, eta_seconds)``.
+
+    The segments expected are added up front (see ``count_segments``);
+    engines call ``advance`` as segments finish, from any thread. The ETA
+    extrapolates the rate since the progress was created, and is None until
+    the first segment is done.
+    """
+
+    def __init__(self, callback: Callable[[int, int, Optional[float]], None], total: int = 0):
+        self.total = total
+        self.done = 0
+        self._callback = callback
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add_total(self, segments: int) -> None:
+        with self._lock:
+            self.total += segments
+            self._callback(self.done, self.total, self._eta_seconds_locked())
+
+    def advance(self, segments: int = 1) -> None:
+        with self._lock:
+            self.done += segments
+            # Shift offsets make the expected total an estimate
+            self.total = max(self.total, self.done)
+            self._callback(self.done, self.total, self._eta_seconds_locked())
+
+    def _eta_seconds_locked(self) -> Optional[float]:
+        if not self.done:
+            return None
+        elapsed = time.monotonic() - self._started
+        return elapsed * (self.total - self.done) / self.done
+
+    def wrap(self, pool):
+        """``pool`` (inline execution when None) counting its segments into this progress."""
+        return _ProgressPool(pool if pool is not None else DummyPoolExecutor(), self)
+
+
+def parallel_apply_model(
+    model,
+    mix: torch.Tensor,
+    shifts: int = 1,
+    split: bool = True,
+    overlap: float = 0.25,
+    transition_power: float = 1.0,
+    device=None,
+    pool=None,
+    progress: Optional[SegmentProgress] = None,
+) -> torch.Tensor:
+    """
+    ``apply_model`` with every (model, shift) pass running concurrently.
+
+    Shift offsets are drawn like ``apply_model`` draws them, but all up front
+    (HTDemucs also consumes ``random`` during forward passes, so the exact
+    offsets for a given seed differ; given the same offsets, the outputs are
+    identical). Without a pool there is nothing to run in parallel and
+    ``apply_model`` is used.
+
+    Args:
+        model: Demucs model or bag of models
+        mix: [batch, channels, samples] tensor
+        shifts: Random shifts averaged per model
+        split: Split into segments (required for parallelism within a pass)
+        overlap: Segment overlap
+        transition_power: Cross-fade sharpness, as in ``apply_model``
+        device: Device for the computation, defaults to ``mix.device``
+        pool: Executor segments are submitted to
+        progress: Advanced once per finished segment; the caller adds the
+            expected total (see ``count_segments``)
+
+    Returns:
+        [batch, sources, channels, samples] tensor
+    """
+    kwargs = {
+        "split": split,
+        "overlap": overlap,
+        "transition_power": transition_power,
+        "device": device,
+        "pool": progress.wrap(pool) if progress is not None else pool,
+    }
+    if pool is None:
+        return apply_model(model, mix, shifts=shifts, **kwargs)
+
+    device = torch.device(device) if device is not None else mix.device
+    sub_models = model.models if isinstance(model, BagOfModels) else [model]
+    length = mix.shape[-1]
+
+    # (model index, shift offset) for every pass
+    passes = []
+    for index, sub_model in enumerate(sub_models):
+        sub_model.to(device)
+        sub_model.eval()
+        if shifts:
+            max_shift = int(0.5 * sub_model.samplerate)
+            passes.extend((index, random.randint(0, max_shift)) for _ in range(shifts))
+        else:
+            passes.append((index, None))
+
+    def run_pass(index: int, offset: Optional[int]) -> torch.Tensor:
+        sub_model = sub_models[index]
+        # Grad mode is per thread, so the caller's no_grad does not reach here
+        with torch.no_grad():
+            if offset is None:
+                return apply_model(sub_model, mix, shifts=0, **kwargs)
+            max_shift = int(0.5 * sub_model.samplerate)
+            padded_mix = tensor_chunk(mix).padded(length + 2 * max_shift)
+            shifted = TensorChunk(padded_mix, offset, length + max_shift - offset)
+            return apply_model(sub_model, shifted, shifts=0, **kwargs)[..., max_shift - offset:]
+
+    with ThreadPoolExecutor(len(passes), thread_name_prefix="shift-pass") as threads:
+        futures = [threads.submit(run_pass, index, offset) for index, offset in passes]
+        outputs = [future.result() for future in futures]
+
+    # Sum in the same order as apply_model so the result matches it exactly
+    per_model = []
+    for index in range(len(sub_models)):
+        model_outputs = [out for (owner, _), out in zip(passes, outputs) if owner == index]
+        if shifts:
+            out = 0
+            for shifted_out in model_outputs:
+                out += shifted_out
+            out /= shifts
+        else:
+            out = model_outputs[0]
+        per_model.append(out)
+
+    if not isinstance(model, BagOfModels):
+        return per_model[0]
+    return _bag_average(model, per_model)
@@ -0,0 +1,206 @@
+"""
+Silence detection ahead of separation.
+
+Long silent intros, outros and gaps cost as much inference as music does.
+``SilenceDetector`` finds them with one vectorized pass over frame energies
+(the loudest channel of each ``frame_samples`` frame, in dBFS) and reports
+the audible spans; separation then runs on those spans only and the stems
+are zero everywhere else.
+
+The duration cap (``MAX_DURATION_SECONDS``) counts audible samples only, so
+a song with a minute of silence up front still gets its full allowance.
+
+    SILENCE_SKIP=true               skip silent regions (false: everything is audible)
+    SILENCE_THRESHOLD_DB=-60        frames below this level (dBFS) are silent
+    SILENCE_MIN_SECONDS=1.0         shorter quiet stretches are separated anyway
+    SILENCE_PAD_SECONDS=0.2         audio kept around each audible span for context
+
+The detector is fed block by block, so the streaming path can find spans in
+its first pass without holding the track in memory.
+"""
+
+import os
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+SILENCE_SKIP = os.environ.get("SILENCE_SKIP", "true").lower() == "true"
+SILENCE_THRESHOLD_DB = float(os.environ.get("SILENCE_THRESHOLD_DB", "-60"))
+SILENCE_MIN_SECONDS = float(os.environ.get("SILENCE_MIN_SECONDS", "1.0"))
+SILENCE_PAD_SECONDS = float(os.environ.get("SILENCE_PAD_SECONDS", "0.2"))
+FRAME_SAMPLES = 2048
+
+Span = Tuple[int, int]
+
+
+def silence_settings() -> str:
+    """Silence settings as one string, for cache keys."""
+    if not SILENCE_SKIP:
+        return "off"
+    return f"{SILENCE_THRESHOLD_DB}dB/{SILENCE_MIN_SECONDS}s/{SILENCE_PAD_SECONDS}s"
+
+
+class SilenceDetector:
+    """Incremental frame-energy silence detector with an audible-duration cap."""
+
+    def __init__(
+        self,
+        sample_rate: int,
+        threshold_db: float = SILENCE_THRESHOLD_DB,
+        min_silence_seconds: float = SILENCE_MIN_SECONDS,
+        pad_seconds: float = SILENCE_PAD_SECONDS,
+        frame_samples: int = FRAME_SAMPLES,
+        full_scale: float = 1.0,
+        enabled: bool = SILENCE_SKIP,
+    ):
+        self.frame_samples = frame_samples
+        self.min_silence = int(min_silence_seconds * sample_rate)
+        self.pad = int(pad_seconds * sample_rate)
+        self.enabled = enabled
+        # Mean-square energy of a frame at the threshold, in the input's own scale
+        self._threshold = (full_scale ** 2) * 10.0 ** (threshold_db / 10.0)
+        self._frames: List[np.ndarray] = []
+        self._pending: Optional[np.ndarray] = None
+        self.num_samples = 0
+        self.audible_samples = 0
+
+    def _audible_frames(self, block: np.ndarray) -> np.ndarray:
+        channels, length = block.shape
+        frames = block[:, : length - length % self.frame_samples].reshape(channels, -1, self.frame_samples)
+        energy = np.einsum("cfs,cfs->cf", frames, frames) / self.frame_samples
+        return energy.max(axis=0) > self._threshold
+
+    def feed(self, block: np.ndarray, max_audible: Optional[int] = None) -> int:
+        """
+        Add the next [channels, samples] block.
+
+        Args:
+            block: Audio following everything fed so far
+            max_audible: Cap on audible samples over the whole stream
+
+        Returns:
+            How many samples of ``block`` fall within the cap; once this is
+            less than the block length the stream is complete. Blocks that
+            do not end on frame boundaries may overshoot the cap by less
+            than one frame.
+        """
+        block = np.asarray(block, dtype=np.float32)
+        length = block.shape[1]
+        if max_audible is not None and self.audible_samples >= max_audible:
+            return 0
+        if not self.enabled:
+            accepted = length if max_audible is None else min(length, max_audible - self.audible_samples)
+            self.num_samples += accepted
+            self.audible_samples += accepted
+            return accepted
+
+        pending = self._pending
+        data = block if pending is None else np.concatenate([pending, block], axis=1)
+        offset = 0 if pending is None else pending.shape[1]
+        audible = self._audible_frames(data)
+        accepted = length
+        if max_audible is not None and audible.any():
+            budget = max_audible - self.audible_samples
+            counts = np.cumsum(audible) * self.frame_samples
+            over = np.flatnonzero(counts >= budget)
+            if len(over):
+                # The cap falls inside frame over[0]; keep it up to the exact sample
+                frame = int(over[0])
+                before = int(counts[frame]) - self.frame_samples
+                accepted = max(0, frame * self.frame_samples + (budget - before) - offset)
+                audible = audible[: frame + 1]
+                self.audible_samples = max_audible
+                self._frames.append(audible)
+                self.num_samples += accepted
+                self._pending = None
+                return accepted
+        self.audible_samples += int(audible.sum()) * self.frame_samples
+        self._frames.append(audible)
+        self.num_samples += length
+        remainder = data.shape[1] % self.frame_samples
+        self._pending = data[:, data.shape[1] - remainder:].copy() if remainder else None
+        return accepted
+
+    def finish(self) -> None:
+        """Classify the trailing partial frame; call once after the last ``feed``."""
+        if self._pending is not None:
+            pending = self._pending
+            energy = float((pending.astype(np.float64) ** 2).mean(axis=1).max())
+            audible = energy > self._threshold
+            self._frames.append(np.array([audible]))
+            self.audible_samples += pending.shape[1] if audible else 0
+            self._pending = None
+
+    def spans(self) -> List[Span]:
+        """Audible [start, end) sample spans: short gaps merged, padded, within the stream."""
+        if not self.enabled:
+            return [(0, self.num_samples)] if self.num_samples else []
+        audible = np.concatenate(self._frames) if self._frames else np.zeros(0, dtype=bool)
+        edges = np.diff(np.concatenate([[False], audible, [False]]).astype(np.int8))
+        starts = np.flatnonzero(edges == 1) * self.frame_samples
+        ends = np.flatnonzero(edges == -1) * self.frame_samples
+
+        spans: List[Span] = []
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            start = max(0, start - self.pad)
+            end = min(self.num_samples, end + self.pad)
+            if spans and start - spans[-1][1] < self.min_silence:
+                spans[-1] = (spans[-1][0], max(spans[-1][1], end))
+            elif start < end:
+                spans.append((start, end))
+        return spans
+
+
+def detect_spans(
+    audio: np.ndarray, sample_rate: int, max_samples: Optional[int] = None, full_scale: float = 1.0
+) -> Tuple[List[Span], int]:
+    """
+    Audible spans of an in-memory [channels, samples] clip.
+
+    Returns:
+        (spans, end): the clip should be cut to ``audio[:, :end]``, where the
+        audible-duration cap is reached
+    """
+    detector = SilenceDetector(sample_rate, full_scale=full_scale)
+    end = detector.feed(audio, max_samples)
+    detector.finish()
+    return detector.spans(), end
+
+
+def span_mask(spans: List[Span], start: int, end: int) -> np.ndarray:
+    """Boolean mask over samples [start, end): True inside an audible span."""
+    mask = np.zeros(max(0, end - start), dtype=bool)
+    for span_start, span_end in spans:
+        lo, hi = max(span_start, start), min(span_end, end)
+        if hi > lo:
+            mask[lo - start:hi - start] = True
+    return mask
+
+
+def overlaps_span(spans: List[Span], start: int, end: int) -> bool:
+    return any(span_start < end and start < span_end for span_start, span_end in spans)
+
+
+def separate_spans(
+    separate: Callable[[torch.Tensor], torch.Tensor], mix: torch.Tensor, spans: List[Span], num_sources: int
+) -> torch.Tensor:
+    """
+    Run ``separate`` on the audible spans of ``mix`` only.
+
+    Args:
+        separate: [batch, channels, samples] -> [batch, sources, channels, samples]
+        mix: Full clip, [batch, channels, samples]
+        spans: Audible spans from ``detect_spans``
+        num_sources: Sources the model returns
+
+    Returns:
+        [batch, sources, channels, samples] on the CPU, zero outside the spans
+    """
+    batch, channels, length = mix.shape
+    out = torch.zeros(batch, num_sources, channels, length, dtype=torch.float32)
+    if spans == [(0, length)]:
+        return separate(mix).to("cpu", dtype=torch.float32)
+    for start, end in spans:
+        out[..., start:end] = separate(mix[..., start:end]).to("cpu", dtype=torch.float32)
+    return out
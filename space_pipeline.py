@@ -0,0 +1,222 @@
+"""
+Separation pipeline of the Gradio app.
+
+Everything that needs torch, torchaudio or demucs lives here, so importing
+``app`` only costs gradio itself and the UI comes up while this module and
+the default model load on a background thread.
+"""
+
+import os
+
+import torch
+
+from audio_processing import denormalize_, normalize_, prepare_mix, stem_samples
+from demucs_config import DemucsConfig
+from inference_modes import inference_mode_label
+from model_registry import MAX_LOADED_MODELS, ModelRegistry
+from silence import detect_spans, separate_spans, silence_settings
+from parallel_apply import INFERENCE_PROCESSES, ProcessSegmentPool, SegmentProgress, count_segments, parallel_apply_model
+from audio_encoding import OUTPUT_CONTAINER, OUTPUT_DITHER, output_format_for, write_stems
+from output_store import get_output_store
+from stem_cache import CacheKeyBuilder, get_stem_cache
+from telemetry import MODEL_LOAD_SECONDS
+from streaming_separation import (
+    DEFAULT_BLOCK_SECONDS,
+    STREAMING_SEPARATION,
+    iter_array_blocks,
+    scan_stream,
+    separate_stream,
+)
+
+TARGET_SAMPLE_RATE = 44100
+TARGET_NUM_CHANNELS = 2
+MAX_DURATION_SECONDS = int(os.environ.get("MAX_DURATION_SECONDS", "30"))
+
+# Intra-op threads per process; 0 shares the cores between concurrent requests
+TORCH_NUM_THREADS = int(os.environ.get("TORCH_NUM_THREADS", "0"))
+
+inference_device = "cuda" if torch.cuda.is_available() else "cpu"
+
+# Shift passes and segments run in forked worker processes when enabled (CPU only)
+inference_pool = (
+    ProcessSegmentPool(INFERENCE_PROCESSES, max_models=MAX_LOADED_MODELS)
+    if INFERENCE_PROCESSES and inference_device == "cpu" else None
+)
+
+# Models are loaded lazily and kept in an LRU registry
+model_registry = ModelRegistry(
+    device=inference_device,
+    on_load=lambda name, seconds: MODEL_LOAD_SECONDS.labels(name).observe(seconds),
+    # Forked workers of an evicted model would otherwise keep running
+    on_evict=inference_pool.release if inference_pool is not None else None,
+)
+
+def set_concurrency(concurrent_requests):
+    """Size torch's thread pool so ``concurrent_requests`` separations share the cores instead of oversubscribing"""
+    threads = TORCH_NUM_THREADS or max(1, (os.cpu_count() or 1) // max(1, concurrent_requests))
+    torch.set_num_threads(threads)
+    return threads
+
+def load_demucs_model(model_name, segment_seconds=None, sources=None):
+    """Load (or fetch from the registry) a Demucs model"""
+    return model_registry.get(model_name, segment_seconds, sources)
+
+def _segment_progress(progress):
+    """Finished model segments, reported as the 0.05-0.9 stretch of ``progress(fraction, desc)``"""
+    def report(done, total, eta_seconds):
+        desc = f"Separating: segment {done}/{total}"
+        if eta_seconds is not None:
+            desc += f", about {eta_seconds:.0f}s left"
+        progress(0.05 + 0.85 * done / max(1, total), desc)
+    return SegmentProgress(report)
+
+def separate(audio_file, config, trace, container=OUTPUT_CONTAINER, progress=None):
+    """
+    Run the separation pipeline for one Gradio request; returns the stem file paths
+
+    ``progress(fraction, desc)`` is called as the stages and model segments
+    finish, possibly from inference threads.
+    """
+    # Stems go to a directory of this request's own, so parallel users never collide
+    store = get_output_store()
+    out_dir = store.new_dir()
+    try:
+        return _separate(audio_file, config, trace, container, out_dir, progress or (lambda fraction, desc: None))
+    finally:
+        store.done(out_dir)
+
+def _separate(audio_file, config, trace, container, out_dir, progress):
+    """Separate into ``out_dir``; see ``separate``"""
+    output_format = output_format_for(config["use_float32"])
+    # Half precision only pays off (and only works) with CUDA kernels
+    use_half = not config["use_float32"] and inference_device == "cuda"
+    
+    # Load model
+    progress(0.0, "Loading model")
+    with trace.span("model_load"):
+        model = load_demucs_model(config["model_name"], config["segment_length"], config["stems"])
+    
+    # Gradio hands over (sample_rate, samples); integer PCM is scaled to [-1, 1]
+    sample_rate, audio_data = audio_file
+    with trace.span("resample"):
+        mix = prepare_mix(audio_data, sample_rate, TARGET_SAMPLE_RATE, TARGET_NUM_CHANNELS)
+    
+    # Limit duration, counting audible audio only; silent regions skip the model
+    max_samples = TARGET_SAMPLE_RATE * MAX_DURATION_SECONDS
+    spans, end = detect_spans(mix.numpy(), TARGET_SAMPLE_RATE, max_samples)
+    mix = mix[:, :end]
+    audio_data = mix.numpy()
+    
+    # Serve repeat uploads straight from the stem cache; a stem subset is
+    # also served from a cached separation of every stem
+    cache = get_stem_cache()
+    if cache is not None:
+        with trace.span("cache_key"):
+            key_builder = CacheKeyBuilder()
+            key_builder.update(audio_data)
+            settings = dict(
+                model=config["model_name"],
+                overlap=config["overlap"],
+                shifts=config["shifts"],
+                segment_length=DemucsConfig.effective_segment_length(config["model_name"], config["segment_length"]),
+                use_float32=config["use_float32"],
+                output_format=output_format,
+                container=container,
+                dither=OUTPUT_DITHER,
+                max_duration_seconds=MAX_DURATION_SECONDS,
+                streaming=STREAMING_SEPARATION,
+                silence=silence_settings(),
+                inference_mode=inference_mode_label(inference_device),
+            )
+            cache_keys = [key_builder.finish(TARGET_SAMPLE_RATE, **settings)]
+            if config["stems"]:
+                cache_keys.append(key_builder.finish(TARGET_SAMPLE_RATE, stems=",".join(config["stems"]), **settings))
+        with trace.span("cache_lookup"):
+            cached_stems = cache.get_first(cache_keys, out_dir)
+        if cached_stems is not None:
+            return [path for name, path in cached_stems.items() if not config["stems"] or name in config["stems"]]
+    
+    progress(0.05, "Separating")
+    if STREAMING_SEPARATION:
+        # Bounded-memory path: stems are written segment by segment
+        block_frames = int(TARGET_SAMPLE_RATE * DEFAULT_BLOCK_SECONDS)
+        
+        def open_blocks():
+            return iter_array_blocks(audio_data, block_frames)
+        
+        stats = scan_stream(open_blocks)
+        stats.spans = spans
+        
+        # Inference and encoding interleave segment by segment
+        with trace.span("stream_separate"):
+            stems = separate_stream(
+                model,
+                open_blocks,
+                stats,
+                out_dir,
+                overlap=config["overlap"],
+                shifts=config["shifts"],
+                device=inference_device,
+                tensor_dtype=torch.float16 if use_half else torch.float32,
+                sample_format=output_format,
+                dither=OUTPUT_DITHER,
+                pool=inference_pool,
+                progress=_segment_progress(progress),
+                sources=config["stems"],
+                container=container,
+            )
+        
+        if cache is not None:
+            with trace.span("cache_store"):
+                cache.put(cache_keys[-1], stems)
+        return list(stems.values())
+    
+    with trace.span("normalize"):
+        # RMS normalization in place; the gain undoes it after inference
+        gain = normalize_(mix)
+        tensor_dtype = torch.float16 if use_half else torch.float32
+        audio_tensor = mix.to(device=inference_device, dtype=tensor_dtype).unsqueeze(0)
+    
+    # Get source names
+    source_names = getattr(model, "sources", ["drums", "bass", "other", "vocals"])
+    
+    # Separate stems with optimized parameters for quality, audible spans only
+    segment_progress = _segment_progress(progress)
+    segment_progress.add_total(sum(
+        count_segments(model, span_end - span_start, config["shifts"], config["overlap"]) for span_start, span_end in spans
+    ))
+    with trace.span("inference"), torch.no_grad():
+        separated_sources = separate_spans(
+            lambda mix: parallel_apply_model(
+                model,
+                mix,
+                split=True,
+                overlap=config["overlap"],
+                shifts=config["shifts"],
+                pool=inference_pool,
+                progress=segment_progress,
+            ),
+            audio_tensor,
+            spans,
+            len(source_names),
+        )[0]
+    
+    stems = {}
+    for source_index, source_name in enumerate(source_names):
+        if config["stems"] and source_name not in config["stems"]:
+            continue
+        
+        with trace.span("postprocess"):
+            # De-normalize and soft-clip in the output tensor itself
+            stems[source_name] = stem_samples(denormalize_(separated_sources[source_index], gain))
+    
+    # Encode every stem in parallel
+    progress(0.9, "Encoding stems")
+    with trace.span("encode"):
+        stem_paths = write_stems(stems, out_dir, TARGET_SAMPLE_RATE, output_format, container, dither=OUTPUT_DITHER)
+    
+    if cache is not None:
+        with trace.span("cache_store"):
+            cache.put(cache_keys[-1], stem_paths)
+    
+    return list(stem_paths.values())
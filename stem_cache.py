@@ -0,0 +1,238 @@
+"""
+Content-addressed on-disk cache of separated stems.
+
+Entries are keyed by a hash of the decoded audio plus every setting that
+changes the separated output, so a repeat upload of the same song skips
+Demucs entirely. Each entry is a directory of stem files with a small
+``meta.json``; entries are published with an atomic rename and evicted
+least-recently-used once the cache grows past its size cap.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+# Bump when the stored layout or the pipeline output changes incompatibly
+CACHE_FORMAT_VERSION = 1
+
+STEM_CACHE_ENABLED = os.environ.get("STEM_CACHE_ENABLED", "true").lower() == "true"
+STEM_CACHE_DIR = os.environ.get(
+    "STEM_CACHE_DIR", os.path.join(tempfile.gettempdir(), "riffraff-stem-cache")
+)
+STEM_CACHE_MAX_BYTES = int(os.environ.get("STEM_CACHE_MAX_BYTES", str(1024 ** 3)))
+
+_META_FILE = "meta.json"
+
+
+class CacheKeyBuilder:
+    """
+    Incremental version of ``make_cache_key`` for audio decoded in blocks.
+
+    Audio is hashed as interleaved frames, so feeding a track block by block
+    yields the same key as hashing it in one piece.
+    """
+
+    def __init__(self):
+        self._digest = hashlib.sha256()
+        self._channels: Optional[int] = None
+        self._frames = 0
+
+    def update(self, block: np.ndarray) -> None:
+        """Add a [channels, samples] block of decoded audio."""
+        frames = np.ascontiguousarray(np.asarray(block).T, dtype=np.float32)
+        self._channels = block.shape[0]
+        self._frames += block.shape[1]
+        self._digest.update(memoryview(frames).cast("B"))
+
+    def finish(self, sample_rate: int, **settings: Any) -> str:
+        header = {
+            "version": CACHE_FORMAT_VERSION,
+            "sample_rate": int(sample_rate),
+            "shape": [self._channels, self._frames],
+            "settings": settings,
+        }
+        digest = self._digest.copy()
+        digest.update(json.dumps(header, sort_keys=True, default=str).encode("utf-8"))
+        return digest.hexdigest()
+
+
+def make_cache_key(audio: np.ndarray, sample_rate: int, **settings: Any) -> str:
+    """
+    Hash decoded audio together with the settings that affect the output.
+
+    Args:
+        audio: Decoded audio, [channels, samples]
+        sample_rate: Sample rate of ``audio``
+        settings: Model name, overlap, shifts, output format, duration cap, ...
+
+    Returns:
+        Hex digest identifying the separation result
+    """
+    builder = CacheKeyBuilder()
+    builder.update(audio)
+    return builder.finish(sample_rate, **settings)
+
+
+def _link_or_copy(src: str, dst: str) -> None:
+    # Hard links are free and survive eviction of the cache entry
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class StemCache:
+    """LRU-bounded directory of separation results."""
+
+    def __init__(self, root: str = STEM_CACHE_DIR, max_bytes: int = STEM_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # key -> entry size in bytes, least recently used first
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._total_bytes = 0
+        os.makedirs(self.root, exist_ok=True)
+        self._load_index()
+
+    def _entry_dir(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def _load_index(self) -> None:
+        found = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.startswith("."):
+                # Leftover from an interrupted write
+                shutil.rmtree(path, ignore_errors=True)
+                continue
+            if not os.path.isfile(os.path.join(path, _META_FILE)):
+                continue
+            found.append((os.path.getmtime(path), name, _dir_size(path)))
+        for _, name, size in sorted(found):
+            self._entries[name] = size
+            self._total_bytes += size
+
+    def get(self, key: str, dest_dir: str) -> Optional[Dict[str, str]]:
+        """
+        Materialize a cached result into ``dest_dir``.
+
+        Returns:
+            Ordered mapping of source name to file path, or None on a miss
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            entry_dir = self._entry_dir(key)
+            try:
+                with open(os.path.join(entry_dir, _META_FILE)) as f:
+                    meta = json.load(f)
+                os.makedirs(dest_dir, exist_ok=True)
+                stems = {}
+                for source_name, file_name in meta["stems"]:
+                    dest_path = os.path.join(dest_dir, file_name)
+                    if os.path.exists(dest_path):
+                        os.unlink(dest_path)
+                    _link_or_copy(os.path.join(entry_dir, file_name), dest_path)
+                    stems[source_name] = dest_path
+            except (OSError, ValueError, KeyError):
+                # Entry was damaged or removed behind our back
+                self._drop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            now = time.time()
+            os.utime(entry_dir, (now, now))
+            self.hits += 1
+            return stems
+
+    def get_first(self, keys: List[str], dest_dir: str) -> Optional[Dict[str, str]]:
+        """``get`` the first of ``keys`` that is cached, counting a single miss if none is."""
+        with self._lock:
+            key = next((key for key in keys if key in self._entries), None)
+            if key is None:
+                self.misses += 1
+                return None
+        return self.get(key, dest_dir)
+
+    def put(self, key: str, stems: Dict[str, str]) -> None:
+        """Store ``{source_name: path}`` under ``key``; existing entries are kept."""
+        staging_dir = os.path.join(self.root, f".tmp-{uuid.uuid4().hex}")
+        os.makedirs(staging_dir)
+        try:
+            names = []
+            for source_name, path in stems.items():
+                file_name = os.path.basename(path)
+                _link_or_copy(path, os.path.join(staging_dir, file_name))
+                names.append([source_name, file_name])
+            with open(os.path.join(staging_dir, _META_FILE), "w") as f:
+                json.dump({"stems": names, "created_at": time.time()}, f)
+            size = _dir_size(staging_dir)
+
+            with self._lock:
+                if key in self._entries:
+                    return
+                try:
+                    os.rename(staging_dir, self._entry_dir(key))
+                except OSError:
+                    # Another process published the same key first
+                    return
+                self._entries[key] = size
+                self._total_bytes += size
+                self._evict()
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def _drop(self, key: str) -> None:
+        self._total_bytes -= self._entries.pop(key, 0)
+        shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+
+    def _evict(self) -> None:
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+        }
+
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for entry in os.scandir(path):
+        if entry.is_file():
+            total += entry.stat().st_size
+    return total
+
+
+_default_cache: Optional[StemCache] = None
+_default_cache_lock = threading.Lock()
+
+
+def get_stem_cache() -> Optional[StemCache]:
+    """Return the process-wide cache, or None when caching is disabled."""
+    global _default_cache
+    if not STEM_CACHE_ENABLED:
+        return None
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = StemCache()
+    return _default_cache
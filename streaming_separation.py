@@ -0,0 +1,378 @@
+"""
+Streaming Demucs separation with bounded memory.
+
+The regular path decodes the whole clip, runs ``apply_model(split=True)`` on
+it and keeps the full ``[sources, channels, samples]`` result in memory
+before anything is written. Here the input is consumed in overlapping
+segments instead: every segment goes through the model on its own, the
+overlaps are cross-faded with the same triangular window Demucs uses, and
+each finished block is appended to the stem files straight away. Peak memory
+depends on the segment length only, not on the length of the track.
+
+Audio sources are passed as zero-argument callables returning an iterator of
+``[channels, samples]`` float32 blocks, because the track is read twice: a
+cheap first pass for RMS normalization and the cache key, then the
+inference pass.
+"""
+
+import os
+import random
+import subprocess
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, List, Optional
+
+import numpy as np
+import torch
+from demucs.apply import apply_model
+from demucs.utils import DummyPoolExecutor
+
+from audio_encoding import OUTPUT_CONTAINER, OUTPUT_DITHER, OUTPUT_FORMAT, WavStreamWriter, transcode_stems
+from audio_processing import denormalize_, native_info, normalization_gain
+from model_registry import model_segment_seconds
+from parallel_apply import SegmentProgress
+from silence import SilenceDetector, Span, overlaps_span, span_mask
+from stem_cache import CacheKeyBuilder
+
+BlockSource = Callable[[], Iterator[np.ndarray]]
+
+STREAMING_SEPARATION = os.environ.get("STREAMING_SEPARATION", "false").lower() == "true"
+
+# Decoder block size; independent from the model segment length
+DEFAULT_BLOCK_SECONDS = 5.0
+
+
+@dataclass
+class StreamStats:
+    """Result of the first pass over a stream."""
+    num_samples: int
+    rms: float
+    key_builder: CacheKeyBuilder
+    # Audible spans; None separates everything
+    spans: Optional[List[Span]] = None
+
+
+def iter_array_blocks(audio: np.ndarray, block_frames: int) -> Iterator[np.ndarray]:
+    """Yield views of an in-memory [channels, samples] array."""
+    for start in range(0, audio.shape[1], block_frames):
+        yield audio[:, start:start + block_frames]
+
+
+def iter_ffmpeg_blocks(
+    path: str,
+    sample_rate: int,
+    channels: int,
+    block_frames: int,
+) -> Iterator[np.ndarray]:
+    """
+    Decode any file ffmpeg understands into [channels, samples] float32 blocks.
+
+    Unlike ``demucs.audio.AudioFile.read`` the decoded audio is never held in
+    memory as a whole; ffmpeg writes raw samples to a pipe which is read one
+    block at a time.
+    """
+    command = [
+        "ffmpeg", "-nostdin", "-loglevel", "error",
+        "-i", path,
+        "-map", "0:a:0",
+        "-ac", str(channels),
+        "-ar", str(sample_rate),
+        "-f", "f32le", "-",
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    bytes_per_block = block_frames * channels * 4
+    try:
+        while True:
+            data = process.stdout.read(bytes_per_block)
+            if not data:
+                break
+            frames = np.frombuffer(data, dtype=np.float32)
+            frames = frames[: len(frames) - len(frames) % channels]
+            yield frames.reshape(-1, channels).T
+        _, stderr = process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError(f"ffmpeg failed to decode {path}: {stderr.decode(errors='replace').strip()}")
+    finally:
+        # Consumer stopped early (duration cap) or decoding failed
+        if process.poll() is None:
+            process.kill()
+            process.communicate()
+
+
+def iter_audio_blocks(
+    path: str,
+    sample_rate: int,
+    channels: int,
+    block_frames: int,
+) -> Iterator[np.ndarray]:
+    """
+    ``iter_ffmpeg_blocks``, but read in-process when no ffmpeg work is needed.
+
+    WAV, FLAC and AIFF already at ``sample_rate`` with ``channels`` channels
+    (or mono) are streamed by libsndfile; everything else is decoded, resampled
+    and remixed by ffmpeg.
+    """
+    info = native_info(path)
+    if info is None or info.samplerate != sample_rate or info.channels not in (1, channels):
+        yield from iter_ffmpeg_blocks(path, sample_rate, channels, block_frames)
+        return
+
+    import soundfile as sf
+
+    for block in sf.blocks(path, blocksize=block_frames, dtype="float32", always_2d=True):
+        block = block.T
+        yield np.repeat(block, channels, axis=0) if block.shape[0] != channels else block
+
+
+def _capped(blocks: Iterator[np.ndarray], max_samples: Optional[int]) -> Iterator[np.ndarray]:
+    remaining = max_samples
+    for block in blocks:
+        if remaining is not None:
+            if remaining <= 0:
+                break
+            block = block[:, :remaining]
+            remaining -= block.shape[1]
+        yield block
+
+
+def _capped_audible(
+    blocks: Iterator[np.ndarray], detector: SilenceDetector, max_samples: Optional[int]
+) -> Iterator[np.ndarray]:
+    for block in blocks:
+        accepted = detector.feed(block, max_samples)
+        if accepted:
+            yield block[:, :accepted]
+        if accepted < block.shape[1]:
+            break
+    detector.finish()
+
+
+def scan_stream(
+    open_blocks: BlockSource, max_samples: Optional[int] = None, detector: Optional[SilenceDetector] = None
+) -> StreamStats:
+    """
+    First pass: count samples, accumulate RMS and hash the audio for the cache.
+
+    With a ``detector`` the audible spans are found as well, and
+    ``max_samples`` caps audible samples instead of the track length.
+    """
+    key_builder = CacheKeyBuilder()
+    num_samples = 0
+    sum_squares = 0.0
+    num_values = 0
+    if detector is None:
+        blocks = _capped(open_blocks(), max_samples)
+    else:
+        blocks = _capped_audible(open_blocks(), detector, max_samples)
+    for block in blocks:
+        key_builder.update(block)
+        num_samples += block.shape[1]
+        sum_squares += float(np.dot(block.ravel(), block.ravel()))
+        num_values += block.size
+    rms = float(np.sqrt(sum_squares / num_values)) if num_values else 0.0
+    spans = detector.spans() if detector is not None else None
+    return StreamStats(num_samples=num_samples, rms=rms, key_builder=key_builder, spans=spans)
+
+
+class _WindowReader:
+    """Random access to a forward-only block stream within a sliding window."""
+
+    def __init__(self, blocks: Iterator[np.ndarray], channels: int, num_samples: int):
+        self._blocks = blocks
+        self._num_samples = num_samples
+        self._buffer = np.zeros((channels, 0), dtype=np.float32)
+        self._buffer_start = 0
+
+    def read(self, start: int, length: int) -> np.ndarray:
+        """Return samples [start, start + length), zero-padded outside the track."""
+        end = min(start + length, self._num_samples)
+        while self._buffer_start + self._buffer.shape[1] < end:
+            block = next(self._blocks, None)
+            if block is None:
+                break
+            self._buffer = np.concatenate([self._buffer, block.astype(np.float32, copy=False)], axis=1)
+
+        window = np.zeros((self._buffer.shape[0], length), dtype=np.float32)
+        lo = max(start, self._buffer_start)
+        hi = min(end, self._buffer_start + self._buffer.shape[1])
+        if hi > lo:
+            window[:, lo - start:hi - start] = self._buffer[:, lo - self._buffer_start:hi - self._buffer_start]
+        return window
+
+    def discard_before(self, position: int) -> None:
+        # Skipped (silent) segments were never read; move the stream past them
+        while self._buffer_start + self._buffer.shape[1] < position:
+            block = next(self._blocks, None)
+            if block is None:
+                break
+            self._buffer_start += self._buffer.shape[1]
+            self._buffer = block.astype(np.float32, copy=False)
+        drop = position - self._buffer_start
+        if drop > 0:
+            self._buffer = self._buffer[:, drop:].copy()
+            self._buffer_start = position
+
+
+def _open_stem_writers(
+    source_names: List[str], out_dir: str, sample_rate: int, channels: int, sample_format: str, dither: bool
+):
+    os.makedirs(out_dir, exist_ok=True)
+    return {
+        source_name: WavStreamWriter(
+            os.path.join(out_dir, f"{source_name}.wav"), sample_rate, channels, sample_format, dither
+        )
+        for source_name in source_names
+    }
+
+
+def separate_stream(
+    model,
+    open_blocks: BlockSource,
+    stats: StreamStats,
+    out_dir: str,
+    overlap: float = 0.25,
+    shifts: int = 2,
+    segment_seconds: Optional[float] = None,
+    device: str = "cpu",
+    tensor_dtype: torch.dtype = torch.float32,
+    sample_format: str = OUTPUT_FORMAT,
+    dither: bool = OUTPUT_DITHER,
+    progress: Optional[SegmentProgress] = None,
+    pool=None,
+    sources: Optional[List[str]] = None,
+    container: str = OUTPUT_CONTAINER,
+) -> Dict[str, str]:
+    """
+    Second pass: separate segment by segment and append to one WAV per source.
+
+    Compressed containers cannot be appended to segment by segment at the
+    same cost, so for those the stems are first written as float WAVs and
+    transcoded in parallel at the end.
+
+    Args:
+        model: Loaded Demucs model (or bag of models)
+        open_blocks: Callable returning a fresh iterator of [channels, samples] blocks
+        stats: Output of ``scan_stream`` for the same source; its sample count
+            (the duration cap) and audible spans apply here
+        out_dir: Directory the stem WAVs are written to
+        overlap: Fraction of each segment shared with the next one
+        shifts: Random time shifts averaged per segment (the Demucs shift trick)
+        segment_seconds: Segment length; capped to what the model was trained on
+        device: Inference device
+        tensor_dtype: Dtype of the tensors fed to the model
+        sample_format: Sample format of the written WAVs ("float32", "int24", "int16")
+        dither: Apply TPDF dither when quantizing to an integer format
+        progress: Advanced once per finished segment pass; the passes this
+            call runs are added to its total
+        pool: Executor segment calls are submitted to (see ``apply_model``);
+            runs them inline when omitted
+        sources: Sources to write (default: all of the model's)
+        container: Output container, one of ``audio_encoding.CONTAINERS``
+
+    Returns:
+        Ordered mapping of source name to written stem path
+    """
+    if pool is None:
+        pool = DummyPoolExecutor()
+    sample_rate = model.samplerate
+    channels = model.audio_channels
+    source_names = list(sources or model.sources)
+    source_indices = [list(model.sources).index(name) for name in source_names]
+    num_samples = stats.num_samples
+    spans = stats.spans
+
+    model_segment = model_segment_seconds(model)
+    if segment_seconds:
+        model_segment = min(model_segment, float(segment_seconds))
+    segment = int(sample_rate * model_segment)
+    stride = max(1, int((1 - overlap) * segment))
+    # Shifted passes must still overlap the next segment, otherwise gaps appear
+    max_shift = min(int(0.5 * sample_rate), max(0, segment - stride - 1)) if shifts else 0
+    passes = max(1, shifts)
+
+    weight = np.concatenate([
+        np.arange(1, segment // 2 + 1, dtype=np.float32),
+        np.arange(segment - segment // 2, 0, -1, dtype=np.float32),
+    ])
+    weight /= weight.max()
+
+    gain = normalization_gain(stats.rms)
+
+    # Overlap-add accumulators covering [acc_start, acc_start + acc_length)
+    acc_length = segment + max_shift + stride
+    out_acc = np.zeros((len(model.sources), channels, acc_length), dtype=np.float32)
+    weight_acc = np.zeros(acc_length, dtype=np.float32)
+    acc_start = -max_shift
+
+    reader = _WindowReader(_capped(open_blocks(), num_samples), channels, num_samples)
+    wav_format = sample_format if container == "wav" else "float32"
+    writers = _open_stem_writers(source_names, out_dir, sample_rate, channels, wav_format, dither)
+
+    def flush(until: int) -> None:
+        nonlocal acc_start
+        until = min(until, num_samples)
+        count = until - acc_start
+        if count <= 0:
+            return
+        skip = max(0, -acc_start)  # accumulator positions before the track start
+        if count > skip:
+            # Only requested sources are post-processed and written
+            block = out_acc[source_indices, :, skip:count] / weight_acc[skip:count]
+            if spans is not None:
+                # Silent regions are written as exact zeros
+                block *= span_mask(spans, acc_start + skip, until)
+            # De-normalize and soft-clip exactly like the in-memory path
+            denormalize_(torch.from_numpy(block), gain)
+            for source_index, source_name in enumerate(source_names):
+                writers[source_name].write(block[source_index].T)
+                # Written blocks are final, so partial stems can be previewed
+                writers[source_name].flush()
+        out_acc[..., :acc_length - count] = out_acc[..., count:]
+        out_acc[..., acc_length - count:] = 0.0
+        weight_acc[:acc_length - count] = weight_acc[count:]
+        weight_acc[acc_length - count:] = 0.0
+        acc_start = until
+
+    offsets = range(0, num_samples, stride)
+    if progress is not None:
+        progress.add_total(len(offsets) * passes)
+    try:
+        for offset in offsets:
+            # Submit every shifted pass first so a batching pool can run them together
+            submitted = []
+            for _ in range(passes):
+                position = offset - (random.randint(0, max_shift) if max_shift else 0)
+                if spans is not None and not overlaps_span(spans, position, position + segment):
+                    # All silence: the output is zeroed anyway, skip the model
+                    submitted.append((position, None))
+                    continue
+                window = reader.read(position, segment)
+                window /= gain
+                mix = torch.from_numpy(window).to(device=device, dtype=tensor_dtype).unsqueeze(0)
+                future = pool.submit(apply_model, model, mix, shifts=0, split=False, device=device)
+                submitted.append((position, future))
+
+            for position, future in submitted:
+                lo = position - acc_start
+                weight_acc[lo:lo + segment] += weight
+                if future is None:
+                    if progress is not None:
+                        progress.advance()
+                    continue
+                with torch.no_grad():
+                    estimate = future.result()[0]
+                estimate = estimate.to("cpu", dtype=torch.float32).numpy()
+
+                out_acc[..., lo:lo + segment] += estimate * weight
+                if progress is not None:
+                    progress.advance()
+
+            next_offset = offset + stride
+            flush(next_offset - max_shift)
+            reader.discard_before(next_offset - max_shift)
+        flush(num_samples)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    wav_paths = {name: os.path.join(out_dir, f"{name}.wav") for name in source_names}
+    return transcode_stems(wav_paths, container, sample_format, dither)
@@ -0,0 +1,98 @@
+"""
+Prometheus metrics and per-request timing spans.
+
+Shared by the Gradio app and the stem backend, which both serve the
+metrics below on ``/metrics``:
+
+    riffraff_stage_seconds{stage}          histogram of pipeline stage durations
+    riffraff_request_seconds{outcome}      histogram of whole separations
+    riffraff_requests_in_flight            separations currently running
+    riffraff_queue_depth                   jobs waiting for a worker
+    riffraff_model_load_seconds{model}     histogram of model loads
+    riffraff_models_resident               models held by the registry
+    riffraff_cache_hit_ratio               stem cache hits / lookups
+    riffraff_jobs_shed_total{reason}       jobs refused or dropped by admission control
+
+A ``RequestTrace`` times the stages of one request. Every span is observed
+in ``riffraff_stage_seconds`` and the whole trace is logged as one JSON line
+when the request finishes, so slow requests can be found in the logs too.
+"""
+
+import json
+import logging
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Tuple
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+logger = logging.getLogger("riffraff.telemetry")
+
+# From a cache hit (milliseconds) to a long track on a small CPU (minutes)
+_DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+STAGE_SECONDS = Histogram(
+    "riffraff_stage_seconds", "Time spent in each separation pipeline stage", ["stage"], buckets=_DURATION_BUCKETS
+)
+REQUEST_SECONDS = Histogram(
+    "riffraff_request_seconds", "End-to-end separation time", ["outcome"], buckets=_DURATION_BUCKETS
+)
+IN_FLIGHT = Gauge("riffraff_requests_in_flight", "Separations currently running")
+QUEUE_DEPTH = Gauge("riffraff_queue_depth", "Separation jobs waiting for a worker")
+MODEL_LOAD_SECONDS = Histogram(
+    "riffraff_model_load_seconds", "Time to load a model into the registry", ["model"], buckets=_DURATION_BUCKETS
+)
+MODELS_RESIDENT = Gauge("riffraff_models_resident", "Models currently held by the model registry")
+CACHE_HIT_RATIO = Gauge("riffraff_cache_hit_ratio", "Stem cache hits divided by lookups since startup")
+JOBS_SHED = Counter(
+    "riffraff_jobs_shed_total", "Jobs refused (queue_full, wait_too_long) or dropped (expired)", ["reason"]
+)
+
+
+def track_gauge(gauge: Gauge, read: Callable[[], float]) -> None:
+    """Evaluate ``read`` whenever ``gauge`` is scraped."""
+    gauge.set_function(read)
+
+
+def metrics_payload() -> Tuple[bytes, str]:
+    """Body and content type for a ``/metrics`` response."""
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+class RequestTrace:
+    """Timing spans of one separation request."""
+
+    def __init__(self, request_id: str = "", **fields):
+        self.request_id = request_id
+        self.fields = fields
+        self.spans: Dict[str, float] = {}
+        self._started = time.perf_counter()
+        self._finished = False
+
+    @contextmanager
+    def span(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            # A stage may run more than once per request (e.g. one encode per stem)
+            self.spans[stage] = self.spans.get(stage, 0.0) + elapsed
+            STAGE_SECONDS.labels(stage).observe(elapsed)
+
+    def finish(self, outcome: str = "ok") -> float:
+        """Record the request duration and log the trace; later calls do nothing."""
+        total = time.perf_counter() - self._started
+        if self._finished:
+            return total
+        self._finished = True
+        REQUEST_SECONDS.labels(outcome).observe(total)
+        logger.info(json.dumps({
+            "event": "separation",
+            "request_id": self.request_id,
+            "outcome": outcome,
+            "total_seconds": round(total, 4),
+            "stages": {stage: round(seconds, 4) for stage, seconds in self.spans.items()},
+            **self.fields,
+        }))
+        return total
@@ -0,0 +1,107 @@
+"""
+Upload ingestion for the FastAPI services.
+
+Uploads are never read into one bytes object:
+
+- ``UploadSizeLimitMiddleware`` rejects a request whose Content-Length is
+  over the limit before any of the body is read, and counts body bytes as
+  they arrive (chunked uploads have no Content-Length), failing with 413 as
+  soon as the limit is crossed.
+- Starlette's multipart parser spools each file part to a temporary file
+  once it passes 1 MB; ``save_upload`` copies that spool to its destination
+  in fixed-size chunks on a worker thread.
+
+Peak memory per upload is therefore about one chunk, whatever the file size.
+"""
+
+import os
+from typing import BinaryIO
+
+from fastapi import HTTPException, UploadFile
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse
+
+# Largest accepted request body; 0 disables the limit
+MAX_UPLOAD_MB = float(os.environ.get("MAX_UPLOAD_MB", "50"))
+MAX_UPLOAD_BYTES = int(MAX_UPLOAD_MB * 1024 * 1024)
+COPY_CHUNK_BYTES = 1024 * 1024
+
+
+def _too_large(max_bytes: int) -> HTTPException:
+    return HTTPException(status_code=413, detail=f"Upload exceeds the {max_bytes // (1024 * 1024)} MB limit")
+
+
+class UploadSizeLimitMiddleware:
+    """ASGI middleware enforcing a request body limit while the body streams in."""
+
+    def __init__(self, app, max_bytes: int = MAX_UPLOAD_BYTES):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http" or not self.max_bytes:
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        content_length = headers.get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_bytes:
+            # Answer before reading any of the body
+            error = _too_large(self.max_bytes)
+            response = JSONResponse({"detail": error.detail}, status_code=error.status_code)
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    # Raised inside form parsing, FastAPI turns it into the 413 response
+                    raise _too_large(self.max_bytes)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+def _copy_upload(source: BinaryIO, path: str, max_bytes: int) -> int:
+    source.seek(0)
+    written = 0
+    try:
+        with open(path, "wb") as destination:
+            while True:
+                chunk = source.read(COPY_CHUNK_BYTES)
+                if not chunk:
+                    break
+                written += len(chunk)
+                if max_bytes and written > max_bytes:
+                    raise _too_large(max_bytes)
+                destination.write(chunk)
+    except BaseException:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        raise
+    return written
+
+
+async def save_upload(upload: UploadFile, path: str, max_bytes: int = MAX_UPLOAD_BYTES) -> int:
+    """
+    Copy an uploaded file to ``path`` chunk by chunk, off the event loop.
+
+    Args:
+        upload: File part of a multipart request
+        path: Destination file
+        max_bytes: Size limit for this file; 0 disables it
+
+    Returns:
+        Number of bytes written
+
+    Raises:
+        HTTPException: 413 if the file is over ``max_bytes``
+    """
+    return await run_in_threadpool(_copy_upload, upload.file, path, max_bytes)